@@ -0,0 +1,249 @@
+"""
+Admission control for the routes that cost the most datastore work, so an overload of one of them degrades that
+route alone instead of slowing down every other route of the worker.
+
+Each budget covers some routes and has its own limits:
+
+- A per-user token bucket. A client over its rate gets a 429 straight away.
+- A limit on the requests of the budget running at once.
+- A bounded wait queue for requests over that limit. A request that finds the queue full, or waits longer than
+  ADMISSION_QUEUE_TIMEOUT seconds, gets a 503.
+
+Both rejections carry Retry-After. Routes outside every budget are not limited at all.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from fastapi.responses import JSONResponse
+from starlette.requests import cookie_parser
+from starlette.routing import Match
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS, HTTP_503_SERVICE_UNAVAILABLE
+from metrics import admission_in_flight, admission_queue_depth, admission_rejections, admission_wait_duration, add_request_time
+
+# Set to "off" to run without any limits, for example to benchmark the handlers themselves
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "on")
+# Seconds a request waits in a full budget's queue before it is turned away
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "2"))
+# Clients whose token buckets are kept, the least recently seen are forgotten first, which refills their bucket
+ADMISSION_MAX_CLIENTS = int(os.environ.get("ADMISSION_MAX_CLIENTS", "100000"))
+
+# Tweet search pages through postings lists
+SEARCH_CONCURRENCY = int(os.environ.get("SEARCH_CONCURRENCY", "8"))
+SEARCH_QUEUE_SIZE = int(os.environ.get("SEARCH_QUEUE_SIZE", "16"))
+SEARCH_RATE = float(os.environ.get("SEARCH_RATE", "1"))
+SEARCH_BURST = int(os.environ.get("SEARCH_BURST", "5"))
+# Timeline reads merge the materialized timeline with the followed celebrities, and the username search results
+# are shown above the timeline
+TIMELINE_CONCURRENCY = int(os.environ.get("TIMELINE_CONCURRENCY", "64"))
+TIMELINE_QUEUE_SIZE = int(os.environ.get("TIMELINE_QUEUE_SIZE", "128"))
+TIMELINE_RATE = float(os.environ.get("TIMELINE_RATE", "5"))
+TIMELINE_BURST = int(os.environ.get("TIMELINE_BURST", "20"))
+
+
+"""
+Raised when a request is turned away.
+
+Args:
+    status_code (int): 429 or 503.
+    reason (str): The reason, as reported in the metrics.
+    retry_after (float): The seconds the client should wait before trying again.
+"""
+class Rejected(Exception):
+    def __init__(self, status_code, reason, retry_after):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+"""
+Token buckets per client, kept for at most max_clients clients.
+
+Args:
+    rate (float): Tokens added per second.
+    burst (int): The most tokens a bucket holds.
+    max_clients (int): The clients whose buckets are kept.
+"""
+class TokenBuckets:
+    def __init__(self, rate, burst, max_clients=ADMISSION_MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        # client -> (tokens, time they were counted), least recently seen first
+        self.buckets = OrderedDict()
+
+    """
+    Takes a token from the client's bucket.
+
+    Returns:
+        float: 0 if the client may go ahead, otherwise the seconds until its bucket has a token again.
+    """
+    def take(self, client):
+        now = time.monotonic()
+        tokens, counted_at = self.buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - counted_at) * self.rate)
+        wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+        self.buckets[client] = (tokens - 1 if not wait else tokens, now)
+        if len(self.buckets) > self.max_clients:
+            self.buckets.popitem(last=False)
+        return wait
+
+"""
+Limits how many requests of some routes run at once, with a bounded queue of requests waiting for a slot.
+
+Args:
+    name (str): The budget name, used as the label of its metrics.
+    paths (tuple): The path templates of the routes it covers, as declared on the app.
+    concurrency (int): The requests that run at once.
+    queue_size (int): The requests that wait for a slot.
+    rate (float): The requests per second each client may make.
+    burst (int): The requests a client may make at once after being idle.
+    queue_timeout (float, optional): The seconds a request waits for a slot. Defaults to ADMISSION_QUEUE_TIMEOUT.
+"""
+class Budget:
+    def __init__(self, name, paths, concurrency, queue_size, rate, burst, queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.name = name
+        self.paths = frozenset(paths)
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.buckets = TokenBuckets(rate, burst)
+        self.running = 0
+        self.waiters = deque()
+        self.report()
+
+    def report(self):
+        admission_in_flight.set(self.running, self.name)
+        admission_queue_depth.set(len(self.waiters), self.name)
+
+    """
+    Waits for a slot, or raises Rejected when the client is over its rate, the queue is full or the wait times out.
+    The slot must be given back with release.
+
+    Args:
+        client (str): The key of the client's token bucket.
+    """
+    async def acquire(self, client):
+        wait = self.buckets.take(client)
+        if wait:
+            raise Rejected(HTTP_429_TOO_MANY_REQUESTS, "rate_limited", wait)
+
+        if self.running < self.concurrency and not self.waiters:
+            self.running += 1
+            self.report()
+            return
+        if len(self.waiters) >= self.queue_size:
+            raise Rejected(HTTP_503_SERVICE_UNAVAILABLE, "queue_full", self.queue_timeout)
+
+        # A released slot is handed straight to the oldest waiter, so running already counts it when the wait ends
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.report()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            # Unless the slot was handed over just as the wait ran out
+            if not waiter.done():
+                raise Rejected(HTTP_503_SERVICE_UNAVAILABLE, "queue_timeout", self.queue_timeout)
+        except BaseException:
+            # The client went away while waiting, a slot handed over in the meantime goes to the next waiter
+            if waiter.done():
+                self.release()
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            self.report()
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.report()
+                return
+        self.running -= 1
+        self.report()
+
+"""
+Applies the budgets to the requests of the routes they cover, and answers rejected requests with 429 or 503.
+
+Routes are matched like the router does, and the matched route is put in the scope so the metrics of rejected
+requests carry it too. Clients are told apart by the user their session token was verified for, or by their address
+when the token is missing or has not been verified yet. The cookie itself is never the key, a client could send a
+new one with every request to get a fresh bucket each time.
+
+Args:
+    app: The ASGI app to wrap.
+    routes (list): The routes of the app, looked at on the first request so routes declared later are included.
+    budgets (list): The budgets.
+    verified_user (callable, optional): Called with a session token, returns the ID of the user it was verified for
+        without verifying it, or None. Defaults to None, which tells clients apart by address alone.
+"""
+class AdmissionControlMiddleware:
+    def __init__(self, app, routes, budgets, verified_user=None):
+        self.app = app
+        self.routes = routes
+        self.budgets = budgets
+        self.verified_user = verified_user
+        self.covered = None
+
+    def match(self, scope):
+        if self.covered is None:
+            self.covered = [(route, budget) for route in self.routes for budget in self.budgets if getattr(route, "path", None) in budget.paths]
+        for route, budget in self.covered:
+            if route.matches(scope)[0] == Match.FULL:
+                return route, budget
+        return None, None
+
+    def client(self, scope):
+        cookie = dict(scope["headers"]).get(b"cookie")
+        token = cookie_parser(cookie.decode("latin-1")).get("token") if cookie else None
+        user = self.verified_user(token) if token and self.verified_user else None
+        if user:
+            return f"user:{user}"
+        return scope["client"][0] if scope.get("client") else "unknown"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route, budget = self.match(scope)
+        if budget is None:
+            await self.app(scope, receive, send)
+            return
+
+        scope["route"] = route
+        start = time.perf_counter()
+        try:
+            await budget.acquire(self.client(scope))
+        except Rejected as rejection:
+            admission_rejections.inc(budget.name, rejection.reason)
+            headers = {"Retry-After": str(max(1, math.ceil(rejection.retry_after)))}
+            response = JSONResponse({"detail": "Too many requests, try again later"}, status_code=rejection.status_code, headers=headers)
+            await response(scope, receive, send)
+            return
+
+        waited = time.perf_counter() - start
+        admission_wait_duration.observe(waited, budget.name)
+        add_request_time("admission_wait", waited)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            budget.release()
+
+"""
+Creates the budgets of the expensive routes from the settings.
+
+Returns:
+    list: The budgets, none when ADMISSION_CONTROL is off.
+"""
+def default_budgets():
+    if ADMISSION_CONTROL == "off":
+        return []
+    return [
+        Budget("search", ("/search_tweets",), SEARCH_CONCURRENCY, SEARCH_QUEUE_SIZE, SEARCH_RATE, SEARCH_BURST),
+        Budget("timeline", ("/", "/feed", "/search_username"), TIMELINE_CONCURRENCY, TIMELINE_QUEUE_SIZE, TIMELINE_RATE, TIMELINE_BURST),
+    ]
@@ -0,0 +1,175 @@
+"""
+Fingerprinted and precompressed static assets.
+
+The build copies every file of static/ to static/dist/ under a name that carries the hash of its content, with gzip
+and, when the brotli package is installed, brotli variants next to it. Templates link to the fingerprinted names with
+static_url(), so the files can be cached forever: a changed file gets a new name. Run the build when deploying:
+
+    python assets.py build
+
+The app runs the same build on startup, which only writes what is missing, so the URLs always match the files.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse
+from media import IMMUTABLE_CACHE_CONTROL
+
+STATIC_DIR = "static"
+BUILD_DIR = "dist"
+MANIFEST_NAME = "manifest.json"
+
+FINGERPRINTED_NAME = re.compile(r"\.[0-9a-f]{12}\.\w+$")
+# Text formats worth compressing, images are compressed already
+COMPRESSIBLE_TYPES = frozenset([".css", ".js", ".html", ".json", ".svg", ".txt"])
+# Preferred encoding first, with the suffix of its variant
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def fingerprinted_name(name, content):
+    stem, extension = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{extension}"
+
+def write_once(path, content):
+    if os.path.exists(path):
+        return
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as output:
+        output.write(content)
+    os.replace(temporary_path, path)
+
+def compressed_variants(content):
+    variants = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+        variants['.br'] = brotli.compress(content, quality=11)
+    except ImportError:
+        pass
+    # A variant that is not smaller is not worth serving
+    return {suffix: variant for suffix, variant in variants.items() if len(variant) < len(content)}
+
+"""
+Writes the fingerprinted copy of every static file and its compressed variants, skipping those that exist.
+
+Args:
+    directory (str): The static directory.
+    prune (bool, optional): Whether to delete the outputs of earlier builds that no file maps to any more.
+
+Returns:
+    dict: The manifest, the fingerprinted name of each file keyed by its name.
+"""
+def build(directory=STATIC_DIR, prune=False):
+    build_dir = os.path.join(directory, BUILD_DIR)
+    os.makedirs(build_dir, exist_ok=True)
+
+    manifest = {}
+    outputs = {MANIFEST_NAME}
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if not entry.is_file() or entry.name.startswith("."):
+            continue
+        with open(entry.path, "rb") as source:
+            content = source.read()
+        name = manifest[entry.name] = fingerprinted_name(entry.name, content)
+        path = os.path.join(build_dir, name)
+        write_once(path, content)
+        outputs.add(name)
+
+        if os.path.splitext(entry.name)[1] in COMPRESSIBLE_TYPES:
+            if any(not os.path.exists(path + suffix) for _, suffix in ENCODINGS):
+                for suffix, variant in compressed_variants(content).items():
+                    write_once(path + suffix, variant)
+            outputs.update(name + suffix for _, suffix in ENCODINGS)
+
+    manifest_path = os.path.join(build_dir, MANIFEST_NAME)
+    temporary_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(temporary_path, manifest_path)
+
+    if prune:
+        for entry in os.scandir(build_dir):
+            if entry.name not in outputs:
+                os.remove(entry.path)
+    return manifest
+
+"""
+Maps static file names to their fingerprinted URLs, for the templates.
+
+Until load has run, and for files the build does not know, the plain URL of the file is returned.
+
+Args:
+    directory (str): The static directory.
+    mount_path (str): The path the static directory is served under.
+"""
+class StaticAssets:
+    def __init__(self, directory=STATIC_DIR, mount_path="/static"):
+        self.directory = directory
+        self.mount_path = mount_path
+        self.manifest = {}
+
+    """
+    Builds what is missing and reads the fingerprinted names. This blocks on the disk.
+    """
+    def load(self):
+        self.manifest = build(self.directory)
+
+    def url(self, name):
+        name = name.lstrip("/")
+        fingerprinted = self.manifest.get(name)
+        if fingerprinted is None:
+            return f"{self.mount_path}/{name}"
+        return f"{self.mount_path}/{BUILD_DIR}/{fingerprinted}"
+
+def accepted_encodings(accept_encoding):
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, parameters = part.strip().partition(";")
+        quality = parameters.strip()
+        if quality.startswith("q=") and quality[2:].strip() in ("0", "0.0", "0.00", "0.000"):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+"""
+StaticFiles that serves the precompressed variant of a file when the client accepts its encoding, and lets clients
+cache fingerprinted files forever. Other files are revalidated on every use.
+"""
+class PrecompressedStaticFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        full_path = os.fspath(full_path)
+        name = os.path.basename(full_path)
+        request_headers = Headers(scope=scope)
+        headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL if FINGERPRINTED_NAME.search(name) else "no-cache"}
+
+        response = None
+        if os.path.splitext(name)[1] in COMPRESSIBLE_TYPES:
+            headers["Vary"] = "Accept-Encoding"
+            accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+            for encoding, suffix in ENCODINGS:
+                if encoding in accepted and os.path.exists(full_path + suffix):
+                    response = FileResponse(full_path + suffix, status_code=status_code, headers={**headers, "Content-Encoding": encoding},
+                                            media_type=mimetypes.guess_type(name)[0], stat_result=os.stat(full_path + suffix))
+                    break
+        if response is None:
+            response = FileResponse(full_path, status_code=status_code, headers=headers, stat_result=stat_result)
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--dir", default=STATIC_DIR, help="The static directory")
+    args = parser.parse_args()
+
+    manifest = build(args.dir, prune=True)
+    print(f"Built {len(manifest)} static files into {os.path.join(args.dir, BUILD_DIR)}")
@@ -0,0 +1,121 @@
+"""
+Measures how long a fresh process takes to import the app, to answer its first request and to report ready.
+
+Each run starts a new Python process that imports main, starts the app's lifespan and sends one request straight
+into the ASGI app as soon as it starts, then polls /ready. The times are measured from the start of that process,
+so interpreter startup and every import are included. The report has the median and the worst of --runs runs:
+
+    python benchmarks/cold_start.py --runs 10 --output before.json
+    python benchmarks/cold_start.py --runs 10 --compare before.json
+
+In production the same time to first byte is exported by every worker as app_time_to_first_response_seconds on
+/metrics. Runs use the in-memory engine unless STORAGE_BACKEND is set, for example to run against the emulators.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METRICS = ('import_ms', 'startup_ms', 'first_byte_ms', 'ready_ms')
+
+
+"""
+Runs in the child process: imports the app, sends the first request and waits for readiness.
+
+Args:
+    path (str): The path of the first request.
+
+Returns:
+    dict: The milliseconds from the start of the process to each milestone.
+"""
+async def measure(path):
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(ROOT)
+
+    import httpx
+    import main as app_module
+    from metrics import process_start_time
+    from in_process import LocalTokenVerifier
+
+    def since_start():
+        return round((time.time() - process_start_time()) * 1000, 1)
+
+    timings = {'import_ms': since_start()}
+    app_module.firebase_token_verifier = LocalTokenVerifier()
+    async with app_module.app.router.lifespan_context(app_module.app):
+        timings['startup_ms'] = since_start()
+        transport = httpx.ASGITransport(app=app_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://cold-start") as client:
+            response = await client.get(path)
+            timings['first_byte_ms'] = since_start()
+            timings['status'] = response.status_code
+            while (await client.get("/ready")).status_code == 503:
+                await asyncio.sleep(0.005)
+            timings['ready_ms'] = since_start()
+    return timings
+
+def run_once(path):
+    env = {**os.environ, "STORAGE_BACKEND": os.environ.get("STORAGE_BACKEND", "memory")}
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", "--path", path],
+                            env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def regressions(report, baseline, tolerance):
+    found = []
+    for metric in METRICS:
+        now, before = report['median'].get(metric), baseline.get('median', {}).get(metric)
+        if now is not None and before is not None and now > before * (1 + tolerance):
+            found.append(f"median {metric}: {before} -> {now}")
+    return found
+
+def main(args):
+    runs = [run_once(args.path) for _ in range(args.runs)]
+    report = {
+        'path': args.path,
+        'runs': args.runs,
+        'backend': os.environ.get("STORAGE_BACKEND", "memory"),
+        'statuses': sorted({run['status'] for run in runs}),
+        'median': {metric: round(statistics.median(run[metric] for run in runs), 1) for metric in METRICS},
+        'max': {metric: max(run[metric] for run in runs) for metric in METRICS},
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            found = regressions(report, json.load(baseline_file), args.tolerance)
+        for regression in found:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", default="/", help="The path of the first request")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON report of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # Anything the app prints goes to stderr, so stdout only carries the timings
+        with contextlib.redirect_stdout(sys.stderr):
+            timings = asyncio.run(measure(args.path))
+        print(json.dumps(timings))
+    else:
+        sys.exit(main(args))
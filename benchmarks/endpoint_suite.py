@@ -0,0 +1,274 @@
+"""
+Benchmarks the main endpoints of the app in-process against the in-memory engine.
+
+A synthetic social graph is generated first (see social_graph.py), then each scenario sends --requests requests
+from --concurrency concurrent clients straight into the ASGI app, signed in as randomly picked users. Tokens are
+checked by a local stand-in for Firebase that accepts the user ID as the token.
+
+The report is JSON with the p50/p95/p99 latency, the throughput and the datastore operations per request of each
+scenario. Pass the report of an earlier run with --compare to fail when a scenario got slower or does more
+datastore operations than the tolerance allows:
+
+    python benchmarks/endpoint_suite.py --users 2000 --tweets 20000 --output before.json
+    python benchmarks/endpoint_suite.py --users 2000 --tweets 20000 --compare before.json
+
+Set --fanout-limit below the follower count of the high-follower accounts to exercise the pull path of the
+timeline on small graphs.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# The suite always runs against a fresh in-memory engine, without the rate limits that would turn its clients away
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.pop("MEMORY_BACKEND_PATH", None)
+os.environ["ADMISSION_CONTROL"] = "off"
+os.chdir(ROOT)
+
+import main as app_module
+import timeline
+from instrumented_repository import request_operations
+from pagination import encode_cursor
+from in_process import LocalTokenVerifier, app_client, signed_in
+import social_graph
+
+# 1x1 transparent PNG attached to the benchmarked tweets
+PIXEL_PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+    "0000000d49444154789c63000100000500010d0a2db40000000049454e44ae426082"
+)
+
+
+"""
+Each scenario builds the arguments of one request from the dataset and the random number generator.
+"""
+def timeline_request(dataset, rng):
+    uid, _ = rng.choice(dataset['users'])
+    return {'method': "GET", 'url': "/", 'headers': signed_in(uid)}
+
+def deep_timeline_request(dataset, rng):
+    # Starts the page at a random point of the dataset's time range, as if the user had scrolled that far
+    uid, _ = rng.choice(dataset['users'])
+    cursor = encode_cursor({'date': datetime.now() - timedelta(days=rng.uniform(0, dataset['days'])), 'id': ""})
+    return {'method': "GET", 'url': "/", 'params': {'cursor': cursor}, 'headers': signed_in(uid)}
+
+def feed_request(dataset, rng):
+    uid, _ = rng.choice(dataset['users'])
+    return {'method': "GET", 'url': "/feed", 'headers': signed_in(uid)}
+
+def profile_request(dataset, rng):
+    uid, _ = rng.choice(dataset['users'])
+    _, username = rng.choices(dataset['users'], weights=dataset['popularity'])[0]
+    return {'method': "GET", 'url': f"/profile/{username}", 'headers': signed_in(uid)}
+
+def search_request(dataset, rng):
+    uid, _ = rng.choice(dataset['users'])
+    words = " ".join(rng.sample(dataset['vocabulary'], rng.randint(1, 2)))
+    return {'method': "POST", 'url': "/search_tweets", 'headers': signed_in(uid), 'data': {'words': words}}
+
+def follow_request(dataset, rng):
+    (uid, _), (_, username) = rng.sample(dataset['users'], 2)
+    return {'method': "POST", 'url': f"/follow/{username}", 'headers': signed_in(uid)}
+
+def tweet_request(dataset, rng):
+    uid, _ = rng.choice(dataset['users'])
+    text = " ".join(rng.choices(dataset['vocabulary'], k=6))
+    return {'method': "POST", 'url': "/tweet", 'headers': signed_in(uid), 'data': {'tweet': text},
+            'files': {'image': ("benchmark.png", PIXEL_PNG, "image/png")}}
+
+SCENARIOS = {
+    'timeline': timeline_request,
+    'timeline_deep': deep_timeline_request,
+    'feed': feed_request,
+    'profile': profile_request,
+    'search_tweets': search_request,
+    'follow': follow_request,
+    'tweet': tweet_request,
+}
+
+
+def percentile(quantiles, number):
+    return round(quantiles[number - 1] * 1000, 3)
+
+"""
+Sends requests from one client until the shared budget of requests is used up.
+
+Args:
+    client (httpx.AsyncClient): The client bound to the app.
+    build_request (callable): The scenario.
+    dataset (dict): The generated social graph.
+    rng (random.Random): The random number generator of this client.
+    remaining (list): The number of requests left to send, shared by all clients.
+    samples (list): Collects the latency in seconds and the operation counter of each request.
+    errors (list): Collects the status code or exception of each failed request.
+"""
+async def client_loop(client, build_request, dataset, rng, remaining, samples, errors):
+    while remaining[0] > 0:
+        remaining[0] -= 1
+        start = time.perf_counter()
+        try:
+            response = await client.request(**build_request(dataset, rng))
+        except Exception as err:
+            errors.append(type(err).__name__)
+            continue
+        latency = time.perf_counter() - start
+        if response.status_code >= 400:
+            errors.append(response.status_code)
+        else:
+            # The app runs in this task in-process, so the counter its request scope started is still current
+            samples.append((latency, request_operations.get()))
+
+"""
+Runs one scenario and summarizes its latency, throughput and datastore operations.
+
+Args:
+    client (httpx.AsyncClient): The client bound to the app.
+    build_request (callable): The scenario.
+    dataset (dict): The generated social graph.
+    requests (int): The number of requests to measure.
+    concurrency (int): The number of concurrent clients.
+    warmup (int): The number of requests to send before measuring.
+    seed (int): The seed of the random number generators of the clients.
+
+Returns:
+    dict: The results of the scenario.
+"""
+async def run_scenario(client, build_request, dataset, requests, concurrency, warmup, seed):
+    await client_loop(client, build_request, dataset, random.Random(-1 - seed), [warmup], [], [])
+
+    remaining = [requests]
+    samples = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        client_loop(client, build_request, dataset, random.Random(seed + number), remaining, samples, errors)
+        for number in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _ in samples]
+    if len(latencies) < 2:
+        return {'requests': len(latencies), 'errors': len(errors), 'error_codes': sorted(set(map(str, errors)))}
+
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    operation_totals = {}
+    for _, operations in samples:
+        for name, count in operations.items():
+            operation_totals[name] = operation_totals.get(name, 0) + count
+
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'error_codes': sorted(set(map(str, errors))),
+        'p50_ms': percentile(quantiles, 50),
+        'p95_ms': percentile(quantiles, 95),
+        'p99_ms': percentile(quantiles, 99),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'datastore_ops_per_request': round(sum(operation_totals.values()) / len(latencies), 2),
+        'datastore_ops': {name: round(total / len(latencies), 2) for name, total in sorted(operation_totals.items())}
+    }
+
+"""
+Compares a report against the report of an earlier run.
+
+Args:
+    report (dict): The report of this run.
+    baseline (dict): The report of the earlier run.
+    tolerance (float): The allowed relative increase of p95 latency and datastore operations per request.
+
+Returns:
+    List: A description of each regression.
+"""
+def regressions(report, baseline, tolerance):
+    found = []
+    for name, results in report['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        for metric in ('p95_ms', 'datastore_ops_per_request'):
+            if metric in results and metric in previous and results[metric] > previous[metric] * (1 + tolerance):
+                found.append(f"{name} {metric}: {previous[metric]} -> {results[metric]}")
+    return found
+
+async def run_scenarios(args, dataset, report):
+    async with app_client(app_module.app) as client:
+        for name in args.scenarios:
+            report['scenarios'][name] = await run_scenario(client, SCENARIOS[name], dataset, args.requests,
+                                                           args.concurrency, args.warmup, args.seed)
+            print(f"{name}: {json.dumps(report['scenarios'][name])}", file=sys.stderr)
+
+async def main(args):
+    if args.fanout_limit is not None:
+        timeline.FANOUT_FOLLOWER_LIMIT = args.fanout_limit
+
+    start = time.perf_counter()
+    app_module.repository = app_module.create_app_repository()
+    dataset = await social_graph.generate(app_module.repository, args.users, args.tweets, args.following_per_user,
+                                          args.celebrities, args.celebrity_reach, args.exponent, args.days, args.seed)
+    generation_seconds = time.perf_counter() - start
+
+    app_module.firebase_token_verifier = LocalTokenVerifier()
+
+    report = {
+        'dataset': {
+            'users': args.users,
+            'tweets': args.tweets,
+            'follows': dataset['follows'],
+            'following_per_user': args.following_per_user,
+            'celebrities': args.celebrities,
+            'celebrity_reach': args.celebrity_reach,
+            'exponent': args.exponent,
+            'seed': args.seed,
+            'fanout_follower_limit': timeline.FANOUT_FOLLOWER_LIMIT,
+            'generation_seconds': round(generation_seconds, 2)
+        },
+        'settings': {'requests': args.requests, 'concurrency': args.concurrency, 'warmup': args.warmup},
+        'scenarios': {}
+    }
+
+    # Anything the app prints goes to stderr, so stdout only carries the report
+    with contextlib.redirect_stdout(sys.stderr):
+        await run_scenarios(args, dataset, report)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            found = regressions(report, json.load(baseline_file), args.tolerance)
+        for regression in found:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    social_graph.add_arguments(parser)
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--fanout-limit", type=int, default=None)
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON report of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,42 @@
+"""
+Helpers for benchmarks that drive the app in-process.
+"""
+import asyncio
+import contextlib
+import httpx
+
+
+"""
+Stands in for the Firebase token verifier, every token is accepted as the ID of the signed-in user.
+"""
+class LocalTokenVerifier:
+    async def verify(self, id_token):
+        return {'user_id': id_token}
+
+    def cached(self, id_token):
+        return {'user_id': id_token}
+
+    async def warm_up(self):
+        pass
+
+def signed_in(uid):
+    return {'Cookie': f"token={uid}"}
+
+"""
+Runs the startup and shutdown of an app around a client that sends requests straight into it. The client is handed
+out once the app reports it is ready, so measurements do not include the warm-up.
+
+Args:
+    app (FastAPI): The app.
+
+Yields:
+    httpx.AsyncClient: The client bound to the app.
+"""
+@contextlib.asynccontextmanager
+async def app_client(app):
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            while (await client.get("/ready")).status_code == 503:
+                await asyncio.sleep(0.01)
+            yield client
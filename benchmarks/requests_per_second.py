@@ -0,0 +1,70 @@
+"""
+Measures requests/sec of a running instance of the app.
+
+Start the app against the Firestore emulator, once on the commit before the async data layer and once after,
+and run this script with the same arguments against each:
+
+    FIRESTORE_EMULATOR_HOST=localhost:8080 uvicorn main:app --workers 1
+    python benchmarks/requests_per_second.py --url http://localhost:8000/profile/alice --concurrency 50 --duration 20
+
+A valid Firebase ID token can be passed with --token to exercise the authenticated code paths. Start the app with
+ADMISSION_CONTROL=off to measure the handlers rather than the per-user rate limits of the expensive routes.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import httpx
+
+
+"""
+Sends requests to a URL in a loop until the deadline passes.
+
+Args:
+    client (httpx.AsyncClient): The shared HTTP client.
+    url (str): The URL to request.
+    deadline (float): The perf_counter time to stop at.
+    latencies (list): Collects the latency of each successful request in seconds.
+    errors (list): Collects the status code or exception of each failed request.
+"""
+async def worker(client, url, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await client.get(url)
+        except httpx.HTTPError as err:
+            errors.append(type(err).__name__)
+            continue
+        if response.status_code >= 400:
+            errors.append(response.status_code)
+        else:
+            latencies.append(time.perf_counter() - start)
+
+async def run(url, concurrency, duration, token):
+    cookies = {"token": token} if token else None
+    limits = httpx.Limits(max_connections=concurrency)
+    latencies = []
+    errors = []
+
+    async with httpx.AsyncClient(cookies=cookies, limits=limits, timeout=30) as client:
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(worker(client, url, deadline, latencies, errors) for _ in range(concurrency)))
+
+    print(f"requests:     {len(latencies)}")
+    print(f"errors:       {len(errors)}")
+    print(f"requests/sec: {len(latencies) / duration:.1f}")
+    if latencies:
+        latencies.sort()
+        print(f"p50 latency:  {statistics.median(latencies) * 1000:.1f} ms")
+        print(f"p99 latency:  {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000/")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--token", default=None)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.url, args.concurrency, args.duration, args.token))
@@ -0,0 +1,85 @@
+"""
+Compares tweet search latency of a per-user scan with the inverted index as the number of users grows.
+
+Users are added to the configured storage backend until each size is reached, so start from an empty store,
+either the in-memory engine or the Firestore emulator:
+
+    STORAGE_BACKEND=memory python benchmarks/search_latency.py --users 100 500 2000
+    FIRESTORE_EMULATOR_HOST=localhost:8080 GOOGLE_CLOUD_PROJECT=bench python benchmarks/search_latency.py --users 100 500 2000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repository import create_repository
+import search_index
+
+WORDS = ["coffee", "python", "release", "weekend", "football", "music", "deploy", "rain", "launch", "pizza", "travel", "bug"]
+
+
+"""
+The search as it was before the index: one query against the tweets of every user, keeping the tweets that start
+with the search words.
+"""
+async def scan_search(repository, words, tweets_per_user):
+    tweets_found = []
+    async for uid, _ in repository.iter_usernames():
+        tweets = await repository.latest_tweets(uid, tweets_per_user)
+        tweets_found.extend(tweet for tweet in tweets if tweet['name'].startswith(words))
+    return tweets_found
+
+async def seed(repository, first_user, last_user, tweets_per_user):
+    now = datetime.now()
+    for user_number in range(first_user, last_user):
+        uid = f"bench-user-{user_number}"
+        await repository.create_user(uid, {'username': uid})
+        for _ in range(tweets_per_user):
+            tweet_data = {
+                'name': " ".join(random.sample(WORDS, 4)),
+                'username': uid,
+                'date': now - timedelta(minutes=random.randint(0, 60 * 24 * 30)),
+                'image_url': ''
+            }
+            tweet_id = await repository.add_tweet(uid, tweet_data)
+            await search_index.index_tweet(repository, uid, tweet_id, tweet_data)
+
+async def measure(search, queries):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        await search(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return statistics.median(latencies)
+
+async def main(user_counts, tweets_per_user, repeat):
+    repository = create_repository()
+    queries = [random.choice(WORDS) for _ in range(repeat)]
+
+    print(f"{'users':>8} {'scan p50 ms':>12} {'index p50 ms':>13}")
+    seeded = 0
+    for user_count in sorted(user_counts):
+        await seed(repository, seeded, user_count, tweets_per_user)
+        seeded = user_count
+
+        scan = await measure(lambda words: scan_search(repository, words, tweets_per_user), queries)
+        index = await measure(lambda words: search_index.search(repository, words), queries)
+        print(f"{user_count:>8} {scan:>12.2f} {index:>13.2f}")
+
+    await repository.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 500, 2000])
+    parser.add_argument("--tweets-per-user", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.users, args.tweets_per_user, args.repeat))
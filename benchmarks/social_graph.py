@@ -0,0 +1,157 @@
+"""
+Generates a synthetic social graph and loads it into a storage backend.
+
+Follows are drawn from a power-law popularity distribution, so most users have a few followers and a few have a
+lot, and the first --celebrities users are additionally followed by a --celebrity-reach share of everyone. Tweets
+are spread over the last --days days, written mostly by the most active users, and use a vocabulary with a Zipf
+word distribution so search terms range from very common to rare.
+
+The generator is used by the endpoint suite and can also seed a backend on its own:
+
+    STORAGE_BACKEND=memory MEMORY_BACKEND_PATH=/tmp/graph.pickle python benchmarks/social_graph.py --users 2000 --tweets 20000
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repository import create_repository
+import search_index
+import timeline
+
+VOCABULARY = [
+    "coffee", "python", "release", "weekend", "football", "music", "deploy", "rain", "launch", "pizza", "travel",
+    "bug", "morning", "concert", "coding", "holiday", "train", "garden", "movie", "review", "startup", "recipe",
+    "marathon", "podcast", "sunset", "library", "election", "museum", "festival", "keyboard", "database", "cloud",
+    "winter", "summer", "beach", "mountain", "birthday", "interview", "conference", "tutorial", "benchmark",
+    "latency", "cache", "index", "timeline", "follow", "photo", "camera", "bicycle", "chess"
+]
+
+
+def power_law_weights(count, exponent):
+    return [1 / (rank + 1) ** exponent for rank in range(count)]
+
+"""
+Draws the accounts a user follows from the popularity distribution.
+
+Args:
+    rng (random.Random): The random number generator.
+    follower (int): The number of the following user.
+    cumulative_weights (list): The cumulative popularity weights of all users.
+    count (int): The number of accounts to follow.
+
+Returns:
+    set: The numbers of the followed users.
+"""
+def draw_followees(rng, follower, cumulative_weights, count):
+    population = range(len(cumulative_weights))
+    followees = set()
+    # Popular accounts get drawn repeatedly, give up after a bounded number of draws
+    for _ in range(count * 4):
+        followees.update(rng.choices(population, cum_weights=cumulative_weights, k=count - len(followees)))
+        followees.discard(follower)
+        if len(followees) >= count:
+            break
+    return followees
+
+"""
+Generates a social graph and writes it to the storage backend through the same code paths the app uses.
+
+Args:
+    repository (Repository): The storage backend, expected to be empty.
+    users (int): The number of users.
+    tweets (int): The total number of tweets.
+    following_per_user (int): The mean number of accounts each user follows.
+    celebrities (int): The number of high-follower accounts.
+    celebrity_reach (float): The share of all users that follow each high-follower account.
+    exponent (float): The exponent of the power-law popularity and activity distributions.
+    days (int): The number of days the tweets are spread over.
+    seed (int): The seed of the random number generator, the same seed produces the same graph.
+
+Returns:
+    dict: The generated users as (uid, username) pairs, the usernames of the high-follower accounts, the
+    popularity weight of each user, the vocabulary and the number of follows.
+"""
+async def generate(repository, users=1000, tweets=10000, following_per_user=20, celebrities=5, celebrity_reach=0.5,
+                   exponent=1.1, days=30, seed=0):
+    rng = random.Random(seed)
+    accounts = [(f"bench-{number}", f"member{number}") for number in range(users)]
+
+    for uid, username in accounts:
+        # A new account has no tweets to show, so its timeline starts out materialized
+        await repository.create_user(uid, {'username': username, 'timeline_materialized': True})
+
+    popularity = power_law_weights(users, exponent)
+    cumulative_popularity = list(itertools.accumulate(popularity))
+    follows = 0
+    for follower, (uid, username) in enumerate(accounts):
+        count = min(users - 1, rng.randint(1, 2 * following_per_user))
+        followees = draw_followees(rng, follower, cumulative_popularity, count)
+        followees.update(number for number in range(min(celebrities, users)) if number != follower and rng.random() < celebrity_reach)
+
+        user = {'id': uid, 'username': username}
+        for followee in followees:
+            target_uid, target_username = accounts[followee]
+            follows += await repository.follow(user, {'id': target_uid, 'username': target_username})
+
+    # Activity follows a power law as well, over an ordering independent of popularity
+    activity = power_law_weights(users, exponent)
+    rng.shuffle(activity)
+    authors = rng.choices(range(users), weights=activity, k=tweets)
+    cumulative_words = list(itertools.accumulate(power_law_weights(len(VOCABULARY), 1.0)))
+    now = datetime.now()
+
+    for author in sorted(authors):
+        uid, username = accounts[author]
+        tweet_data = {
+            'name': " ".join(rng.choices(VOCABULARY, cum_weights=cumulative_words, k=rng.randint(3, 10))),
+            'username': username,
+            'date': now - timedelta(seconds=rng.randint(0, days * 24 * 60 * 60)),
+            'image_url': ''
+        }
+        tweet_id = await repository.add_tweet(uid, tweet_data)
+        author_doc = await repository.get_user(uid)
+        await asyncio.gather(
+            timeline.fan_out_tweet(repository, author_doc, tweet_id, tweet_data),
+            search_index.index_tweet(repository, uid, tweet_id, tweet_data)
+        )
+
+    return {
+        'users': accounts,
+        'celebrities': [username for _, username in accounts[:celebrities]],
+        'popularity': popularity,
+        'vocabulary': VOCABULARY,
+        'days': days,
+        'follows': follows
+    }
+
+async def main(args):
+    repository = create_repository()
+    try:
+        dataset = await generate(repository, args.users, args.tweets, args.following_per_user, args.celebrities,
+                                 args.celebrity_reach, args.exponent, args.days, args.seed)
+    finally:
+        await repository.close()
+    print(json.dumps({'users': len(dataset['users']), 'tweets': args.tweets, 'follows': dataset['follows'], 'celebrities': dataset['celebrities']}))
+
+def add_arguments(parser):
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--tweets", type=int, default=10000)
+    parser.add_argument("--following-per-user", type=int, default=20)
+    parser.add_argument("--celebrities", type=int, default=5)
+    parser.add_argument("--celebrity-reach", type=float, default=0.5)
+    parser.add_argument("--exponent", type=float, default=1.1)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,185 @@
+"""
+Compares the home timeline page rendered in full before it is sent with the same page streamed while it renders.
+
+A synthetic social graph is generated first (see social_graph.py) on the in-memory engine, which then answers every
+call after --latency-ms, like a remote datastore would. The --readers users that follow the most accounts, and so
+have the largest timelines, each request their timeline page one request at a time, signed in through a local
+stand-in for Firebase, with the page compressed as a browser would ask for it.
+
+The report is JSON with, per mode, the time to the first byte of the body and to its last byte, the bytes sent, and
+the peak memory allocated while a request ran as traced by tracemalloc. Memory is measured in a pass of its own,
+since tracing slows down everything else:
+
+    python benchmarks/streamed_pages.py --users 2000 --tweets 20000 --latency-ms 20
+    python benchmarks/streamed_pages.py --users 2000 --tweets 20000 --page-size 100 --fanout-limit 200
+"""
+import argparse
+import asyncio
+import contextlib
+import inspect
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# A fresh in-memory engine, without the rate limits that would turn the readers away
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.pop("MEMORY_BACKEND_PATH", None)
+os.environ["ADMISSION_CONTROL"] = "off"
+os.chdir(ROOT)
+
+import main as app_module
+import timeline
+from instrumented_repository import InstrumentedRepository
+from repository import create_repository
+from in_process import LocalTokenVerifier, app_client, signed_in
+import social_graph
+
+MODES = ("buffered", "streamed")
+
+
+"""
+Delays every call of a storage backend, to stand in for the round trip to a remote datastore.
+
+Args:
+    repository (Repository): The storage backend.
+    latency (float): The seconds each call waits first.
+"""
+class SlowRepository:
+    def __init__(self, repository, latency):
+        self.repository = repository
+        self.latency = latency
+
+    def __getattr__(self, name):
+        method = getattr(self.repository, name)
+        if not inspect.iscoroutinefunction(method):
+            return method
+
+        async def delayed(*args, **kwargs):
+            await asyncio.sleep(self.latency)
+            return await method(*args, **kwargs)
+        return delayed
+
+"""
+Sends one GET request straight into the ASGI app and times the body as it arrives.
+
+Returns:
+    tuple: The seconds to the first non-empty part of the body and to the end of it, and the bytes of the body.
+"""
+async def timed_get(app, path, headers):
+    scope = {
+        'type': "http", 'asgi': {'version': "3.0"}, 'http_version': "1.1", 'method': "GET", 'scheme': "http",
+        'path': path, 'raw_path': path.encode(), 'query_string': b"", 'root_path': "",
+        'headers': [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        'client': ("127.0.0.1", 0), 'server': ("benchmark", 80)
+    }
+    done = asyncio.Event()
+    received = []
+
+    async def receive():
+        if not received:
+            received.append(True)
+            return {'type': "http.request", 'body': b"", 'more_body': False}
+        await done.wait()
+        return {'type': "http.disconnect"}
+
+    first_byte = None
+    size = 0
+
+    async def send(message):
+        nonlocal first_byte, size
+        if message['type'] == "http.response.start" and message['status'] != 200:
+            raise RuntimeError(f"GET {path} answered {message['status']}")
+        if message['type'] == "http.response.body":
+            body = message.get('body', b"")
+            if body and first_byte is None:
+                first_byte = time.perf_counter() - start
+            size += len(body)
+            if not message.get('more_body', False):
+                done.set()
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    return first_byte, time.perf_counter() - start, size
+
+async def measure(readers, encoding):
+    headers = {'Accept-Encoding': encoding}
+    first_bytes, totals, sizes = [], [], []
+    for uid in readers:
+        first_byte, total, size = await timed_get(app_module.app, "/", {**headers, **signed_in(uid)})
+        first_bytes.append(first_byte)
+        totals.append(total)
+        sizes.append(size)
+
+    tracemalloc.start()
+    peaks = []
+    try:
+        for uid in readers:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            await timed_get(app_module.app, "/", {**headers, **signed_in(uid)})
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'ttfb_p50_ms': round(statistics.median(first_bytes) * 1000, 2),
+        'ttfb_max_ms': round(max(first_bytes) * 1000, 2),
+        'total_p50_ms': round(statistics.median(totals) * 1000, 2),
+        'total_max_ms': round(max(totals) * 1000, 2),
+        'body_bytes_p50': int(statistics.median(sizes)),
+        'peak_memory_p50_kb': round(statistics.median(peaks) / 1024, 1),
+        'peak_memory_max_kb': round(max(peaks) / 1024, 1)
+    }
+
+async def main(args):
+    if args.fanout_limit is not None:
+        timeline.FANOUT_FOLLOWER_LIMIT = args.fanout_limit
+    app_module.TIMELINE_LENGTH = args.page_size
+
+    backend = create_repository()
+    dataset = await social_graph.generate(backend, args.users, args.tweets, args.following_per_user, args.celebrities,
+                                          args.celebrity_reach, args.exponent, args.days, args.seed)
+    following = {uid: len(await backend.following_ids(uid)) for uid, _ in dataset['users']}
+    readers = sorted(following, key=following.get, reverse=True)[:args.readers]
+
+    app_module.repository = InstrumentedRepository(SlowRepository(backend, args.latency_ms / 1000), observe=app_module.observe_repository_call)
+    app_module.firebase_token_verifier = LocalTokenVerifier()
+
+    report = {
+        'dataset': {'users': args.users, 'tweets': args.tweets, 'follows': dataset['follows'],
+                    'readers_following_p50': statistics.median(following[uid] for uid in readers)},
+        'settings': {'readers': args.readers, 'page_size': args.page_size, 'latency_ms': args.latency_ms,
+                     'encoding': args.encoding, 'fanout_follower_limit': timeline.FANOUT_FOLLOWER_LIMIT},
+        'modes': {}
+    }
+    # Anything the app prints goes to stderr, so stdout only carries the report
+    with contextlib.redirect_stdout(sys.stderr):
+        async with app_client(app_module.app):
+            # Untimed pass, so the first mode does not pay for filling caches
+            await measure(readers[:1], args.encoding)
+            for mode in MODES:
+                app_module.page_templates.stream = mode == "streamed"
+                report['modes'][mode] = await measure(readers, args.encoding)
+                print(f"{mode}: {json.dumps(report['modes'][mode])}", file=sys.stderr)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    social_graph.add_arguments(parser)
+    parser.add_argument("--readers", type=int, default=20, help="Users whose timeline page is requested")
+    parser.add_argument("--page-size", type=int, default=app_module.TIMELINE_LENGTH, help="Tweets per timeline page")
+    parser.add_argument("--latency-ms", type=float, default=10, help="Delay of every storage backend call")
+    parser.add_argument("--encoding", default="gzip", help="The Accept-Encoding of the requests")
+    parser.add_argument("--fanout-limit", type=int, default=None)
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
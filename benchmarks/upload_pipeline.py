@@ -0,0 +1,134 @@
+"""
+Measures latency and peak memory of many concurrent image uploads through POST /tweet, in-process.
+
+Each upload streams a --size-mb PNG from disk into the app, so the client side adds little to the memory of the
+process. The uploads cycle through --distinct different images, so all but the first upload of each image are
+skipped by the content-addressed media store. The in-memory engine keeps every blob it receives, which puts the
+stored images on top of its peak; to see the upload pipeline on its own, run against the Cloud Storage emulator
+instead, for example fake-gcs-server:
+
+    python benchmarks/upload_pipeline.py --uploads 50 --concurrency 25 --size-mb 5
+    STORAGE_BACKEND=firestore STORAGE_EMULATOR_HOST=http://localhost:4443 FIRESTORE_EMULATOR_HOST=localhost:8080 \\
+        python benchmarks/upload_pipeline.py --uploads 50 --concurrency 25 --size-mb 5
+
+The latencies are those of the requests, which return once the image is staged. The images are resized and stored
+by background jobs afterwards, the throughput counts until the last of them is done. The report is JSON, requests
+over MAX_UPLOAD_SIZE are expected to be rejected with 413.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.chdir(ROOT)
+
+import main as app_module
+from in_process import LocalTokenVerifier, app_client, signed_in
+
+USER_ID = "upload-bench"
+
+
+def current_rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def write_image(directory, number, size):
+    # Random pixels barely compress, so the PNG ends up close to the requested size
+    side = int((size / 3) ** 0.5)
+    path = os.path.join(directory, f"upload-{number}.png")
+    Image.frombytes("RGB", (side, side), os.urandom(side * side * 3)).save(path, "PNG", compress_level=1)
+    return path
+
+"""
+Uploads the image repeatedly from one client until the shared budget of uploads is used up.
+
+Args:
+    client (httpx.AsyncClient): The client bound to the app.
+    paths (list): The paths of the images to cycle through.
+    remaining (list): The number of uploads left, shared by all clients.
+    latencies (list): Collects the latency of each successful upload in seconds.
+    errors (list): Collects the status code or exception of each failed upload.
+"""
+async def uploader(client, paths, remaining, latencies, errors):
+    while remaining[0] > 0:
+        remaining[0] -= 1
+        path = paths[remaining[0] % len(paths)]
+        start = time.perf_counter()
+        with open(path, "rb") as image:
+            try:
+                response = await client.post("/tweet", headers=signed_in(USER_ID), data={'tweet': "upload benchmark"},
+                                             files={'image': ("upload.png", image, "image/png")})
+            except Exception as err:
+                errors.append(type(err).__name__)
+                continue
+        if response.status_code >= 400:
+            errors.append(response.status_code)
+        else:
+            latencies.append(time.perf_counter() - start)
+
+async def main(args):
+    app_module.firebase_token_verifier = LocalTokenVerifier()
+    app_module.repository = app_module.create_app_repository()
+    await app_module.repository.create_user(USER_ID, {'username': USER_ID, 'timeline_materialized': True})
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [write_image(directory, number, int(args.size_mb * 2 ** 20)) for number in range(args.distinct)]
+
+        async with app_client(app_module.app) as client:
+            baseline_rss = current_rss_mb()
+            remaining = [args.uploads]
+            latencies = []
+            errors = []
+            start = time.perf_counter()
+            await asyncio.gather(*(uploader(client, paths, remaining, latencies, errors) for _ in range(args.concurrency)))
+            await app_module.job_queue.join()
+            elapsed = time.perf_counter() - start
+
+    report = {
+        'backend': os.environ["STORAGE_BACKEND"],
+        'uploads': args.uploads,
+        'concurrency': args.concurrency,
+        'size_mb': args.size_mb,
+        'distinct_images': args.distinct,
+        'succeeded': len(latencies),
+        'errors': len(errors),
+        'error_codes': sorted(set(map(str, errors))),
+        'uploaded_mb': round(len(latencies) * args.size_mb, 1),
+        'throughput_mb_per_s': round(len(latencies) * args.size_mb / elapsed, 1),
+        'baseline_rss_mb': round(baseline_rss, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+    if len(latencies) >= 2:
+        quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        report.update({
+            'p50_ms': round(quantiles[49] * 1000, 1),
+            'p95_ms': round(quantiles[94] * 1000, 1),
+            'p99_ms': round(quantiles[98] * 1000, 1),
+        })
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=25)
+    parser.add_argument("--size-mb", type=float, default=5)
+    parser.add_argument("--distinct", type=int, default=10)
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,50 @@
+"""
+Reports the memory footprint and lookup latency of the in-memory username index for a given number of users.
+
+    python benchmarks/username_index_footprint.py --users 10000 100000 1000000
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from username_index import UsernameIndex
+
+
+def random_username():
+    return "".join(random.choices(string.ascii_lowercase + string.digits, k=random.randint(5, 15)))
+
+def time_per_call(func, args, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for arg in args:
+            func(arg)
+    return (time.perf_counter() - start) / (repeat * len(args)) * 1_000_000
+
+def main(user_counts, repeat):
+    print(f"{'users':>10} {'memory MB':>10} {'bytes/user':>11} {'prefix us':>10} {'resolve us':>11}")
+    for user_count in user_counts:
+        index = UsernameIndex()
+        for user_number in range(user_count):
+            index.add(random_username(), f"{user_number:028d}")
+
+        sample = random.sample(index.usernames, min(1000, user_count))
+        prefixes = [username[:2] for username in sample]
+        footprint = index.memory_footprint()
+
+        prefix_us = time_per_call(lambda prefix: index.search_prefix(prefix, 10), prefixes, repeat)
+        resolve_us = time_per_call(index.resolve, sample, repeat)
+        print(f"{user_count:>10} {footprint / 1024 / 1024:>10.1f} {footprint / user_count:>11.0f} {prefix_us:>10.2f} {resolve_us:>11.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    main(args.users, args.repeat)
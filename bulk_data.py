@@ -0,0 +1,285 @@
+"""
+Exports the users, tweets and follow graph to a newline-delimited JSON file, and imports such a file back.
+
+Each line is one record, {"type": "user" | "tweet" | "follow", "data": {...}}, with dates as ISO 8601 strings.
+Materialized timelines and the search index are derived data and are not exported: timelines are rebuilt the next
+time each user reads theirs, and the index with `python search_index.py rebuild` after an import. Blobs such as
+tweet images stay in their bucket.
+
+    python bulk_data.py export dump.ndjson --checkpoint export.checkpoint
+    python bulk_data.py import dump.ndjson --checkpoint import.checkpoint --writers 8
+
+Both commands stream, so memory use does not grow with the size of the data. With --checkpoint an interrupted run
+picks up where it stopped when started again with the same arguments.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from constants import MAX_BATCH_SIZE
+from repository import create_repository
+
+# Users read per page on export, with all of their tweets and follow edges
+EXPORT_PAGE_SIZE = 100
+# Seconds between two progress lines
+PROGRESS_INTERVAL = 5
+
+RECORD_TYPES = ("user", "tweet", "follow")
+# Flags on user documents that describe derived data, which is not there after an import
+DERIVED_USER_FIELDS = ("timeline_materialized",)
+
+
+def encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot export a {type(value).__name__}")
+
+def parse_date(data):
+    if isinstance(data.get('date'), str):
+        data['date'] = datetime.fromisoformat(data['date'])
+    return data
+
+def read_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+"""
+Replaces the checkpoint in one step, so a crash leaves either the previous or the new checkpoint behind.
+"""
+def write_checkpoint(path, checkpoint):
+    if not path:
+        return
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(temporary_path, path)
+
+"""
+Prints the number of documents handled and the rate to stderr, at most every PROGRESS_INTERVAL seconds.
+
+Args:
+    action (str): What is done with the documents, such as "Exported".
+    documents (int, optional): The documents handled by an earlier run. Defaults to 0.
+"""
+class Progress:
+    def __init__(self, action, documents=0):
+        self.action = action
+        self.documents = documents
+        self.start_documents = documents
+        self.start = time.monotonic()
+        self.reported = self.start
+
+    def add(self, documents):
+        self.documents += documents
+        now = time.monotonic()
+        if now - self.reported >= PROGRESS_INTERVAL:
+            self.reported = now
+            print(f"{self.action} {self.documents} documents, {self.rate():.0f}/s", file=sys.stderr)
+
+    def rate(self):
+        return (self.documents - self.start_documents) / max(time.monotonic() - self.start, 1e-9)
+
+# Export
+
+"""
+Reads the tweets and the followed users of one user, page by page.
+
+Args:
+    repository (Repository): The storage backend.
+    user (dict): The user.
+    page_size (int): The documents read per call.
+
+Yields:
+    list: The user's record, then the records of each page of its tweets and follow edges as soon as it is read.
+"""
+async def user_records(repository, user, page_size):
+    yield [{'type': "user", 'data': user}]
+
+    tweets = await repository.tweets_page(user['id'], page_size)
+    while tweets:
+        yield [{'type': "tweet", 'data': tweet} for tweet in tweets]
+        tweets = await repository.tweets_page(user['id'], page_size, tweets[-1]['id']) if len(tweets) == page_size else []
+
+    source = {'id': user['id'], 'username': user.get('username')}
+    edges = await repository.following_page(user['id'], page_size)
+    while edges:
+        yield [{'type': "follow", 'data': {
+            'user': source,
+            'target': {'id': edge['uid'], 'username': edge['username']},
+            'date': edge['date']
+        }} for edge in edges]
+        edges = await repository.following_page(user['id'], page_size, edges[-1]['uid']) if len(edges) == page_size else []
+
+"""
+Writes every user, tweet and follow edge to a file, one page of users at a time.
+
+The users of a page are read one after another and each page of documents is written as soon as it is read, so
+at most one page of documents is held in memory however many tweets and follows a user has. After each page of
+users the file is synced to disk and the checkpoint records the last user written and the length of the file, so
+a resumed export cuts off anything written after it.
+
+Args:
+    repository (Repository): The storage backend.
+    path (str): The file to write.
+    checkpoint_path (str, optional): Where to keep the checkpoint. Defaults to None for no checkpoint.
+    page_size (int, optional): The users, and the documents of a user, read per call. Defaults to EXPORT_PAGE_SIZE.
+
+Returns:
+    int: The number of documents in the file.
+"""
+async def export(repository, path, checkpoint_path=None, page_size=EXPORT_PAGE_SIZE):
+    checkpoint = read_checkpoint(checkpoint_path) or {'after': None, 'offset': 0, 'documents': 0}
+    progress = Progress("Exported", checkpoint['documents'])
+
+    with open(path, "r+b" if checkpoint['offset'] and os.path.exists(path) else "wb") as output:
+        output.truncate(checkpoint['offset'])
+        output.seek(checkpoint['offset'])
+
+        after = checkpoint['after']
+        while True:
+            users = await repository.users_page(page_size, after)
+            if not users:
+                break
+            for user in users:
+                async for records in user_records(repository, user, page_size):
+                    output.writelines(json.dumps(record, default=encode).encode() + b"\n" for record in records)
+                    progress.add(len(records))
+
+            output.flush()
+            os.fsync(output.fileno())
+            after = users[-1]['id']
+            write_checkpoint(checkpoint_path, {'after': after, 'offset': output.tell(), 'documents': progress.documents})
+            if len(users) < page_size:
+                break
+
+    print(f"Exported {progress.documents} documents, {progress.rate():.0f}/s", file=sys.stderr)
+    return progress.documents
+
+# Import
+
+"""
+Writes one batch of records, grouped by type so each type is written in as few commits as possible.
+"""
+async def write_records(repository, records):
+    users, tweets, edges = [], [], []
+    for record in records:
+        data = record['data']
+        if record['type'] == "user":
+            users.append({key: value for key, value in data.items() if key not in DERIVED_USER_FIELDS})
+        elif record['type'] == "tweet":
+            tweets.append(parse_date(data))
+        else:
+            edges.append((data['user'], data['target'], parse_date(data)['date']))
+
+    await asyncio.gather(repository.put_users(users), repository.put_tweets(tweets), repository.put_follow_edges(edges))
+
+"""
+Reads the file from the given offset in batches of records.
+
+Yields:
+    tuple: The records of a batch and the offset just past its last line.
+"""
+def read_batches(path, offset, batch_size):
+    with open(path, "rb") as source:
+        source.seek(offset)
+        records = []
+        for line in source:
+            offset += len(line)
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get('type') not in RECORD_TYPES:
+                raise ValueError(f"Unknown record type {record.get('type')!r} before offset {offset} of {path}")
+            records.append(record)
+            if len(records) == batch_size:
+                yield records, offset
+                records = []
+        if records:
+            yield records, offset
+
+"""
+Loads a file written by export into the storage backend, overwriting documents with the same IDs.
+
+The file is read in batches that a pool of writers commit concurrently, with a bounded queue between them so
+reading never runs far ahead of writing. Batches can finish out of order, so the checkpoint only moves past a
+batch once every batch before it is written too. A resumed import writes again the batches that were in flight,
+which is harmless because every write sets a whole document.
+
+Args:
+    repository (Repository): The storage backend.
+    path (str): The file to read.
+    checkpoint_path (str, optional): Where to keep the checkpoint. Defaults to None for no checkpoint.
+    writers (int, optional): The batches written at once. Defaults to 4.
+    batch_size (int, optional): The records per batch. Defaults to MAX_BATCH_SIZE.
+
+Returns:
+    int: The number of documents imported.
+"""
+async def import_(repository, path, checkpoint_path=None, writers=4, batch_size=MAX_BATCH_SIZE):
+    checkpoint = read_checkpoint(checkpoint_path) or {'offset': 0, 'documents': 0}
+    progress = Progress("Imported", checkpoint['documents'])
+    queue = asyncio.Queue(maxsize=writers * 2)
+    # Batch number -> (offset past it, records) for the written batches the checkpoint has not moved past yet
+    written = {}
+    next_batch = [0]
+
+    def batch_written(number, offset, count):
+        written[number] = (offset, count)
+        progress.add(count)
+        committed = None
+        while next_batch[0] in written:
+            committed, count = written.pop(next_batch[0])
+            checkpoint['documents'] += count
+            next_batch[0] += 1
+        if committed is not None:
+            checkpoint['offset'] = committed
+            write_checkpoint(checkpoint_path, checkpoint)
+
+    async def write():
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                return
+            number, records, offset = batch
+            await write_records(repository, records)
+            batch_written(number, offset, len(records))
+
+    async def read():
+        for number, (records, offset) in enumerate(read_batches(path, checkpoint['offset'], batch_size)):
+            await queue.put((number, records, offset))
+        for _ in range(writers):
+            await queue.put(None)
+
+    await asyncio.gather(read(), *(write() for _ in range(writers)))
+
+    print(f"Imported {progress.documents} documents, {progress.rate():.0f}/s", file=sys.stderr)
+    return progress.documents
+
+async def main(args):
+    repository = create_repository()
+    try:
+        if args.command == "export":
+            await export(repository, args.file, args.checkpoint, args.page_size)
+        elif args.command == "import":
+            await import_(repository, args.file, args.checkpoint, args.writers, args.batch_size)
+            print("Run `python search_index.py rebuild` to index the imported tweets")
+    finally:
+        await repository.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("file", help="The newline-delimited JSON file")
+    parser.add_argument("--checkpoint", help="File that records the progress, to resume an interrupted run")
+    parser.add_argument("--page-size", type=int, default=EXPORT_PAGE_SIZE, help="Users read per page on export")
+    parser.add_argument("--writers", type=int, default=4, help="Batches written at once on import")
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE, help="Records per batch on import")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,138 @@
+"""
+Compression of the text responses of the app, streamed ones included.
+
+Starlette's GZipMiddleware holds back the output of its compressor until it has a full block, which keeps the
+first parts of a streamed page from reaching the browser. Here every part of a response is flushed through the
+compressor as soon as it is sent, so a streamed page arrives compressed just as early as it would uncompressed.
+"""
+import os
+import zlib
+from starlette.datastructures import Headers, MutableHeaders
+from assets import accepted_encodings
+
+# Responses smaller than this are sent uncompressed, unless they are streamed
+COMPRESSION_MINIMUM_SIZE = int(os.environ.get("COMPRESSION_MINIMUM_SIZE", "500"))
+# Compression levels, balanced against the time spent on every response
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "4"))
+
+COMPRESSIBLE_MEDIA_TYPES = frozenset([
+    "text/html", "text/plain", "text/css", "text/javascript", "application/javascript", "application/json",
+    "image/svg+xml",
+])
+# Statuses whose body is not the whole resource, or empty
+UNCOMPRESSED_STATUSES = frozenset([204, 206, 304])
+
+
+class GzipCompressor:
+    encoding = "gzip"
+
+    def __init__(self):
+        # wbits 31 writes the gzip header and trailer around the deflate stream
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data):
+        return self.compressor.compress(data) + self.compressor.flush()
+
+class BrotliCompressor:
+    encoding = "br"
+
+    def __init__(self, brotli):
+        self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self, data):
+        return self.compressor.process(data) + self.compressor.finish()
+
+"""
+Picks the compressor for a request, brotli when the client accepts it and the brotli package is installed.
+
+Returns:
+    The compressor, or None when the client accepts neither encoding.
+"""
+def create_compressor(accept_encoding):
+    accepted = accepted_encodings(accept_encoding)
+    if "br" in accepted:
+        try:
+            import brotli
+            return BrotliCompressor(brotli)
+        except ImportError:
+            pass
+    if "gzip" in accepted:
+        return GzipCompressor()
+    return None
+
+"""
+Compresses the text responses of the app with the best encoding the client accepts.
+
+Responses that are encoded already, such as precompressed static files, and types that do not compress, such as
+images, pass through untouched. So do server-sent events, which are flushed event by event and kept open.
+
+Args:
+    app: The ASGI app to wrap.
+    minimum_size (int, optional): The smallest response body compressed. Defaults to COMPRESSION_MINIMUM_SIZE.
+"""
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        compressor = create_compressor(Headers(scope=scope).get("accept-encoding", ""))
+        if compressor is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                # Held back until the first part of the body shows whether it is compressed
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                if not self.is_compressible(start) or (not more_body and len(body) < self.minimum_size):
+                    compressor = None
+                if compressor is not None:
+                    body = compressor.compress(body) if more_body else compressor.finish(body)
+                    self.set_headers(MutableHeaders(raw=start["headers"]), compressor, None if more_body else len(body))
+                await send(start)
+                start = None
+            elif compressor is not None:
+                body = compressor.compress(body) if more_body else compressor.finish(body)
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_compressed)
+
+    def is_compressible(self, message):
+        if message["status"] in UNCOMPRESSED_STATUSES:
+            return False
+        headers = Headers(raw=message["headers"])
+        media_type = headers.get("content-type", "").partition(";")[0].strip().lower()
+        return "content-encoding" not in headers and media_type in COMPRESSIBLE_MEDIA_TYPES
+
+    def set_headers(self, headers, compressor, content_length):
+        headers["Content-Encoding"] = compressor.encoding
+        headers.add_vary_header("Accept-Encoding")
+        if content_length is None:
+            del headers["Content-Length"]
+        else:
+            headers["Content-Length"] = str(content_length)
+        if "etag" in headers and not headers["etag"].startswith("W/"):
+            # The compressed body is another representation of the resource
+            headers["ETag"] = "W/" + headers["etag"]
@@ -0,0 +1,63 @@
+# Firestore collections
+USER_COLLECTION = "User"
+TWEET_COLLECTION = 'Tweet'
+TIMELINE_COLLECTION = 'Timeline'
+# Follow edges, stored under both users
+FOLLOWERS_COLLECTION = 'Followers'
+FOLLOWING_COLLECTION = 'Following'
+# Username reservations, keyed by username and holding the uid of the user that claimed it
+USERNAME_COLLECTION = 'Username'
+
+# Templates
+MAIN_TEMPLATE = "main.html"
+UPDATE_PROFILE_TEMPLATE = "update_profile.html"
+USER_INFORMATION_TEMPLATE = "user_information.html"
+
+# Tweets
+MAX_TWEET_LENGTH = 140
+
+# Timelines
+TIMELINE_LENGTH = 20
+PROFILE_PAGE_SIZE = 10
+MAX_FEED_PAGE_SIZE = 100
+# Authors with more followers than this are not fanned out on write, their tweets are pulled on read instead
+FANOUT_FOLLOWER_LIMIT = 5000
+# Those authors are only fanned out on write again once their followers drop to this share of the limit, so an
+# author around the limit does not switch back and forth
+FANOUT_DEMOTION_RATIO = 0.9
+# Seconds a worker reuses the list of those authors before reading it again
+CELEBRITY_CACHE_SECONDS = 60
+
+# Firestore limits
+MAX_BATCH_SIZE = 500
+# Documents read by one batched get
+MAX_BATCH_GET_SIZE = 100
+
+# Search
+SEARCH_INDEX_COLLECTION = 'SearchIndex'
+POSTINGS_COLLECTION = 'Postings'
+# The terms each tweet is indexed under, keyed by tweet ID
+INDEXED_TERMS_COLLECTION = 'IndexedTerms'
+SEARCH_RESULT_LIMIT = 20
+SEARCH_PAGE_SIZE = 200
+# Longer words are indexed and searched by their first this many characters, terms are document IDs
+MAX_TERM_LENGTH = 100
+
+# Usernames are Firestore document IDs, so they are kept to letters, digits and underscores. Names wrapped in double
+# underscores are reserved by Firestore.
+USERNAME_PATTERN = r"(?!__.*__\Z)\w{1,30}"
+
+# Username autocomplete
+AUTOCOMPLETE_LIMIT = 10
+MAX_AUTOCOMPLETE_LIMIT = 50
+
+# Image uploads
+# The largest accepted multipart request body, the image together with the other form fields
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+# Resumable uploads are sent in chunks of this size, it must be a multiple of 256 KB
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Images are also stored resized to fit these squares, for the timelines
+FEED_IMAGE_SIZE = 720
+THUMBNAIL_SIZE = 240
+# The most pixels an uploaded image can have, a small file can decode to far more memory than it takes on disk
+MAX_IMAGE_PIXELS = 25_000_000
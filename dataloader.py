@@ -0,0 +1,119 @@
+import asyncio
+import contextvars
+from constants import MAX_BATCH_GET_SIZE
+from instrumented_repository import count_operations, READ_OPERATIONS
+
+# The loaders of the request being handled
+request_loaders = contextvars.ContextVar("request_loaders", default=None)
+
+
+"""
+Collects the keys requested during one turn of the event loop and loads them with a single batched read.
+
+Each key is loaded at most once, later loads of the same key share the first result for the rest of the request.
+A request that writes a document and reads it again afterwards should read it from the repository directly.
+
+Args:
+    batch_load (callable): Called with a list of keys, returns the documents that exist in any order.
+    key_of (callable): Returns the key of a document returned by batch_load.
+    max_batch_size (int): The most keys sent in one call to batch_load.
+"""
+class DataLoader:
+    def __init__(self, batch_load, key_of, max_batch_size):
+        self.batch_load = batch_load
+        self.key_of = key_of
+        self.max_batch_size = max_batch_size
+        self.results = {}
+        self.pending = []
+        self.batches = set()
+
+    """
+    Loads the document with the given key.
+
+    Args:
+        key: The key of the document.
+
+    Returns:
+        asyncio.Future: Resolves to the document, or None if it does not exist.
+    """
+    def load(self, key):
+        result = self.results.get(key)
+        if result is None:
+            loop = asyncio.get_running_loop()
+            result = self.results[key] = loop.create_future()
+            self.pending.append(key)
+            # Dispatch once every coroutine that is ready in this turn has had the chance to ask for its keys
+            if len(self.pending) == 1:
+                loop.call_soon(self.dispatch)
+        return result
+
+    def dispatch(self):
+        keys, self.pending = self.pending, []
+        for start in range(0, len(keys), self.max_batch_size):
+            batch = asyncio.ensure_future(self.load_batch(keys[start:start + self.max_batch_size]))
+            self.batches.add(batch)
+            batch.add_done_callback(self.batches.discard)
+
+    async def load_batch(self, keys):
+        try:
+            documents = {self.key_of(document): document for document in await self.batch_load(keys)}
+        except Exception as err:
+            for key in keys:
+                self.results[key].set_exception(err)
+            return
+
+        for key in keys:
+            self.results[key].set_result(documents.get(key))
+
+"""
+The loaders of one request, for the reads that requests repeat or issue side by side.
+"""
+class RequestLoaders:
+    def __init__(self, repository):
+        self.users = DataLoader(repository.get_users, lambda user: user['id'], MAX_BATCH_GET_SIZE)
+        self.usernames = DataLoader(repository.find_users_by_username, lambda user: user['username'], MAX_BATCH_GET_SIZE)
+        self.tweets = DataLoader(repository.get_tweets, lambda tweet: (tweet['author_id'], tweet['id']), MAX_BATCH_GET_SIZE)
+
+"""
+Gives every HTTP request its own loaders and operation counter, and reports the number of datastore reads the
+request made in the X-Datastore-Reads response header.
+
+The header is only sent with responses whose body is sent in one part, once all of its reads are done. Streamed
+responses, such as the pages rendered while the timeline is read, have no header since their reads happen after
+the headers are sent. Their reads are still counted in the request_datastore_calls metric, which is recorded once
+the body is complete.
+
+Args:
+    app: The ASGI app to wrap.
+    get_repository (callable): Returns the storage backend the loaders read from.
+"""
+class RequestScopeMiddleware:
+    def __init__(self, app, get_repository):
+        self.app = app
+        self.get_repository = get_repository
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        operations = count_operations()
+        request_loaders.set(RequestLoaders(self.get_repository()))
+
+        start = None
+
+        async def send_with_reads(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                # Held back until the first part of the body shows whether the response is complete
+                start = message
+                return
+            if start is not None:
+                if message["type"] == "http.response.body" and not message.get("more_body", False):
+                    reads = sum(count for name, count in operations.items() if name in READ_OPERATIONS)
+                    start["headers"] = list(start.get("headers", [])) + [(b"x-datastore-reads", str(reads).encode())]
+                await send(start)
+                start = None
+            await send(message)
+
+        await self.app(scope, receive, send_with_reads)
@@ -0,0 +1,26 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Number of blocking calls (storage uploads, token verification) a worker runs at the same time
+BLOCKING_CONCURRENCY = int(os.environ.get("BLOCKING_CONCURRENCY", "16"))
+
+# Bounded pool for client libraries without an async API
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_CONCURRENCY, thread_name_prefix="blocking")
+
+
+"""
+Runs a blocking function on the bounded executor so the event loop stays free.
+
+Args:
+    func (callable): The blocking function.
+    *args: Positional arguments for the function.
+    **kwargs: Keyword arguments for the function.
+
+Returns:
+    The return value of the function.
+"""
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, partial(func, *args, **kwargs))
@@ -0,0 +1,487 @@
+import asyncio
+import time
+from datetime import datetime
+from google.api_core.exceptions import NotFound
+from google.cloud import firestore, storage
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+import local_constants
+from constants import USER_COLLECTION, TWEET_COLLECTION, TIMELINE_COLLECTION, SEARCH_INDEX_COLLECTION, POSTINGS_COLLECTION, INDEXED_TERMS_COLLECTION, FOLLOWERS_COLLECTION, FOLLOWING_COLLECTION, USERNAME_COLLECTION, MAX_BATCH_SIZE, UPLOAD_CHUNK_SIZE, CELEBRITY_CACHE_SECONDS
+from datastore import run_blocking
+from repository import Repository
+from timeline import is_celebrity
+
+# Terms added to or removed from the search index by one transaction, two writes each besides the record of the terms
+TERMS_PER_TRANSACTION = (MAX_BATCH_SIZE - 1) // 2
+
+
+def snapshot_to_dict(snapshot):
+    return {"id": snapshot.id, **snapshot.to_dict()}
+
+"""
+Orders a collection newest first by (date, document ID), starting after the (date, id) position before.
+
+The document ID breaks ties between equal dates, so a page boundary never skips or repeats a document, and
+start_after seeks straight to the position so deep pages cost the same as the first one.
+"""
+def newest_first(collection, limit, before=None):
+    query = collection.order_by('date', direction='DESCENDING').order_by(FieldPath.document_id(), direction='DESCENDING')
+    if before:
+        query = query.start_after({'date': before[0], FieldPath.document_id(): before[1]})
+    return query.limit(limit)
+
+"""
+Stores documents in Firestore and blobs in Cloud Storage.
+"""
+class FirestoreRepository(Repository):
+    def __init__(self):
+        # The async client does not block the event loop while waiting on Firestore
+        self.db = firestore.AsyncClient()
+        # One storage client for the life of the app, so uploads reuse its connection pool and credentials
+        self.storage_client = storage.Client(project=local_constants.PROJECT_NAME)
+        self.bucket = self.storage_client.bucket(local_constants.PROJECT_STORAGE_BUCKET)
+        # Listeners are only available on the synchronous client, which is only used for them
+        self.watch_db = firestore.Client()
+        self.watches = []
+        # The users whose tweets are pulled on read, shared by the timeline reads of this worker
+        self.celebrities = None
+        self.celebrities_read_at = 0
+        self.celebrities_read = None
+
+    def user_ref(self, uid):
+        return self.db.collection(USER_COLLECTION).document(uid)
+
+    def username_ref(self, username):
+        return self.db.collection(USERNAME_COLLECTION).document(username)
+
+    def tweet_ref(self, author_id, tweet_id):
+        return self.user_ref(author_id).collection(TWEET_COLLECTION).document(tweet_id)
+
+    def term_ref(self, term):
+        return self.db.collection(SEARCH_INDEX_COLLECTION).document(term)
+
+    def posting_ref(self, term, tweet_id):
+        return self.term_ref(term).collection(POSTINGS_COLLECTION).document(tweet_id)
+
+    def indexed_terms_ref(self, tweet_id):
+        return self.db.collection(INDEXED_TERMS_COLLECTION).document(tweet_id)
+
+    """
+    Applies a write to each item, committing batches of at most MAX_BATCH_SIZE writes concurrently.
+
+    Args:
+        items (iterable): The items to write.
+        write (callable): Called with (batch, item) to queue the write for one item.
+        writes_per_item (int, optional): The number of writes queued for each item. Defaults to 1.
+    """
+    async def write_in_batches(self, items, write, writes_per_item=1):
+        batches = []
+        batch = self.db.batch()
+        pending = 0
+        for item in items:
+            write(batch, item)
+            pending += writes_per_item
+            if pending > MAX_BATCH_SIZE - writes_per_item:
+                batches.append(batch)
+                batch = self.db.batch()
+                pending = 0
+        if pending:
+            batches.append(batch)
+
+        await asyncio.gather(*(batch.commit() for batch in batches))
+
+    # Users
+
+    async def get_user(self, uid):
+        user_doc = await self.user_ref(uid).get()
+        return snapshot_to_dict(user_doc) if user_doc.exists else None
+
+    async def get_users(self, uids):
+        return [snapshot_to_dict(user_doc) async for user_doc in self.db.get_all([self.user_ref(uid) for uid in uids]) if user_doc.exists]
+
+    # Usernames resolve through their reservation with key gets, rather than with a query on the user documents
+
+    async def find_user_by_username(self, username):
+        reservation = await self.username_ref(username).get()
+        return await self.get_user(reservation.get('uid')) if reservation.exists else None
+
+    async def find_users_by_username(self, usernames):
+        uids = [reservation.get('uid') async for reservation in self.db.get_all([self.username_ref(username) for username in usernames]) if reservation.exists]
+        return await self.get_users(uids) if uids else []
+
+    async def create_user(self, uid, data):
+        batch = self.db.batch()
+        batch.set(self.user_ref(uid), data)
+        if data.get('username'):
+            batch.set(self.username_ref(data['username']), {'uid': uid})
+        await batch.commit()
+
+    async def claim_username(self, uid, username):
+        user_ref = self.user_ref(uid)
+        username_ref = self.username_ref(username)
+
+        @firestore.async_transactional
+        async def claim_in_transaction(transaction):
+            reservation = await username_ref.get(transaction=transaction)
+            if reservation.exists and reservation.get('uid') != uid:
+                return False
+
+            user_doc = await user_ref.get(['username'], transaction=transaction)
+            previous = (user_doc.to_dict() or {}).get('username')
+            if previous and previous != username:
+                transaction.delete(self.username_ref(previous))
+            transaction.set(username_ref, {'uid': uid})
+            transaction.set(user_ref, {'username': username}, merge=True)
+            return True
+
+        return await claim_in_transaction(self.db.transaction())
+
+    async def update_user(self, uid, fields):
+        await self.user_ref(uid).update(fields)
+
+    async def iter_usernames(self):
+        async for reservation in self.db.collection(USERNAME_COLLECTION).stream():
+            yield reservation.get('uid'), reservation.id
+
+    def watch_usernames(self, callback):
+        def on_snapshot(docs, changes, read_time):
+            claimed = {change.document.get('uid') for change in changes if change.type.name != 'REMOVED'}
+            for change in changes:
+                uid = change.document.get('uid')
+                if change.type.name != 'REMOVED':
+                    callback(uid, change.document.id)
+                # A rename releases the old username in the same transaction, the new one replaces it in the index
+                elif uid not in claimed:
+                    callback(uid, None)
+
+        # The listener runs on a thread of its own. Only the reservations are watched, so the count updates on the
+        # user documents do not wake it
+        watch = self.watch_db.collection(USERNAME_COLLECTION).on_snapshot(on_snapshot)
+        self.watches.append(watch)
+        return watch.unsubscribe
+
+    # Follow graph
+
+    def follower_ref(self, uid, follower_id):
+        return self.user_ref(uid).collection(FOLLOWERS_COLLECTION).document(follower_id)
+
+    def following_ref(self, uid, target_id):
+        return self.user_ref(uid).collection(FOLLOWING_COLLECTION).document(target_id)
+
+    """
+    Writes or deletes both records of a follow edge and moves the counts of both users, in one transaction.
+
+    Only the edge is read inside the transaction, so concurrent follows of the same account do not contend on its
+    user document. The counts are moved with server-side increments.
+
+    Returns:
+        bool: True if the edge changed.
+    """
+    async def change_follow(self, user, target, following):
+        following_ref = self.following_ref(user['id'], target['id'])
+        follower_ref = self.follower_ref(target['id'], user['id'])
+
+        @firestore.async_transactional
+        async def change_in_transaction(transaction):
+            edge = await following_ref.get(transaction=transaction)
+            if edge.exists == following:
+                return False
+
+            if following:
+                date = datetime.now()
+                transaction.set(following_ref, {'uid': target['id'], 'username': target['username'], 'date': date})
+                transaction.set(follower_ref, {'uid': user['id'], 'username': user['username'], 'date': date})
+            else:
+                transaction.delete(following_ref)
+                transaction.delete(follower_ref)
+            step = 1 if following else -1
+            transaction.update(self.user_ref(user['id']), {'following_count': firestore.Increment(step)})
+            transaction.update(self.user_ref(target['id']), {'follower_count': firestore.Increment(step)})
+            return True
+
+        if not await change_in_transaction(self.db.transaction()):
+            return False
+
+        # The celebrity flag only decides how tweets are delivered, so it can trail the count by a moment
+        target_doc = await self.user_ref(target['id']).get(['follower_count', 'celebrity'])
+        fields = target_doc.to_dict() or {}
+        celebrity = is_celebrity(fields.get('follower_count', 0), fields.get('celebrity', False))
+        if fields.get('celebrity', False) != celebrity:
+            await self.update_user(target['id'], {'celebrity': celebrity})
+            # Seen by this worker at once, other workers read it when their list expires
+            self.celebrities = None
+        return True
+
+    async def follow(self, user, target):
+        return await self.change_follow(user, target, True)
+
+    async def unfollow(self, user, target):
+        return await self.change_follow(user, target, False)
+
+    async def is_following(self, uid, target_id):
+        edge = await self.following_ref(uid, target_id).get()
+        return edge.exists
+
+    async def follower_ids(self, uid):
+        edges = await self.user_ref(uid).collection(FOLLOWERS_COLLECTION).select([]).get()
+        return [edge.id for edge in edges]
+
+    async def following_ids(self, uid):
+        edges = await self.user_ref(uid).collection(FOLLOWING_COLLECTION).select([]).get()
+        return [edge.id for edge in edges]
+
+    """
+    Returns every user whose tweets are pulled on read, read at most once per CELEBRITY_CACHE_SECONDS seconds.
+    Concurrent callers share one read.
+    """
+    async def celebrity_users(self):
+        if self.celebrities is None or time.monotonic() - self.celebrities_read_at > CELEBRITY_CACHE_SECONDS:
+            if self.celebrities_read is None or self.celebrities_read.done():
+                self.celebrities_read = asyncio.ensure_future(self.read_celebrities())
+            await asyncio.shield(self.celebrities_read)
+        return self.celebrities
+
+    async def read_celebrities(self):
+        read_at = time.monotonic()
+        celebrity_docs = await self.db.collection(USER_COLLECTION).where(filter=FieldFilter('celebrity', '==', True)).get()
+        self.celebrities = [snapshot_to_dict(celebrity_doc) for celebrity_doc in celebrity_docs]
+        self.celebrities_read_at = read_at
+
+    async def find_followed_celebrities(self, uid, following_count=None):
+        celebrities = await self.celebrity_users()
+        if not celebrities:
+            return []
+
+        # Whichever is smaller is read: the user's follow edges, or the edges to each celebrity in one batched get
+        if following_count is not None and following_count < len(celebrities):
+            followed = set(await self.following_ids(uid))
+        else:
+            followed = {edge.id async for edge in self.db.get_all([self.following_ref(uid, celebrity['id']) for celebrity in celebrities]) if edge.exists}
+        return [dict(celebrity) for celebrity in celebrities if celebrity['id'] in followed]
+
+    async def iter_users(self):
+        async for user_doc in self.db.collection(USER_COLLECTION).stream():
+            yield snapshot_to_dict(user_doc)
+
+    async def put_follow_edges(self, edges):
+        def write(batch, edge):
+            user, target, date = edge
+            batch.set(self.following_ref(user['id'], target['id']), {'uid': target['id'], 'username': target['username'], 'date': date})
+            batch.set(self.follower_ref(target['id'], user['id']), {'uid': user['id'], 'username': user['username'], 'date': date})
+
+        await self.write_in_batches(edges, write)
+
+    async def count_follows(self, uid):
+        followers, following = await asyncio.gather(
+            self.user_ref(uid).collection(FOLLOWERS_COLLECTION).count().get(),
+            self.user_ref(uid).collection(FOLLOWING_COLLECTION).count().get()
+        )
+        return followers[0][0].value, following[0][0].value
+
+    async def remove_user_fields(self, uid, names):
+        await self.update_user(uid, {name: firestore.DELETE_FIELD for name in names})
+
+    # Tweets
+
+    async def add_tweet(self, author_id, data):
+        tweet_ref = self.user_ref(author_id).collection(TWEET_COLLECTION).document()
+        await tweet_ref.set(data)
+        return tweet_ref.id
+
+    async def get_tweet(self, author_id, tweet_id):
+        tweet_doc = await self.tweet_ref(author_id, tweet_id).get()
+        return {"id": tweet_id, "author_id": author_id, **tweet_doc.to_dict()} if tweet_doc.exists else None
+
+    async def get_tweets(self, keys):
+        refs = [self.tweet_ref(author_id, tweet_id) for author_id, tweet_id in keys]
+        return [{"id": tweet.id, "author_id": tweet.reference.parent.parent.id, **tweet.to_dict()} async for tweet in self.db.get_all(refs) if tweet.exists]
+
+    async def update_tweet(self, author_id, tweet_id, fields):
+        await self.tweet_ref(author_id, tweet_id).update(fields)
+
+    async def delete_tweet(self, author_id, tweet_id):
+        await self.tweet_ref(author_id, tweet_id).delete()
+
+    async def latest_tweets(self, author_id, limit, before=None):
+        tweets = await newest_first(self.user_ref(author_id).collection(TWEET_COLLECTION), limit, before).get()
+        return [{"id": tweet.id, "author_id": author_id, **tweet.to_dict()} for tweet in tweets]
+
+    async def iter_tweets(self):
+        async for tweet in self.db.collection_group(TWEET_COLLECTION).stream():
+            yield {"id": tweet.id, "author_id": tweet.reference.parent.parent.id, **tweet.to_dict()}
+
+    # Materialized timelines
+
+    async def add_to_timelines(self, owner_ids, entry):
+        await self.write_in_batches(owner_ids, lambda batch, owner_id: batch.set(self.user_ref(owner_id).collection(TIMELINE_COLLECTION).document(entry['tweet_id']), entry))
+
+    async def put_timeline_entries(self, owner_id, entries):
+        timeline = self.user_ref(owner_id).collection(TIMELINE_COLLECTION)
+        await self.write_in_batches(entries, lambda batch, entry: batch.set(timeline.document(entry['tweet_id']), entry))
+
+    async def update_timeline_entries(self, tweet_id, fields):
+        copies = await self.db.collection_group(TIMELINE_COLLECTION).where(filter=FieldFilter('tweet_id', '==', tweet_id)).get()
+        await self.write_in_batches(copies, lambda batch, copy: batch.update(copy.reference, fields))
+
+    async def delete_timeline_entries(self, tweet_id):
+        copies = await self.db.collection_group(TIMELINE_COLLECTION).where(filter=FieldFilter('tweet_id', '==', tweet_id)).get()
+        await self.write_in_batches(copies, lambda batch, copy: batch.delete(copy.reference))
+
+    async def prune_timeline(self, owner_id, author_id):
+        entries = await self.user_ref(owner_id).collection(TIMELINE_COLLECTION).where(filter=FieldFilter('author_id', '==', author_id)).get()
+        await self.write_in_batches(entries, lambda batch, entry: batch.delete(entry.reference))
+
+    async def read_timeline(self, owner_id, limit, before=None):
+        entries = await newest_first(self.user_ref(owner_id).collection(TIMELINE_COLLECTION), limit, before).get()
+        return [snapshot_to_dict(entry) for entry in entries]
+
+    # Search index
+
+    async def update_postings(self, tweet_id, posting, terms):
+        indexed_ref = self.indexed_terms_ref(tweet_id)
+        # The terms the tweet keeps from before, their postings are rewritten once the counts are done
+        kept_terms = None
+
+        # A term added or removed takes two writes, so a tweet with many changed terms is moved over in several
+        # transactions. Each one records the terms it moved, so the next one, or a retry, picks up where it stopped,
+        # and the counts only move for the terms that the record says were added or removed.
+        @firestore.async_transactional
+        async def update_in_transaction(transaction):
+            nonlocal kept_terms
+            indexed = await indexed_ref.get(transaction=transaction)
+            indexed_terms = set(indexed.get('terms')) if indexed.exists else set()
+            if kept_terms is None:
+                kept_terms = indexed_terms & terms
+            changed = sorted(indexed_terms ^ terms)
+            for term in changed[:TERMS_PER_TRANSACTION]:
+                if term in indexed_terms:
+                    transaction.delete(self.posting_ref(term, tweet_id))
+                    transaction.set(self.term_ref(term), {'count': firestore.Increment(-1)}, merge=True)
+                    indexed_terms.discard(term)
+                else:
+                    transaction.set(self.posting_ref(term, tweet_id), posting)
+                    transaction.set(self.term_ref(term), {'count': firestore.Increment(1)}, merge=True)
+                    indexed_terms.add(term)
+            if indexed_terms:
+                transaction.set(indexed_ref, {'terms': sorted(indexed_terms)})
+            elif indexed.exists:
+                transaction.delete(indexed_ref)
+            return len(changed) > TERMS_PER_TRANSACTION
+
+        while await update_in_transaction(self.db.transaction()):
+            pass
+        # The postings carry every term of the tweet, which an edit changes
+        await self.write_in_batches(kept_terms, lambda batch, term: batch.set(self.posting_ref(term, tweet_id), posting))
+
+    async def term_counts(self, terms):
+        term_docs = self.db.get_all([self.term_ref(term) for term in terms])
+        return {term_doc.id: term_doc.get('count') async for term_doc in term_docs if term_doc.exists}
+
+    async def postings_page(self, term, limit, cursor=None):
+        postings_query = self.term_ref(term).collection(POSTINGS_COLLECTION).order_by('date', direction='DESCENDING').limit(limit)
+        if cursor is not None:
+            postings_query = postings_query.start_after(cursor)
+
+        page = await postings_query.get()
+        return [entry.to_dict() for entry in page], (page[-1] if len(page) == limit else None)
+
+    async def clear_search_index(self):
+        await asyncio.gather(
+            self.db.recursive_delete(self.db.collection(SEARCH_INDEX_COLLECTION)),
+            self.db.recursive_delete(self.db.collection(INDEXED_TERMS_COLLECTION))
+        )
+
+    async def put_postings(self, postings):
+        await self.write_in_batches(postings, lambda batch, item: batch.set(self.posting_ref(item[0], item[1]), item[2]))
+
+    async def put_indexed_terms(self, indexed_terms):
+        await self.write_in_batches(indexed_terms.items(), lambda batch, item: batch.set(self.indexed_terms_ref(item[0]), {'terms': sorted(item[1])}))
+
+    async def set_term_counts(self, counts):
+        await self.write_in_batches(counts.items(), lambda batch, item: batch.set(self.term_ref(item[0]), {'count': item[1]}))
+
+    # Bulk data
+
+    def by_id_after(self, collection, limit, after):
+        query = collection.order_by(FieldPath.document_id())
+        if after:
+            query = query.start_after({FieldPath.document_id(): after})
+        return query.limit(limit)
+
+    async def users_page(self, limit, after=None):
+        user_docs = await self.by_id_after(self.db.collection(USER_COLLECTION), limit, after).get()
+        return [snapshot_to_dict(user_doc) for user_doc in user_docs]
+
+    async def tweets_page(self, author_id, limit, after=None):
+        tweet_docs = await self.by_id_after(self.user_ref(author_id).collection(TWEET_COLLECTION), limit, after).get()
+        return [{"id": tweet_doc.id, "author_id": author_id, **tweet_doc.to_dict()} for tweet_doc in tweet_docs]
+
+    async def following_page(self, uid, limit, after=None):
+        edges = await self.by_id_after(self.user_ref(uid).collection(FOLLOWING_COLLECTION), limit, after).get()
+        return [{'uid': edge.id, **edge.to_dict()} for edge in edges]
+
+    async def put_users(self, users):
+        def write(batch, user):
+            batch.set(self.user_ref(user['id']), {key: value for key, value in user.items() if key != 'id'})
+            if user.get('username'):
+                batch.set(self.username_ref(user['username']), {'uid': user['id']})
+
+        await self.write_in_batches(users, write, writes_per_item=2)
+
+    async def put_tweets(self, tweets):
+        def write(batch, tweet):
+            batch.set(self.tweet_ref(tweet['author_id'], tweet['id']), {key: value for key, value in tweet.items() if key not in ('id', 'author_id')})
+
+        await self.write_in_batches(tweets, write)
+
+    # Blobs
+
+    def upload_blob_sync(self, name, file, content_type, cache_control):
+        # Setting a chunk size makes the upload resumable, the file is read and sent one chunk at a time
+        blob = self.bucket.blob(name, chunk_size=UPLOAD_CHUNK_SIZE)
+        blob.cache_control = cache_control
+        blob.upload_from_file(file, content_type=content_type)
+
+        # Get the URL of the uploaded file
+        return self.blob_url(blob.name)
+
+    async def upload_blob(self, name, file, content_type=None, cache_control=None):
+        # The storage client has no async API, so the upload runs on the bounded executor
+        return await run_blocking(self.upload_blob_sync, name, file, content_type, cache_control)
+
+    def read_blob_sync(self, name):
+        try:
+            return self.bucket.blob(name).download_as_bytes()
+        except NotFound:
+            return None
+
+    async def read_blob(self, name):
+        return await run_blocking(self.read_blob_sync, name)
+
+    async def blob_exists(self, name):
+        return await run_blocking(self.bucket.blob(name).exists)
+
+    def blob_url(self, name):
+        return f"https://storage.cloud.google.com/{self.bucket.name}/{name}"
+
+    async def warm_up(self):
+        # Any read opens the gRPC channel to Firestore and the HTTP session to Cloud Storage
+        await asyncio.gather(
+            self.db.collection(USER_COLLECTION).limit(1).get(),
+            run_blocking(self.bucket.blob("warm-up").exists)
+        )
+
+    async def close(self):
+        if self.watches:
+            await run_blocking(self.stop_watching)
+        self.db.close()
+        self.storage_client.close()
+
+    def stop_watching(self):
+        # Stopping a watch twice does nothing, so watches already stopped by their caller are fine
+        for watch in self.watches:
+            watch.unsubscribe()
+        self.watches = []
+        # Closing the client only closes its HTTP session, its gRPC channel is closed through the transport
+        self.watch_db.close()
+        self.watch_db._firestore_api.transport.close()
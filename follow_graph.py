@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+from datetime import datetime
+from constants import MAX_BATCH_SIZE
+from repository import create_repository
+from timeline import is_celebrity
+
+# The fields the follow graph used to be stored in, as lists of usernames on each user document
+LEGACY_FIELDS = ['followers', 'following']
+
+
+"""
+Moves the follow graph out of the follower and following username lists on the user documents into edge records.
+
+Both lists are read, so an edge that only made it into one side of a racing follow is still kept. Edges are
+written idempotently and the counts are recounted from the stored edges, so the migration can be run again
+after an interruption.
+
+Usernames are resolved through their reservations, so run the username_reservations migration first.
+
+Args:
+    repository (Repository): The storage backend.
+
+Returns:
+    int: The number of users whose lists were migrated.
+"""
+async def migrate(repository):
+    uids = {username: uid async for uid, username in repository.iter_usernames()}
+
+    migrated = []
+    edges = []
+    date = datetime.now()
+    async for user in repository.iter_users():
+        if not any(field in user for field in LEGACY_FIELDS):
+            continue
+        migrated.append(user['id'])
+
+        for target_username in user.get('following', []):
+            if target_username in uids:
+                edges.append(({'id': user['id'], 'username': user['username']}, {'id': uids[target_username], 'username': target_username}, date))
+        for follower_username in user.get('followers', []):
+            if follower_username in uids:
+                edges.append(({'id': uids[follower_username], 'username': follower_username}, {'id': user['id'], 'username': user['username']}, date))
+
+        if len(edges) >= MAX_BATCH_SIZE:
+            await repository.put_follow_edges(edges)
+            edges = []
+    await repository.put_follow_edges(edges)
+
+    # Every user can have gained edges from the lists of others, so all counts are recounted
+    async def recount(uid):
+        follower_count, following_count = await repository.count_follows(uid)
+        await repository.update_user(uid, {'follower_count': follower_count, 'following_count': following_count, 'celebrity': is_celebrity(follower_count)})
+
+    all_uids = list(uids.values())
+    for start in range(0, len(all_uids), MAX_BATCH_SIZE):
+        await asyncio.gather(*(recount(uid) for uid in all_uids[start:start + MAX_BATCH_SIZE]))
+
+    # The lists are only dropped once the edges and counts that replace them are stored
+    for start in range(0, len(migrated), MAX_BATCH_SIZE):
+        await asyncio.gather(*(repository.remove_user_fields(uid, LEGACY_FIELDS) for uid in migrated[start:start + MAX_BATCH_SIZE]))
+    return len(migrated)
+
+async def main(command):
+    repository = create_repository()
+    try:
+        if command == "migrate":
+            print(f"Migrated the follow lists of {await migrate(repository)} users")
+    finally:
+        await repository.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the follow graph.")
+    parser.add_argument("command", choices=["migrate"])
+    args = parser.parse_args()
+
+    asyncio.run(main(args.command))
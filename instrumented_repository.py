@@ -0,0 +1,83 @@
+import contextvars
+import functools
+import inspect
+import time
+from collections import Counter
+
+# Repository calls made by the current request, keyed by method name
+request_operations = contextvars.ContextVar("request_operations", default=None)
+
+# The repository methods that only read
+READ_OPERATIONS = frozenset([
+    'get_user', 'get_users', 'find_user_by_username', 'find_users_by_username', 'iter_usernames', 'iter_users',
+    'is_following', 'follower_ids', 'following_ids', 'find_followed_celebrities', 'count_follows',
+    'get_tweet', 'get_tweets', 'latest_tweets', 'iter_tweets', 'read_timeline',
+    'term_counts', 'postings_page', 'users_page', 'tweets_page', 'following_page', 'read_blob', 'blob_exists'
+])
+
+
+"""
+Starts counting the repository calls made from the current context.
+
+Tasks started afterwards share the counter, so calls made from asyncio.gather are counted too.
+
+Returns:
+    Counter: The number of calls to each repository method.
+"""
+def count_operations():
+    operations = Counter()
+    request_operations.set(operations)
+    return operations
+
+def record(name):
+    operations = request_operations.get()
+    if operations is not None:
+        operations[name] += 1
+
+"""
+Wraps a storage backend and records every call to it in the counter of the current request.
+
+Every call counts as one datastore operation, whether the backend answers it with a document get, a query or a batched write.
+
+Args:
+    repository (Repository): The storage backend.
+    observe (callable, optional): Called with (method name, args, start, seconds) after every call, start being the
+        time.perf_counter() at which the call began. Defaults to None.
+"""
+class InstrumentedRepository:
+    def __init__(self, repository, observe=None):
+        self.repository = repository
+        self.observe = observe
+
+    def __getattr__(self, name):
+        method = getattr(self.repository, name)
+        observe = self.observe
+
+        if inspect.isasyncgenfunction(method):
+            @functools.wraps(method)
+            async def wrapper(*args, **kwargs):
+                record(name)
+                # Only the time spent waiting on the backend counts, not the time the caller spends on each item
+                elapsed = 0
+                begin = start = time.perf_counter()
+                async for item in method(*args, **kwargs):
+                    elapsed += time.perf_counter() - start
+                    yield item
+                    start = time.perf_counter()
+                if observe:
+                    observe(name, args, begin, elapsed + time.perf_counter() - start)
+        elif inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def wrapper(*args, **kwargs):
+                record(name)
+                start = time.perf_counter()
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    if observe:
+                        observe(name, args, start, time.perf_counter() - start)
+        else:
+            return method
+
+        setattr(self, name, wrapper)
+        return wrapper
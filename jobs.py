@@ -0,0 +1,424 @@
+"""
+Runs the side effects of writes in the background, so a request handler only makes the write itself.
+
+A handler enqueues a job, named after what it does and keyed by what it is about, such as the ID of a tweet, and
+returns. A job that raises is retried up to JOB_MAX_ATTEMPTS times with exponential backoff, then set aside as a
+dead letter and handed to the dead letter handler of its name, if it has one. Jobs must therefore be idempotent:
+any of them can run again after it partly ran. Enqueueing a job that is still waiting in the queue under the same
+name and key does nothing, the waiting job runs once.
+
+Jobs with the same key run one at a time in the order they were queued, so the jobs about one tweet never overtake
+each other. A job waiting for a retry holds back the jobs queued after it under its key.
+
+By default jobs are kept in memory and the ones still queued when the process dies are lost. With JOB_DIR set each
+job is written to its own file before enqueue returns and removed once it is done, jobs left over by a crash run
+again when the app starts, and dead letters are kept in JOB_DIR/dead:
+
+    python jobs.py status
+    python jobs.py dead
+    python jobs.py requeue [<job file>]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from collections import deque
+from datastore import run_blocking
+from metrics import jobs_pending, jobs_dead_letters, job_duration
+
+# Jobs run at the same time
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+# Attempts before a job becomes a dead letter
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "5"))
+# Seconds before the first retry, doubled for every retry after it
+JOB_RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", "1"))
+# Seconds the app waits on shutdown for the queued jobs to finish
+JOB_DRAIN_TIMEOUT = float(os.environ.get("JOB_DRAIN_TIMEOUT", "10"))
+# Optional directory that makes the queue durable
+JOB_DIR = os.environ.get("JOB_DIR")
+
+# Dead letters kept by the in-memory queue
+DEAD_LETTER_LIMIT = 1000
+
+# Job name -> the coroutine function that runs it, called with the arguments of the job
+handlers = {}
+# Job name -> the coroutine function called with the arguments of a job that became a dead letter
+dead_letter_handlers = {}
+
+
+"""
+Registers a coroutine function as the handler of the jobs with the given name.
+
+Args:
+    name (str): The job name.
+"""
+def job(name):
+    def register(handler):
+        handlers[name] = handler
+        return handler
+    return register
+
+"""
+Registers a coroutine function that is called with the arguments of a job with the given name once it became a
+dead letter, to make up for what the job could not do.
+
+Args:
+    name (str): The job name.
+"""
+def dead_letter(name):
+    def register(handler):
+        dead_letter_handlers[name] = handler
+        return handler
+    return register
+
+"""
+One unit of background work. The arguments must be JSON serializable so the job can be written to disk.
+
+Args:
+    name (str): The job name, which selects its handler.
+    key (str): What the job is about, the same name and key are the same job.
+    args (dict): The keyword arguments of the handler.
+"""
+class Job:
+    def __init__(self, name, key, args, attempts=0, error=None, file=None):
+        self.name = name
+        self.key = key
+        self.args = args
+        self.attempts = attempts
+        self.error = error
+        self.file = file or f"{uuid.uuid4().hex}.json"
+
+    @property
+    def id(self):
+        return f"{self.name}:{self.key}"
+
+    def to_dict(self):
+        return {'name': self.name, 'key': self.key, 'args': self.args, 'attempts': self.attempts, 'error': self.error}
+
+    @classmethod
+    def from_dict(cls, data, file):
+        return cls(data['name'], data['key'], data['args'], data['attempts'], data['error'], file)
+
+def write_json(path, data):
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as json_file:
+        json.dump(data, json_file)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(temporary_path, path)
+
+def copy_file(file, path):
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as staged_file:
+        shutil.copyfileobj(file, staged_file)
+    file.seek(0)
+    os.replace(temporary_path, path)
+
+"""
+Runs jobs on a pool of worker tasks in this process, keeping the queue in memory.
+
+Args:
+    workers (int, optional): The jobs run at the same time. Defaults to JOB_WORKERS.
+    max_attempts (int, optional): The attempts before a job becomes a dead letter. Defaults to JOB_MAX_ATTEMPTS.
+    retry_delay (float, optional): The seconds before the first retry. Defaults to JOB_RETRY_DELAY.
+"""
+class JobQueue:
+    def __init__(self, workers=JOB_WORKERS, max_attempts=JOB_MAX_ATTEMPTS, retry_delay=JOB_RETRY_DELAY):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.queue = asyncio.Queue()
+        # Job ID -> the job waiting in the queue under that ID
+        self.queued = {}
+        # Key -> the job running or waiting for a retry under that key, and the jobs queued after it
+        self.holders = {}
+        self.blocked = {}
+        # Jobs that are queued, running or waiting for a retry
+        self.pending = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.retries = set()
+        self.dead = deque(maxlen=DEAD_LETTER_LIMIT)
+        self.tasks = []
+        self.staging_dir = None
+        jobs_pending.set(0)
+        jobs_dead_letters.set(0)
+
+    async def start(self):
+        if self.staging_dir is None:
+            self.staging_dir = tempfile.mkdtemp(prefix="jobs-")
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    """
+    Queues a job, unless the same job is already waiting in the queue.
+
+    Args:
+        name (str): The job name.
+        key (str): What the job is about.
+        **args: The keyword arguments of the handler.
+    """
+    async def enqueue(self, name, key, /, **args):
+        job = Job(name, key, args)
+        if job.id in self.queued:
+            return
+        await self.save(job)
+        self.add_pending(1)
+        self.put(job)
+
+    """
+    Copies a file that a job will read, such as an upload, out of the request into the staging directory. A file
+    that is already staged under the same name is not copied again.
+
+    Args:
+        file: A binary file object, rewound afterwards.
+        name (str): The name of the staged file, unique to its content.
+
+    Returns:
+        str: The path of the staged file.
+    """
+    async def stage(self, file, name):
+        path = os.path.join(self.staging_dir, name)
+        if not os.path.exists(path):
+            await run_blocking(copy_file, file, path)
+        return path
+
+    def put(self, job):
+        self.queued[job.id] = job
+        self.queue.put_nowait(job)
+
+    def add_pending(self, count):
+        self.pending += count
+        jobs_pending.set(self.pending)
+        if self.pending:
+            self.idle.clear()
+        else:
+            self.idle.set()
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            if self.holders.setdefault(job.key, job) is not job:
+                self.blocked.setdefault(job.key, deque()).append(job)
+                continue
+            if self.queued.get(job.id) is job:
+                del self.queued[job.id]
+            await self.run(job)
+
+    """
+    Hands the key of a job that is done to the next job queued under it, which runs before any job queued later.
+    """
+    def unblock(self, job):
+        waiting = self.blocked.get(job.key)
+        if not waiting:
+            del self.holders[job.key]
+            return
+        next_job = waiting.popleft()
+        if not waiting:
+            del self.blocked[job.key]
+        self.holders[job.key] = next_job
+        self.queue.put_nowait(next_job)
+
+    async def run(self, job):
+        start = time.perf_counter()
+        try:
+            await handlers[job.name](**job.args)
+        except Exception as err:
+            job_duration.observe(time.perf_counter() - start, job.name, "failed")
+            job.attempts += 1
+            job.error = f"{type(err).__name__}: {err}"
+            if job.attempts >= self.max_attempts:
+                await self.bury(job)
+                await self.give_up(job)
+                self.add_pending(-1)
+                self.unblock(job)
+            else:
+                await self.save(job)
+                self.schedule_retry(job)
+        else:
+            job_duration.observe(time.perf_counter() - start, job.name, "succeeded")
+            await self.remove(job)
+            self.add_pending(-1)
+            self.unblock(job)
+
+    async def give_up(self, job):
+        handler = dead_letter_handlers.get(job.name)
+        if handler is None:
+            return
+        try:
+            await handler(**job.args)
+        except Exception as err:
+            print(f"Dead letter handler of background job {job.id} failed with {type(err).__name__}: {err}")
+
+    def schedule_retry(self, job):
+        def retry():
+            self.retries.discard(handle)
+            self.put(job)
+
+        handle = asyncio.get_running_loop().call_later(self.retry_delay * 2 ** (job.attempts - 1), retry)
+        self.retries.add(handle)
+
+    """
+    Waits until every queued job has finished, including its retries.
+    """
+    async def join(self):
+        await self.idle.wait()
+
+    """
+    Gives the queued jobs up to JOB_DRAIN_TIMEOUT seconds to finish, then stops the workers. The staged files are
+    only removed when every job finished, since unfinished jobs may still need them.
+    """
+    async def close(self, timeout=JOB_DRAIN_TIMEOUT):
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+            finished = True
+        except asyncio.TimeoutError:
+            self.abandon()
+            finished = False
+        for handle in self.retries:
+            handle.cancel()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if finished:
+            self.cleanup()
+
+    def abandon(self):
+        print(f"Stopped with {self.pending} background jobs unfinished, they are lost, set JOB_DIR to keep them")
+        if self.staging_dir is not None:
+            print(f"The files they staged, such as uploaded images, are kept in {self.staging_dir}")
+
+    def cleanup(self):
+        if self.staging_dir is not None:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    # Storage of the jobs, nothing is stored by the in-memory queue
+
+    async def save(self, job):
+        pass
+
+    async def remove(self, job):
+        pass
+
+    async def bury(self, job):
+        self.dead.append(job)
+        jobs_dead_letters.set((jobs_dead_letters.value or 0) + 1)
+        print(f"Background job {job.id} failed {job.attempts} times, last with {job.error}")
+
+"""
+A job queue that keeps every unfinished job in a file, so jobs survive a restart of the process. Staged files are
+kept next to the jobs.
+
+Args:
+    directory (str): The directory of the queue.
+"""
+class DiskJobQueue(JobQueue):
+    def __init__(self, directory, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = os.path.abspath(directory)
+        self.pending_dir = os.path.join(directory, "pending")
+        self.dead_dir = os.path.join(directory, "dead")
+        self.staging_dir = os.path.join(directory, "staged")
+
+    """
+    Queues the jobs left over by the previous process, oldest first, before the workers start.
+    """
+    async def start(self):
+        for job in await run_blocking(self.recover):
+            self.add_pending(1)
+            self.put(job)
+        await super().start()
+
+    def recover(self):
+        for path in (self.pending_dir, self.dead_dir, self.staging_dir):
+            os.makedirs(path, exist_ok=True)
+        return [Job.from_dict(data, file) for file, data in read_jobs(self.pending_dir)]
+
+    def job_path(self, job):
+        return os.path.join(self.pending_dir, job.file)
+
+    async def save(self, job):
+        await run_blocking(write_json, self.job_path(job), job.to_dict())
+
+    async def remove(self, job):
+        await run_blocking(os.remove, self.job_path(job))
+
+    async def bury(self, job):
+        await run_blocking(write_json, os.path.join(self.dead_dir, job.file), job.to_dict())
+        await run_blocking(os.remove, self.job_path(job))
+        await super().bury(job)
+
+    def abandon(self):
+        print(f"Stopped with {self.pending} background jobs unfinished, they run again on the next start")
+
+    def cleanup(self):
+        pass
+
+"""
+Creates the job queue, durable when JOB_DIR is set.
+
+Returns:
+    JobQueue: The job queue.
+"""
+def create_job_queue():
+    return DiskJobQueue(JOB_DIR) if JOB_DIR else JobQueue()
+
+"""
+Reads the job files of a directory, oldest first.
+
+Returns:
+    list: The file name and the content of each job.
+"""
+def read_jobs(directory):
+    if not os.path.isdir(directory):
+        return []
+    files = sorted((entry for entry in os.scandir(directory) if entry.name.endswith(".json")), key=lambda entry: entry.stat().st_mtime)
+    jobs = []
+    for entry in files:
+        with open(entry.path) as job_file:
+            jobs.append((entry.name, json.load(job_file)))
+    return jobs
+
+# Command line
+
+def print_status(args):
+    print(f"{len(read_jobs(os.path.join(args.dir, 'pending')))} pending, {len(read_jobs(os.path.join(args.dir, 'dead')))} dead")
+
+def print_dead(args):
+    for file, data in read_jobs(os.path.join(args.dir, "dead")):
+        print(f"{file}  {data['name']}:{data['key']}  {data['attempts']} attempts  {data['error']}")
+
+"""
+Moves dead letters back to the pending jobs with their attempts reset. They run the next time the app starts.
+"""
+def requeue(args):
+    dead_dir = os.path.join(args.dir, "dead")
+    pending_dir = os.path.join(args.dir, "pending")
+    requeued = 0
+    for file, data in read_jobs(dead_dir):
+        if args.file and file != args.file:
+            continue
+        write_json(os.path.join(pending_dir, file), {**data, 'attempts': 0, 'error': None})
+        os.remove(os.path.join(dead_dir, file))
+        requeued += 1
+    print(f"Requeued {requeued} jobs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=JOB_DIR, required=JOB_DIR is None, help="The directory of the queue")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="Count the pending and dead jobs").set_defaults(run=print_status)
+    commands.add_parser("dead", help="List the dead letters with their last error").set_defaults(run=print_dead)
+    requeue_parser = commands.add_parser("requeue", help="Move dead letters back to the queue")
+    requeue_parser.add_argument("file", nargs="?", help="The job file to requeue, all of them when omitted")
+    requeue_parser.set_defaults(run=requeue)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        sys.exit(f"No job queue in {args.dir}")
+    args.run(args)
@@ -0,0 +1,235 @@
+import asyncio
+import json
+import os
+from collections import deque
+from fastapi.encoders import jsonable_encoder
+
+# New tweets kept for a connection that has not sent them yet, a connection that falls further behind is told to reload
+LIVE_QUEUE_SIZE = int(os.environ.get("LIVE_QUEUE_SIZE", "50"))
+# Open streams each worker accepts
+LIVE_MAX_CONNECTIONS = int(os.environ.get("LIVE_MAX_CONNECTIONS", "10000"))
+# Seconds between two keep-alive comments on an idle stream, which also notice clients that went away
+LIVE_HEARTBEAT = float(os.environ.get("LIVE_HEARTBEAT", "15"))
+# Optional Redis URL of a broker shared by all workers, for example redis://localhost:6379/0
+LIVE_REDIS_URL = os.environ.get("LIVE_REDIS_URL")
+
+LIVE_CHANNEL = "live:tweets"
+
+
+"""
+The new tweets waiting to be sent on one stream.
+
+An idle subscription holds an empty deque and nothing else, a waiter future only exists while the stream waits.
+
+Args:
+    author_ids (set): The IDs of the authors whose tweets the stream receives.
+    max_size (int): The most tweets kept before the subscription overflows.
+"""
+class Subscription:
+    __slots__ = ("author_ids", "pending", "max_size", "overflowed", "waiter", "closed")
+
+    def __init__(self, author_ids, max_size=LIVE_QUEUE_SIZE):
+        self.author_ids = author_ids
+        self.pending = deque()
+        self.max_size = max_size
+        self.overflowed = False
+        self.waiter = None
+        self.closed = False
+
+    """
+    Queues a tweet without waiting, so a slow stream never holds up the publisher. Once the queue is full the
+    subscription is marked as overflowed and stops queueing.
+    """
+    def put(self, tweet):
+        if self.overflowed:
+            return
+        if len(self.pending) >= self.max_size:
+            self.overflowed = True
+            self.pending.clear()
+        else:
+            self.pending.append(tweet)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    """
+    Waits until a tweet is queued or the subscription overflows.
+
+    Args:
+        timeout (float): The most seconds to wait.
+
+    Returns:
+        bool: True if there is something to send, False on timeout.
+    """
+    async def wait(self, timeout):
+        if self.pending or self.overflowed:
+            return True
+        self.waiter = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(self.waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiter = None
+
+"""
+Delivers new tweets to the open streams of the users following their author, within this process.
+"""
+class Broker:
+    def __init__(self):
+        # author_id -> the subscriptions that receive the author's tweets
+        self.subscribers = {}
+        self.connections = 0
+        # Called with every delivered tweet, whoever it is delivered to
+        self.listeners = []
+
+    def subscribe(self, author_ids):
+        subscription = Subscription(set(author_ids))
+        for author_id in subscription.author_ids:
+            self.subscribers.setdefault(author_id, set()).add(subscription)
+        self.connections += 1
+        return subscription
+
+    """
+    Subscribes to the tweets of some authors if the worker has fewer than LIVE_MAX_CONNECTIONS open streams. The
+    check and the subscription happen in one step, so streams opened at the same time cannot go over the limit.
+
+    Args:
+        author_ids (list): The IDs of the authors whose tweets are received.
+
+    Returns:
+        Subscription: The subscription, or None when the worker is full.
+    """
+    def try_subscribe(self, author_ids):
+        if self.connections >= LIVE_MAX_CONNECTIONS:
+            return None
+        return self.subscribe(author_ids)
+
+    """
+    Ends a subscription and frees its slot. Ending a subscription again does nothing.
+    """
+    def unsubscribe(self, subscription):
+        if subscription.closed:
+            return
+        subscription.closed = True
+        for author_id in subscription.author_ids:
+            subscribers = self.subscribers.get(author_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscribers[author_id]
+        self.connections -= 1
+
+    """
+    Ends a subscription once its response is over, as a background task of the response. This also frees the slot
+    of a stream whose client left before the stream started.
+    """
+    async def release(self, subscription):
+        self.unsubscribe(subscription)
+
+    """
+    Registers a function that is called with the author ID and the tweet of every tweet delivered to this process.
+    """
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def deliver(self, author_id, tweet):
+        for listener in self.listeners:
+            listener(author_id, tweet)
+        for subscription in self.subscribers.get(author_id, ()):
+            subscription.put(tweet)
+
+    """
+    Publishes a new tweet to the streams following its author.
+
+    Args:
+        author_id (str): The ID of the author.
+        tweet (dict): The tweet as it is shown in a timeline.
+    """
+    async def publish(self, author_id, tweet):
+        self.deliver(author_id, jsonable_encoder(tweet))
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+"""
+A broker that publishes through Redis, so the streams of every worker receive the tweets posted on any worker.
+The redis package is only needed when this broker is used.
+
+Args:
+    url (str): The Redis URL.
+"""
+class RedisBroker(Broker):
+    def __init__(self, url):
+        super().__init__()
+        import redis.asyncio
+        self.client = redis.asyncio.from_url(url)
+        self.listener = None
+
+    async def publish(self, author_id, tweet):
+        await self.client.publish(LIVE_CHANNEL, json.dumps({'author_id': author_id, 'tweet': jsonable_encoder(tweet)}))
+
+    async def start(self):
+        self.listener = asyncio.create_task(self.listen())
+
+    async def listen(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(LIVE_CHANNEL)
+        async for message in pubsub.listen():
+            published = json.loads(message["data"])
+            self.deliver(published['author_id'], published['tweet'])
+
+    async def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+        await self.client.aclose()
+
+"""
+Creates the broker, shared through Redis when LIVE_REDIS_URL is set.
+
+Returns:
+    Broker: The broker.
+"""
+def create_broker():
+    return RedisBroker(LIVE_REDIS_URL) if LIVE_REDIS_URL else Broker()
+
+def server_sent_event(event, data=None):
+    lines = [f"event: {event}"]
+    if data is not None:
+        lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+"""
+Streams the tweets of a subscription as server-sent events until the client goes away.
+
+Each new tweet is sent as a "tweet" event. A client that fell more than LIVE_QUEUE_SIZE tweets behind gets a
+"reload" event and the stream ends, it should reload the timeline rather than receive a partial one.
+
+The subscription ends with the stream. A stream that never starts does not end it, so the response should also
+release it once it is over.
+
+Args:
+    broker (Broker): The broker of the subscription.
+    subscription (Subscription): The subscription made for the stream.
+
+Yields:
+    str: The events.
+"""
+async def stream_events(broker, subscription):
+    try:
+        # Tells the client the stream is open, proxies may hold back the response headers until the first bytes
+        yield ": connected\n\n"
+        while True:
+            if not await subscription.wait(LIVE_HEARTBEAT):
+                yield ": ping\n\n"
+                continue
+            if subscription.overflowed:
+                yield server_sent_event("reload")
+                return
+            while subscription.pending:
+                yield server_sent_event("tweet", subscription.pending.popleft())
+    finally:
+        broker.unsubscribe(subscription)
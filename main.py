@@ -1,67 +1,292 @@
 from fastapi import FastAPI, File, Request, UploadFile, HTTPException, Depends, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-import google.oauth2.id_token
-from google.auth.transport import requests
-from google.cloud import firestore, storage
-from google.cloud.firestore_v1.base_query import FieldFilter
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response, StreamingResponse
 import starlette.status as status
 from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_303_SEE_OTHER
+from starlette.background import BackgroundTask
+from fastapi.encoders import jsonable_encoder
+from contextlib import asynccontextmanager
 from datetime import datetime
-import local_constants
+from functools import partial
+import asyncio
+import mimetypes
+import os
+import re
+import time
+from constants import MAIN_TEMPLATE, MAX_TWEET_LENGTH, UPDATE_PROFILE_TEMPLATE, USER_INFORMATION_TEMPLATE, AUTOCOMPLETE_LIMIT, MAX_AUTOCOMPLETE_LIMIT, MAX_UPLOAD_SIZE, USERNAME_PATTERN, TIMELINE_LENGTH, PROFILE_PAGE_SIZE, MAX_FEED_PAGE_SIZE
+from repository import create_repository
+import timeline
+import search_index
+import media
+from pagination import decode_cursor, merge_page
+from username_index import UsernameIndex
+from upload_limit import UploadSizeLimitMiddleware
+from admission import AdmissionControlMiddleware, default_budgets
+from assets import PrecompressedStaticFiles, StaticAssets
+from compression import CompressionMiddleware
+from streaming import StreamingTemplates
+from instrumented_repository import InstrumentedRepository
+from dataloader import RequestLoaders, RequestScopeMiddleware, request_loaders
+from profile_cache import CachedProfile, create_profile_cache
+from metrics import MetricsMiddleware, TimedTemplates, observe_datastore_call, observe_token_verification, render_metrics, warm_up_duration
+from datastore import run_blocking
+import profiling
+from profiling import ProfilingMiddleware
+import live
+import trending
+import jobs
+
+# Seconds to wait before trying a failed warm-up again
+WARM_UP_RETRY_DELAY = 5
 
-app = FastAPI()
 
-# Firebase and Firestore setup
-firestore_db = firestore.Client()
-firebase_request_adapter = requests.Request()
+"""
+Records a storage backend call in the metrics, and as a span when the request is traced.
+"""
+def observe_repository_call(name, args, start, seconds):
+    observe_datastore_call(name, args, start, seconds)
+    profiling.observe_call(name, args, start, seconds)
+
+"""
+Creates the storage backend selected by STORAGE_BACKEND, counting and timing the operations of each request.
+
+Returns:
+    InstrumentedRepository: The storage backend.
+"""
+def create_app_repository():
+    return InstrumentedRepository(create_repository(), observe=observe_repository_call)
+
+"""
+Creates the Firebase token verifier. google-auth's requests transport is slow to import, so it is only imported here.
+
+Returns:
+    FirebaseTokenVerifier: The token verifier.
+"""
+def create_token_verifier():
+    from google.auth.transport import requests
+    from token_cache import FirebaseTokenVerifier
+    return FirebaseTokenVerifier(requests.Request())
+
+"""
+Compiles every template ahead of the first render. This blocks on the disk.
+"""
+def compile_templates():
+    for name in templates.env.list_templates():
+        templates.env.get_template(name)
+    page_templates.compile()
+
+"""
+Gets the app ready for its first requests without holding up startup: opens the storage backend connections,
+fetches the Firebase certs, compiles the templates, builds the static assets, imports Pillow and loads the username
+index. Requests that arrive in the meantime are served, only more slowly, and /ready reports the app as ready once
+this is done.
+"""
+async def warm_up():
+    global ready
+    start = time.perf_counter()
+    while True:
+        try:
+            await asyncio.gather(
+                repository.warm_up(),
+                firebase_token_verifier.warm_up(),
+                run_blocking(compile_templates),
+                run_blocking(static_assets.load),
+                run_blocking(media.warm_up),
+                load_username_index()
+            )
+            break
+        except Exception as err:
+            print(f"Warm-up failed, retrying in {WARM_UP_RETRY_DELAY}s: {err}")
+            await asyncio.sleep(WARM_UP_RETRY_DELAY)
+
+    warm_up_duration.set(time.perf_counter() - start)
+    ready = True
+
+"""
+Loads the username index and starts listening for username changes made by other workers.
+"""
+async def load_username_index():
+    if not username_index.loaded:
+        await username_index.load(repository)
+        username_index.listen(repository, asyncio.get_running_loop())
+
+"""
+Creates the shared clients when the app starts and closes them when it stops.
+
+Clients that were set on the module beforehand, for example by a benchmark that drives the app in-process, are
+kept. The warm-up runs in the background so the app starts accepting requests straight away.
+"""
+@asynccontextmanager
+async def lifespan(app):
+    global repository, firebase_token_verifier, profile_cache, broker, job_queue
+    if repository is None:
+        repository = create_app_repository()
+    if firebase_token_verifier is None:
+        firebase_token_verifier = create_token_verifier()
+    profile_cache = create_profile_cache()
+    broker = live.create_broker()
+    broker.add_listener(trending_topics.add_tweet)
+    await broker.start()
+    profiling.install()
+    job_queue = jobs.create_job_queue()
+    await job_queue.start()
+
+    warm_up_task = asyncio.create_task(warm_up())
+    try:
+        yield
+    finally:
+        warm_up_task.cancel()
+        username_index.stop()
+        # The jobs still use the other clients
+        await job_queue.close()
+        await asyncio.gather(repository.close(), profile_cache.close(), broker.close())
 
-# Constants
-USER_COLLECTION = "User"
-TWEET_COLLECTION = 'Tweet'
+"""
+Finds the user a session token was verified for, from the tokens the verifier already holds. Used to rate-limit
+signed-in users by who they are, without verifying tokens before the limits apply.
 
-MAIN_TEMPLATE = "main.html"
-UPDATE_PROFILE_TEMPLATE = "update_profile.html"
-USER_INFORMATION_TEMPLATE = "user_information.html"
+Args:
+    id_token (str): The Firebase ID token.
+
+Returns:
+    str or None: The user ID, or None if the token has not been verified yet.
+"""
+def verified_token_user(id_token):
+    claims = firebase_token_verifier.cached(id_token) if firebase_token_verifier is not None else None
+    return get_user(claims) if claims else None
+
+app = FastAPI(lifespan=lifespan)
+
+# Reject oversized uploads while they stream in
+app.add_middleware(UploadSizeLimitMiddleware, max_body_size=MAX_UPLOAD_SIZE)
+# Concurrency and rate limits of the expensive routes, inside the metrics so rejected requests are recorded
+app.add_middleware(AdmissionControlMiddleware, routes=app.routes, budgets=default_budgets(), verified_user=verified_token_user)
+# Compression of text responses that flushes streamed pages as they are rendered
+app.add_middleware(CompressionMiddleware)
+# Per-route latency and datastore call metrics, inside the request scope so they can read its counter
+app.add_middleware(MetricsMiddleware)
+# Per-request datastore loaders and read counter
+app.add_middleware(RequestScopeMiddleware, get_repository=lambda: repository)
+# Opt-in traces of single requests, around everything else
+app.add_middleware(ProfilingMiddleware)
+
+# Storage backend and Firebase token verifier, created in the lifespan
+repository = None
+firebase_token_verifier = None
+
+# Whether the warm-up has finished
+ready = False
 
 # Mount static directory
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", PrecompressedStaticFiles(directory="static"), name="static")
 
 # Templating
-templates = Jinja2Templates(directory="templates")
+templates = TimedTemplates(directory="templates")
+
+# Fingerprinted URLs of the static files, linked with static_url() in the templates
+static_assets = StaticAssets()
+templates.env.globals["static_url"] = static_assets.url
 
+# The same templates rendered while they are sent, for the pages that wait on the storage backend
+page_templates = StreamingTemplates(templates)
+
+# In-memory username index
+username_index = UsernameIndex()
+
+# Hashtags and mentions of the tweets posted over the last TRENDING_WINDOW seconds
+trending_topics = trending.Trending()
+
+# Viewer-independent part of the profile pages, created in the lifespan
+profile_cache = None
+
+# Pushes new tweets to the open timeline streams, created in the lifespan
+broker = None
+
+# Runs the side effects of writes in the background, created in the lifespan
+job_queue = None
 
 """
-A function that retrieves a user's document from the Firestore database based on the provided user token.
+A function that retrieves the ID of a user's document based on the provided user token.
 
 Args:
     user_token (dict): A dictionary containing the user's ID.
 
 Returns:
-    firestore.DocumentReference: The reference to the user's document in the Firestore database.
+    str: The ID of the user's document in the storage backend.
 """
 def get_user(user_token):
-    user = firestore_db.collection(USER_COLLECTION).document(user_token['user_id'])
+    user = user_token['user_id']
     return user
 
+"""
+Retrieves a user's document by username.
+
+The username is resolved to a user ID from the in-memory username index, so the lookup is a single document get.
+Until the index has loaded, the username is queried instead.
+
+Args:
+    username (str): The username of the user.
+
+Returns:
+    dict or None: The user's document, or None if no user has that username.
+"""
+async def get_user_doc_by_username(username):
+    if not username_index.loaded:
+        return await loaders().usernames.load(username)
+
+    uid = username_index.resolve(username)
+    if uid is None:
+        return None
+
+    return await get_user_doc(uid)
+
+"""
+Returns the datastore loaders of the current request.
+
+Reads made through the loaders in the same turn of the event loop are deduplicated and sent as one batched read.
+
+Returns:
+    RequestLoaders: The loaders of the request, or fresh loaders outside of a request.
+"""
+def loaders():
+    return request_loaders.get() or RequestLoaders(repository)
+
+"""
+Retrieves a user's document by ID through the request's loaders.
+
+Args:
+    uid (str): The ID of the user, may be None when nobody is signed in.
+
+Returns:
+    dict or None: The user's document, or None if there is no such user.
+"""
+async def get_user_doc(uid):
+    if not uid:
+        return None
+    return await loaders().users.load(uid)
+
 """
 Validates a Firebase ID token.
 
+Tokens that were already verified are served from the token cache, new tokens are verified against the cached Firebase certs.
+
 Args:
     id_token (str): The Firebase ID token to be validated.
 
 Returns:
     dict or None: The decoded token if it is valid, None otherwise.
 """
-def validate_firebase_token(id_token):
+async def validate_firebase_token(id_token):
     if not id_token:
         return None
+    start = time.perf_counter()
     try:
-        return google.oauth2.id_token.verify_firebase_token(id_token, firebase_request_adapter)
+        claims = await firebase_token_verifier.verify(id_token)
     except ValueError as err:
+        observe_token_verification("invalid", time.perf_counter() - start)
         print(str(err))
         return None
+    observe_token_verification("valid", time.perf_counter() - start)
+    return claims
 
 """
 Get the current user based on the request object.
@@ -70,14 +295,14 @@ Parameters:
     - request (Request): The request object containing user information.
 
 Returns:
-    - Tuple: A tuple containing the user object and the user token.
+    - Tuple: A tuple containing the user's ID and the user token.
 """ 
-def get_current_user(request: Request):
+async def get_current_user(request: Request):
     id_token = request.cookies.get("token")
     user_token = None
     user = None
 
-    user_token = validate_firebase_token(id_token)
+    user_token = await validate_firebase_token(id_token)
     if not user_token:
         return None, None
 
@@ -92,29 +317,86 @@ This function is a route handler for the root URL ("/") of the application. It h
 
 Parameters:
     - request (Request): The incoming request object.
+    - cursor (str, optional): The cursor of the timeline page to show, from the previous page.
 
 Returns:
-    - TemplateResponse: The rendered HTML template for the root page.
+    - StreamingResponse: The root page, sent while the timeline is read.
 """
 @app.get("/", response_class=HTMLResponse)
-async def root(request: Request):
+async def root(request: Request, cursor: str = None):
     error_message = "No error here"
+    before = parse_cursor(cursor)
 
-    user, user_token = get_current_user(request)
+    user, user_token = await get_current_user(request)
 
     if user is None:
-        return templates.TemplateResponse("main.html", {"request": request, 'user_token': None, 'error_message': None, 'user_info': None})
+        return page_templates.TemplateResponse(MAIN_TEMPLATE, {"request": request, 'user_token': None, 'error_message': None, 'user_info': None})
     
-    user_doc = user.get()
+    user_info = await get_user_doc(user)
 
-    if not user_doc.exists:
+    if not user_info:
        return RedirectResponse("/set_username", status_code=status.HTTP_303_SEE_OTHER)
 
-    user_info = user_doc.to_dict()
+    # Read while the page is sent, after the page shell and the compose form
+    timeline_tweets = timeline.stream_timeline(repository, user_info, TIMELINE_LENGTH, before)
 
-    timeline_tweets = get_timeline_tweets_by_chronological_order(user, user_info)
+    # Only the newest page of the timeline receives new tweets as they are posted
+    return page_templates.TemplateResponse(MAIN_TEMPLATE, {"request": request, 'user_token': user_token, 'error_message': error_message, 'user_info': user_info, "timeline_tweets": timeline_tweets, "live": before is None, "trending": trending_topics.top()})
+
+"""
+Streams the new tweets of the accounts the current user follows, and of the user themselves, as server-sent events.
+
+The accounts followed are read once when the stream opens, a stream picks up follows made later when it reconnects.
+
+Parameters:
+    - request (Request): The incoming request object.
+
+Returns:
+    - StreamingResponse: The text/event-stream of new tweets.
+
+Raises:
+    - HTTPException: If the user is not signed in, or the worker already has LIVE_MAX_CONNECTIONS open streams.
+"""
+@app.get("/timeline/stream")
+async def timeline_stream(request: Request):
+    user, _ = await get_current_user(request)
+    if not await get_user_doc(user):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized")
 
-    return templates.TemplateResponse("main.html", {"request": request, 'user_token': user_token, 'error_message': error_message, 'user_info': user_info, "timeline_tweets": timeline_tweets})
+    author_ids = [user, *await repository.following_ids(user)]
+    subscription = broker.try_subscribe(author_ids)
+    if subscription is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many open streams", headers={"Retry-After": "30"})
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(live.stream_events(broker, subscription), media_type="text/event-stream", headers=headers,
+                             background=BackgroundTask(broker.release, subscription))
+
+"""
+Returns the trending hashtags and mentions of the tweets posted over the last TRENDING_WINDOW seconds.
+
+Counts are kept in memory as tweets are posted, so this reads nothing from the storage backend.
+
+Parameters:
+    - limit (int, optional): The topics per kind, capped at TRENDING_CANDIDATES.
+
+Returns:
+    - JSONResponse: The hashtags and the mentions, each a list of topics with their count, highest count first.
+"""
+@app.get("/trending")
+async def trending_endpoint(limit: int = trending.TRENDING_TOP):
+    limit = max(1, min(limit, trending.TRENDING_CANDIDATES))
+    return JSONResponse(trending_topics.top(limit), headers={"Cache-Control": "public, max-age=30"})
+
+"""
+Checks the length of a tweet the way the tweet form does, which counts a line break as one character although it
+is sent as two.
+
+Raises:
+    HTTPException: If the tweet is longer than MAX_TWEET_LENGTH.
+"""
+def check_tweet_length(tweet):
+    if len(tweet.replace("\r\n", "\n")) > MAX_TWEET_LENGTH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Tweets can have at most {MAX_TWEET_LENGTH} characters")
 
 """
 Handles the POST request to add a new tweet.
@@ -129,6 +411,7 @@ Returns:
 
 Raises:
     RedirectResponse: If the user does not exist, redirects to the set_username page.
+    HTTPException: If the tweet is longer than MAX_TWEET_LENGTH.
 
 Side Effects:
     Updates the tweet data in the database.
@@ -136,29 +419,154 @@ Side Effects:
 """
 @app.post("/tweet")
 async def add_tweet(request: Request, tweet: str = Form(...), image: UploadFile = File(...)):
-    user, user_token = get_current_user(request)
-    user_doc = user.get() 
+    user, user_token = await get_current_user(request)
+    user_info = await get_user_doc(user)
 
-    if not user_doc.exists:
+    if not user_info:
         return RedirectResponse("/set_username", status_code=status.HTTP_303_SEE_OTHER)
+    check_tweet_length(tweet)
 
-    image_url = ""
+    images, staged_image = {}, None
     if image and image.filename:
-        image_url = await upload_file_handler(image)
+        images, staged_image = await upload_file_handler(image)
 
-    username = user_doc.to_dict()['username']
+    username = user_info['username']
 
     tweet_data = {
         'name': tweet,
         'username': username,
         'date': datetime.now(),
-        'image_url': image_url
+        'image_url': images.get('image_url', ''),
+        'image_feed_url': images.get('image_feed_url', ''),
+        'image_thumbnail_url': images.get('image_thumbnail_url', '')
     }
-    tweet_ref = firestore_db.collection(USER_COLLECTION).document(user_token['user_id']).collection(TWEET_COLLECTION).document()
-    tweet_ref.set(tweet_data)
+    tweet_id = await repository.add_tweet(user, tweet_data)
+
+    # The timelines, the search index and the open timeline streams are updated in the background
+    await asyncio.gather(
+        job_queue.enqueue("tweet_posted", tweet_id, author_id=user, tweet_id=tweet_id),
+        profile_cache.invalidate(username)
+    )
+    # So are the resized variants of a new image
+    if staged_image:
+        await job_queue.enqueue("store_image", tweet_id, path=staged_image, author_id=user, tweet_id=tweet_id)
 
     return RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
 
+"""
+Pushes a new tweet into the timelines of its author and their followers, indexes it for search, then publishes it
+to the open timeline streams, once it is in the timelines a reload would read.
+
+The tweet is read again so the job works from its current state, and skipped if it was deleted in the meantime.
+The jobs of one tweet run one at a time in the order they were queued, so an edit or a delete made while this job
+runs is applied by its own job once this one is done. The tweet is read once more before it is published, so the
+streams get its latest text and a deleted tweet is not published.
+
+Args:
+    author_id (str): The ID of the author.
+    tweet_id (str): The ID of the new tweet.
+"""
+@jobs.job("tweet_posted")
+async def tweet_posted(author_id, tweet_id):
+    author, tweet_data = await asyncio.gather(repository.get_user(author_id), repository.get_tweet(author_id, tweet_id))
+    if not author or not tweet_data:
+        return
+
+    await asyncio.gather(
+        timeline.fan_out_tweet(repository, author, tweet_id, tweet_data),
+        search_index.index_tweet(repository, author_id, tweet_id, tweet_data)
+    )
+    tweet_data = await repository.get_tweet(author_id, tweet_id)
+    if tweet_data:
+        await broker.publish(author_id, {'id': tweet_id, **timeline.timeline_entry(tweet_id, author_id, tweet_data)})
+
+"""
+Updates the timeline copies and the search index of an edited tweet from the tweet as it is stored now.
+
+Args:
+    author_id (str): The ID of the author.
+    tweet_id (str): The ID of the edited tweet.
+    previous_name (str, optional): Unused, the index keeps the terms of every tweet. Jobs queued before that still
+        carry it.
+"""
+@jobs.job("tweet_edited")
+async def tweet_edited(author_id, tweet_id, previous_name=None):
+    tweet_data = await repository.get_tweet(author_id, tweet_id)
+    if not tweet_data:
+        return
+
+    await asyncio.gather(
+        timeline.update_tweet_copies(repository, tweet_id, {'name': tweet_data.get('name'), 'image_url': tweet_data.get('image_url')}),
+        search_index.index_tweet(repository, author_id, tweet_id, tweet_data)
+    )
+
+"""
+Removes the timeline copies and the search postings of a deleted tweet.
+
+Args:
+    tweet_id (str): The ID of the deleted tweet.
+    name (str, optional): Unused, the index keeps the terms of every tweet. Jobs queued before that still carry it.
+"""
+@jobs.job("tweet_deleted")
+async def tweet_deleted(tweet_id, name=None):
+    await asyncio.gather(
+        timeline.delete_tweet_copies(repository, tweet_id),
+        search_index.remove_tweet(repository, tweet_id)
+    )
+
+"""
+Copies the latest tweets of a user who is no longer a celebrity into their followers' timelines, which stop pulling
+them on read. Does nothing if the user is still a celebrity.
+
+Args:
+    uid (str): The ID of the user.
+"""
+@jobs.job("celebrity_demoted")
+async def celebrity_demoted(uid):
+    user = await repository.get_user(uid)
+    if user and not user.get('celebrity'):
+        await timeline.backfill_followers(repository, user)
+
+"""
+Stores the resized variants of a staged image upload, then removes the staged copy.
+
+Args:
+    path (str): The staged file.
+    author_id (str, optional): The ID of the author of the tweet that shows the image.
+    tweet_id (str, optional): The ID of that tweet. Jobs queued before tweets were passed in carry neither.
+"""
+@jobs.job("store_image")
+async def store_staged_image(path, author_id=None, tweet_id=None):
+    # Gone when an earlier attempt, or the job of another tweet with the same image, stored the variants
+    if not os.path.exists(path):
+        return
+
+    with open(path, "rb") as image:
+        await media.store_variants(repository, image)
+    os.remove(path)
+
+"""
+Takes the variant URLs off a tweet whose image variants could not be stored, so it shows the original image, which
+is stored before the tweet is created, instead of broken ones.
+
+Args:
+    path (str): The staged file, kept for a requeue of the job.
+    author_id (str, optional): The ID of the author of the tweet.
+    tweet_id (str, optional): The ID of the tweet.
+"""
+@jobs.dead_letter("store_image")
+async def image_variants_lost(path, author_id=None, tweet_id=None):
+    tweet_data = await repository.get_tweet(author_id, tweet_id) if tweet_id else None
+    if not tweet_data:
+        return
+
+    fields = {'image_feed_url': "", 'image_thumbnail_url': ""}
+    await repository.update_tweet(author_id, tweet_id, fields)
+    await asyncio.gather(
+        timeline.update_tweet_copies(repository, tweet_id, fields),
+        profile_cache.invalidate(tweet_data.get('username'))
+    )
+
 """
 A route handler for the "/set_username" endpoint.
 
@@ -183,22 +591,36 @@ Parameters:
     - prefix (str): The prefix to search for in the username.
 
 Returns:
-    - TemplateResponse: The rendered HTML template with the search results.
+    - StreamingResponse: The main page with the search results, sent while the timeline is read.
 """
 @app.post("/search_username")
 async def search_username(request: Request, name: str = Form(...)):
     error_message = "No error here"
-    user, user_token = get_current_user(request)
-    user_info = user.get().to_dict()
+    user, user_token = await get_current_user(request)
+    user_info = await get_user_doc(user)
 
     # Search for users that start with the given prefix
-    user_query = firestore_db.collection(USER_COLLECTION).where(filter=FieldFilter('username', '>=', name)).where(filter=FieldFilter('username', '<', name + u'\uf8ff')).limit(10)
-    users = [doc.to_dict() for doc in user_query.stream()]
+    users = [{'username': username} for username in username_index.search_prefix(name, 10)]
 
-    # Get the timeline tweets by chronological order
-    timeline_tweets = get_timeline_tweets_by_chronological_order(user, user_info)
+    # Get the timeline tweets by chronological order, while the page is sent
+    timeline_tweets = timeline.stream_timeline(repository, user_info)
 
-    return templates.TemplateResponse(MAIN_TEMPLATE, {"request": request, 'user_token': user_token, 'error_message': error_message, 'user_info': user_info, 'users_found': users, "name": name, "timeline_tweets": timeline_tweets})
+    return page_templates.TemplateResponse(MAIN_TEMPLATE, {"request": request, 'user_token': user_token, 'error_message': error_message, 'user_info': user_info, 'users_found': users, "name": name, "timeline_tweets": timeline_tweets})
+
+"""
+Autocomplete usernames that start with the given prefix.
+
+Parameters:
+    - prefix (str): The prefix to search for in the username.
+    - limit (int, optional): The maximum number of usernames to return, capped at MAX_AUTOCOMPLETE_LIMIT.
+
+Returns:
+    - JSONResponse: The matching usernames in alphabetical order.
+"""
+@app.get("/autocomplete")
+async def autocomplete(prefix: str, limit: int = AUTOCOMPLETE_LIMIT):
+    limit = max(1, min(limit, MAX_AUTOCOMPLETE_LIMIT))
+    return JSONResponse({"usernames": username_index.search_prefix(prefix, limit)})
 
 """
 Save the provided username for the current user.
@@ -206,7 +628,8 @@ Parameters:
     - request (Request): The HTTP request object.
     - username (str): The username to be saved.
 Returns:
-    - RedirectResponse: A redirect response to the home page.
+    - RedirectResponse: A redirect response to the home page, or the form again with a message if the username is
+      invalid or taken.
 Raises:
     - HTTPException: If the user is not authorized.
 Example Usage:
@@ -217,53 +640,44 @@ Example Usage:
 @app.post("/save_username", response_class=RedirectResponse)
 async def save_username(request: Request, username: str = Form(...)):
     id_token = request.cookies.get("token")
-    user_token = validate_firebase_token(id_token)
+    user_token = await validate_firebase_token(id_token)
     if not user_token:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized")
     
-    # Check if the username is already taken
-    user_ref = firestore_db.collection(USER_COLLECTION).where("username", "==", username).stream()
-    if any(user.exists for user in user_ref):
-        return templates.TemplateResponse(UPDATE_PROFILE_TEMPLATE, {"request": request, "message": "Username already taken"})
+    user = get_user(user_token)
 
-    user_ref = firestore_db.collection(USER_COLLECTION).document(user_token['user_id'])
+    if not re.fullmatch(USERNAME_PATTERN, username):
+        return templates.TemplateResponse(UPDATE_PROFILE_TEMPLATE, {"request": request, "message": "Usernames can only have up to 30 letters, digits and underscores"})
 
-    if not user_ref.get().exists:
-        user_data = {
-            'username': username
-        }
-        user_ref.set(user_data)
+    if not await get_user_doc(user):
+        # The reservation and the user document are written in one transaction, so two users cannot claim the same username
+        if not await repository.claim_username(user, username):
+            return templates.TemplateResponse(UPDATE_PROFILE_TEMPLATE, {"request": request, "message": "Username already taken"})
+        username_index.add(username, user)
 
     return RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
 
 """
-Retrieves tweets from the database that match the given search words.
+Retrieves tweets from the database that contain all of the given search words, newest first.
+
+The words are looked up in the search index, so the cost does not grow with the number of users.
 
 Parameters:
     - request (Request): The request object for the HTTP request.
     - words (str): The search words to match against the tweet names.
 
 Returns:
-    - TemplateResponse: The rendered HTML template with the search results, including the request, user token, user information, search words, and found tweets.
+    - StreamingResponse: The main page with the found tweets, sent while the search runs.
 """
 @app.post("/search_tweets")
 async def search_tweets(request: Request, words: str = Form(...)):
-    tweets_found = []
-    
-    user, user_token = get_current_user(request)
-    user_info = user.get().to_dict()
-
-    users = firestore_db.collection(USER_COLLECTION).stream()
+    user, user_token = await get_current_user(request)
+    user_info = await get_user_doc(user)
 
-    for user in users:
-        user_id = user.id
+    # Searched while the page is sent, the template calls it where the results go
+    found_tweets = partial(search_index.search, repository, words)
 
-        # Search for tweets that start with the given prefix
-        tweets_query = firestore_db.collection(USER_COLLECTION).document(user_id).collection(TWEET_COLLECTION).where(filter=FieldFilter('name', '>=', words)).where(filter=FieldFilter('name', '<=', words + '\uf8ff')).stream()
-        # Get the timeline tweets by chronological order
-        tweets_found.extend([doc.to_dict() for doc in tweets_query])
-
-    return templates.TemplateResponse(MAIN_TEMPLATE, {"request": request, 'user_token': user_token, 'user_info': user_info, "words": words, 'tweets': tweets_found})
+    return page_templates.TemplateResponse(MAIN_TEMPLATE, {"request": request, 'user_token': user_token, 'user_info': user_info, "words": words, 'tweets': found_tweets})
 
 """
 Retrieves the profile information of a user with the given username.
@@ -271,6 +685,7 @@ Retrieves the profile information of a user with the given username.
 Parameters:
     - request (Request): The request object for the HTTP request.
     - username (str): The username of the target user.
+    - cursor (str, optional): The cursor of the page of tweets to show, from the previous page.
 
 Returns:
     - TemplateResponse: The rendered HTML template with the user's profile information, including their tweets and follower status.
@@ -279,34 +694,69 @@ Raises:
     - HTTPException: If the user with the given username is not found.
 """
 @app.get("/profile/{username}", response_class=HTMLResponse)
-async def set_username(request: Request, username: str):
-    user_docs = firestore_db.collection(USER_COLLECTION).where('username', '==', username).limit(1).get()
-    if not user_docs:
+async def set_username(request: Request, username: str, cursor: str = None):
+    before = parse_cursor(cursor)
+    user, _ = await get_current_user(request)
+
+    # The first page is the same for every viewer and served from the profile cache, older pages are read directly
+    load = partial(load_profile, username, before)
+    profile, current_user_info = await asyncio.gather(
+        profile_cache.get(username, load) if before is None else load(),
+        get_user_doc(user)
+    )
+    if not profile:
         raise HTTPException(status_code=404, detail="User not found")
 
-    user_doc = user_docs[0]
+    # Only the follow button depends on the viewer, check the follow edge with a point lookup
+    is_following_user = await repository.is_following(user, profile.user_info['id']) if current_user_info else True
+
+    etag = f'W/"{profile.etag}-{int(is_following_user)}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Cookie"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return templates.TemplateResponse(USER_INFORMATION_TEMPLATE, {"request": request, "user_info": profile.user_info, "tweets": profile.tweets, "is_following_user": is_following_user, 'username': username, "next_cursor": profile.next_cursor}, headers=headers)
 
-    # Get the user's tweets
-    tweets_query = user_doc.reference.collection(TWEET_COLLECTION).order_by('date', direction='DESCENDING').limit(10).stream()
-    tweets = [tweet.to_dict() for tweet in tweets_query]
+"""
+Checks an If-None-Match header against an ETag with the weak comparison, which ignores the W/ prefix.
+
+Parameters:
+    - if_none_match (str): The header, a comma-separated list of ETags or *, or None.
+    - etag (str): The current ETag of the resource.
 
-    is_following_user = True
-    user_info = user_doc.to_dict()
+Returns:
+    - bool: True if the client's copy is current.
+"""
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    opaque_tag = etag.strip().removeprefix("W/")
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == opaque_tag:
+            return True
+    return False
 
-    user, _ = get_current_user(request)
+"""
+Reads the part of a profile page that is the same for every viewer.
 
-    if user:
-        current_user_doc = user.get()
+Parameters:
+    - username (str): The username of the user.
+    - before (tuple): The (date, id) position the page of tweets starts after, None for the newest page.
 
-        if current_user_doc.exists:
-            current_username = current_user_doc.get('username')
-            target_user_followers = user_doc.to_dict().get('followers', [])
-            is_following_user = current_username in target_user_followers
+Returns:
+    - CachedProfile or None: The user's document and page of tweets, or None if the user is not found.
+"""
+async def load_profile(username, before):
+    user_info = await get_user_doc_by_username(username)
+    if not user_info:
+        return None
 
-    return templates.TemplateResponse(USER_INFORMATION_TEMPLATE, {"request": request, "user_info": user_info, "tweets": tweets, "is_following_user": is_following_user, 'username': username})
+    tweets, next_cursor = await merge_page([partial(repository.latest_tweets, user_info['id'])], PROFILE_PAGE_SIZE, before)
+    return CachedProfile(user_info, tweets, next_cursor)
 
 """
-Function to follow a user. Checks if the current user can follow the target user, updates followers list accordingly,
+Function to follow a user. Checks if the current user can follow the target user, stores the follow edge,
 and redirects to the profile of the target user. 
 
 Parameters:
@@ -320,38 +770,31 @@ Returns:
 """
 @app.post("/follow/{username}")
 async def follow(request: Request, username: str):
-    user, _ = get_current_user(request)
-    
-    user = user.get()
-    current_username = user.to_dict().get('username')
+    user, _ = await get_current_user(request)
+
+    # Both users are read in one batched get
+    user, target_user = await asyncio.gather(get_user_doc(user), get_user_doc_by_username(username))
+    current_username = user.get('username')
 
     if current_username == username:
         raise HTTPException(status_code=400, detail="Bad Request: Cannot follow yourself")
 
     # Check if the target user exists
-    target_users = firestore_db.collection(USER_COLLECTION).where(filter=FieldFilter('username', '==', username)).limit(1).get()
-    if not target_users:
+    if not target_user:
         raise HTTPException(status_code=404, detail="Not Found: Target user not found")
 
-    target_user = target_users[0]
-
-    # Update the followers list
-    target_user_ref = target_user.reference
-    target_user_followers = target_user.to_dict().get('followers', [])
-    if current_username not in target_user_followers:
-        target_user_followers.append(current_username)
-        target_user_ref.update({"followers": target_user_followers})
-
-    # Update the following list
-    current_user_following = user.to_dict().get('following', [])
-    if username not in current_user_following:
-        current_user_following.append(username)
-        user.reference.update({"following": current_user_following})
+    # Store the follow edge and update the follower counts
+    if await repository.follow(user, target_user):
+        # Copy the target user's latest tweets into the current user's timeline, the counts of both profiles changed
+        await asyncio.gather(
+            timeline.backfill_timeline(repository, user, target_user),
+            profile_cache.invalidate(current_username, username)
+        )
 
     return RedirectResponse(url=f"/profile/{username}", status_code=status.HTTP_303_SEE_OTHER)
 
 """
-A function that handles the unfollow action for a user. It checks if the current user can unfollow the target user, updates the followers and following lists accordingly, and redirects to the target user's profile.
+A function that handles the unfollow action for a user. It checks if the current user can unfollow the target user, removes the follow edge, and redirects to the target user's profile.
 
 Args:
     request: The request object.
@@ -362,64 +805,100 @@ Returns:
 """
 @app.post("/unfollow/{username}")
 async def unfollow_user(request: Request, username: str):
-    user, _ = get_current_user(request)
-    
-    current_user_doc = user.get()
-    current_username = current_user_doc.to_dict().get('username')
+    user, _ = await get_current_user(request)
+
+    # Both users are read in one batched get
+    current_user_doc, target_user_doc = await asyncio.gather(get_user_doc(user), get_user_doc_by_username(username))
+    current_username = current_user_doc.get('username')
 
     if current_username == username:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad Request: Cannot follow yourself")
 
-    target_user_ref = firestore_db.collection(USER_COLLECTION).where(filter=FieldFilter('username', '==', username)).limit(1).get()
-    if not target_user_ref:
+    if not target_user_doc:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Target user not found")
 
-    target_user_doc = target_user_ref[0]
-
-    # Update the followers list
-    target_user_followers = target_user_doc.to_dict().get('followers', [])
-    if current_username in target_user_followers:
-        target_user_followers.remove(current_username)
-        target_user_doc.reference.update({"followers": target_user_followers})
-
-    # Update the following list
-    current_user_following = current_user_doc.to_dict().get('following', [])
-    if username in current_user_following:
-        current_user_following.remove(username)
-        current_user_doc.reference.update({"following": current_user_following})
+    # Remove the follow edge and update the follower counts
+    if await repository.unfollow(current_user_doc, target_user_doc):
+        # Remove the target user's tweets from the current user's timeline, the counts of both profiles changed
+        await asyncio.gather(
+            timeline.prune_timeline(repository, current_user_doc, target_user_doc['id']),
+            profile_cache.invalidate(current_username, username)
+        )
+        if target_user_doc.get('celebrity'):
+            # The unfollow may have ended the target's celebrity, the job checks
+            await job_queue.enqueue("celebrity_demoted", target_user_doc['id'], uid=target_user_doc['id'])
 
     return RedirectResponse(url=f"/profile/{username}", status_code=status.HTTP_303_SEE_OTHER)
 
 """
-A function that retrieves timeline tweets by chronological order for a given user.
+A function that retrieves one page of timeline tweets by chronological order for a given user.
+
+The timeline is read from the user's materialized Timeline collection, which is kept up to date when tweets are
+added, edited or deleted and when users are followed or unfollowed.
 
 Args:
-    user: The user object for whom the timeline tweets are fetched.
-    user_info: Information about the user, including following list.
+    user: The ID of the user for whom the timeline tweets are fetched.
+    user_info: Information about the user.
+    before (tuple, optional): The (date, id) position the page starts after, None for the newest page.
+    limit (int, optional): The number of tweets per page.
 
 Returns:
-    List: A list of timeline tweets sorted by date in descending order.
+    Tuple: The timeline tweets sorted by date in descending order, and the cursor of the next page or None.
 """
-def get_timeline_tweets_by_chronological_order(user, user_info):
-    following_list = user_info.get('following', [])
-    tweets = []
+async def get_timeline_tweets_by_chronological_order(user, user_info, before=None, limit=TIMELINE_LENGTH):
+    return await timeline.read_timeline(repository, user_info, limit, before)
 
-    # Get the timeline tweets from each user in the following list
-    for username in following_list:
-        user_docs = firestore_db.collection(USER_COLLECTION).where(filter=FieldFilter('username', '==', username)).get()
-        for user_doc in user_docs:
-            user_tweets_query = user_doc.reference.collection(TWEET_COLLECTION).order_by('date', direction='DESCENDING').limit(20).stream()
-            user_tweets = [{"id": tweet.id, **tweet.to_dict()} for tweet in user_tweets_query]
-            tweets.extend(user_tweets)
+"""
+Reads a page cursor from the query string.
 
-    # Get the timeline tweets from the current user
-    user_tweets = user.collection(TWEET_COLLECTION).order_by('date', direction='DESCENDING').limit(20).stream()
-    available_tweets = [{"id": tweet.id, **tweet.to_dict()} for tweet in user_tweets]
-    tweets.extend(available_tweets)
+Parameters:
+    - cursor (str): The cursor, or None for the first page.
 
-    # Sort the tweets by date
-    timeline_tweets = sorted(tweets, key=lambda x: x['date'], reverse=True)[:20]
-    return timeline_tweets
+Returns:
+    - tuple or None: The (date, id) position the page starts after.
+
+Raises:
+    - HTTPException: If the cursor is malformed.
+"""
+def parse_cursor(cursor):
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+"""
+Returns one page of tweets as JSON, from the current user's home timeline or from the profile of a user.
+
+Parameters:
+    - request (Request): The request object.
+    - cursor (str, optional): The next_cursor of the previous page.
+    - limit (int, optional): The number of tweets per page, capped at MAX_FEED_PAGE_SIZE.
+    - username (str, optional): Page through this user's tweets instead of the home timeline.
+
+Returns:
+    - JSONResponse: The tweets newest first and the cursor of the next page, null on the last page.
+
+Raises:
+    - HTTPException: If the cursor is malformed, the user is not signed in for the home timeline or the user is not found.
+"""
+@app.get("/feed")
+async def feed(request: Request, cursor: str = None, limit: int = TIMELINE_LENGTH, username: str = None):
+    before = parse_cursor(cursor)
+    limit = max(1, min(limit, MAX_FEED_PAGE_SIZE))
+
+    if username:
+        user_info = await get_user_doc_by_username(username)
+        if not user_info:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        tweets, next_cursor = await merge_page([partial(repository.latest_tweets, user_info['id'])], limit, before)
+    else:
+        user, _ = await get_current_user(request)
+        user_info = await get_user_doc(user)
+        if not user_info:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized")
+        tweets, next_cursor = await get_timeline_tweets_by_chronological_order(user, user_info, before, limit)
+
+    return JSONResponse({"tweets": jsonable_encoder(tweets), "next_cursor": next_cursor})
 
 """
 Handles the GET request to edit a tweet.
@@ -440,7 +919,7 @@ Side Effects:
 """
 @app.get("/edit/{tweet_id}", response_class=HTMLResponse)
 async def edit_tweet_page(request: Request, tweet_id: str):
-    user, user_token = get_current_user(request)
+    user, user_token = await get_current_user(request)
     message = request.query_params.get("message", "")
 
     if not user_token:
@@ -470,6 +949,7 @@ Returns:
 
 Raises:
     RedirectResponse: If the user is not authenticated.
+    HTTPException: If the tweet is longer than MAX_TWEET_LENGTH.
 
 Side Effects:
     Updates the tweet with the new content and image in the database.
@@ -477,7 +957,7 @@ Side Effects:
 """
 @app.post("/edit/{tweet_id}", response_class=HTMLResponse)
 async def edit_tweet_handler(request: Request, tweet_id: str, tweet: str = Form(...), image: UploadFile = File(...)): 
-    user, user_token = get_current_user(request)
+    user, user_token = await get_current_user(request)
 
     if not user_token:
         return RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
@@ -489,6 +969,7 @@ async def edit_tweet_handler(request: Request, tweet_id: str, tweet: str = Form(
 
     if not retrived_tweet:
         return {"message": "Tweet not found"}
+    check_tweet_length(tweet)
 
     image_url = None
 
@@ -501,9 +982,12 @@ async def edit_tweet_handler(request: Request, tweet_id: str, tweet: str = Form(
         'image_url': image_url
     }
 
-    # Update the tweet in the database
-    tweet_ref = user.collection(TWEET_COLLECTION).document(tweet_id)
-    tweet_ref.update(tweet_data)
+    # Update the tweet in the database, its timeline copies and search postings follow in the background
+    await repository.update_tweet(user, tweet_id, tweet_data)
+    await asyncio.gather(
+        job_queue.enqueue("tweet_edited", tweet_id, author_id=user, tweet_id=tweet_id),
+        profile_cache.invalidate(retrived_tweet.get('username'))
+    )
 
     headers = {"message": "Tweet updated successfully"}
     redirect_url = f"/edit/{tweet_id}?message=Tweet+updated+successfully"
@@ -513,7 +997,7 @@ async def edit_tweet_handler(request: Request, tweet_id: str, tweet: str = Form(
 Retrieves a tweet by its ID.
 
 Args:
-    user (User): The user object representing the owner of the tweet.
+    user (str): The ID of the user who owns the tweet.
     tweet_id (str): The ID of the tweet to retrieve.
 
 Returns:
@@ -521,7 +1005,7 @@ Returns:
 """
 async def get_tweet_by_Id(user, tweet_id: str):
     # Check if the tweet exists
-    tweet_data =  user.collection(TWEET_COLLECTION).document(tweet_id).get().to_dict()
+    tweet_data = await loaders().tweets.load((user, tweet_id))
     if tweet_data:
         return tweet_data
     else:
@@ -542,7 +1026,7 @@ Returns:
 """
 @app.get("/delete/{tweet_id}")
 async def delete_tweet_page(request: Request, tweet_id: str):
-    user, user_token = get_current_user(request)
+    user, user_token = await get_current_user(request)
 
     if not user_token:
         return RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
@@ -556,8 +1040,11 @@ async def delete_tweet_page(request: Request, tweet_id: str):
         return {"message": "Tweet not found"}
     
     # Delete the tweet from the database
-    tweet_ref = firestore_db.collection(USER_COLLECTION).document(user_token['user_id']).collection(TWEET_COLLECTION).document(tweet_id)
-    tweet_ref.delete()
+    await repository.delete_tweet(user, tweet_id)
+    await asyncio.gather(
+        job_queue.enqueue("tweet_deleted", tweet_id, tweet_id=tweet_id),
+        profile_cache.invalidate(tweet.get('username'))
+    )
 
     return RedirectResponse("/", status_code=status.HTTP_303_SEE_OTHER)
 
@@ -568,10 +1055,11 @@ Parameters:
     - image (UploadFile): The file to be uploaded.
 
 Returns:
-    - str: The URL of the uploaded file.
+    - tuple: The URLs of the uploaded image and of its resized variants, keyed by tweet field, and the path of the
+      staged copy the variants are to be made from, or None when they exist already.
 
 Raises:
-    - HTTPException: If the file is not a JPG or PNG image.
+    - HTTPException: If the file is not a JPG or PNG image, or the image has too many pixels.
     - RedirectResponse: If the filename is empty.
 
 This function checks if the uploaded file has a valid filename and if it is a JPG or PNG image. If the filename is empty, it returns a RedirectResponse to the root URL. If the file is not a JPG or PNG image, it raises an HTTPException with a status code of 400 and a detail message
@@ -584,28 +1072,71 @@ async def upload_file_handler(image: UploadFile = File(...)):
     if not (image.filename.endswith(".jpg") or image.filename.endswith(".png")):
         raise HTTPException(status_code=400, detail="Only JPG and PNG images are allowed")
     
-    image_url = upload_file(image)
-    return image_url
+    try:
+        return await upload_file(image)
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err))
 
 """
-A function that uploads a file to Google Cloud Storage.
+A function that uploads a file to the blob store of the storage backend.
+
+The image is stored under the hash of its content, so an image that was uploaded before is not uploaded again. The
+original is stored before this returns, so its URL works as soon as a tweet holds it. Its resized variants take
+longer to make, so a new image is copied out of the spooled temporary file of the upload for a background job that
+stores them, their URLs serve the variants once the job has run.
 
 Parameters:
     - file: The file to be uploaded.
 
 Returns:
-    - A string representing the URL of the uploaded file.
+    - tuple: The URLs of the uploaded image and of its resized variants, keyed by tweet field, and the path of the
+      staged copy the variants are to be made from, or None when they exist already.
+"""
+async def upload_file(file):
+    names, variants_missing = await media.store_original(repository, file.file)
+    staged = await job_queue.stage(file.file, names['image_url']) if variants_missing else None
+    return {field: repository.blob_url(name) for field, name in names.items()}, staged
+
+"""
+Serves a blob from the storage backend, used for the URLs handed out by backends without a public blob host.
+
+Parameters:
+    - name (str): The name of the blob.
+
+Returns:
+    - Response: The content of the blob.
+
+Raises:
+    - HTTPException: If there is no blob with that name.
+"""
+@app.get("/blobs/{name}")
+async def read_blob(name: str):
+    content = await repository.read_blob(name)
+    if content is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Blob not found")
+
+    media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    headers = {"Cache-Control": media.IMMUTABLE_CACHE_CONTROL} if media.is_content_addressed(name) else None
+    return Response(content, media_type=media_type, headers=headers)
+
 """
-def upload_file(file):
-    # Create a storage client
-    storage_client = storage.Client(project=local_constants.PROJECT_NAME)
-    bucket = storage_client.bucket(local_constants.PROJECT_STORAGE_BUCKET)
+Exposes the request, datastore, token verification and template metrics of this worker in the Prometheus text format.
 
-    print(file)
+Returns:
+    Response: The metrics, for a Prometheus scrape.
+"""
+@app.get("/metrics")
+async def metrics():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
-    # Upload the file to the bucket
-    blob = storage.Blob(file.filename, bucket)
-    blob.upload_from_file(file.file)
+"""
+Reports whether the app has finished warming up, for the readiness probe of the load balancer.
 
-    # Get the URL of the uploaded file
-    return f"https://storage.cloud.google.com/{bucket.name}/{blob.name}"
\ No newline at end of file
+Returns:
+    JSONResponse: 200 once the app is warmed up, 503 before.
+"""
+@app.get("/ready")
+async def readiness():
+    if not ready:
+        return JSONResponse({"ready": False}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return JSONResponse({"ready": True})
@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import io
+import re
+from constants import UPLOAD_CHUNK_SIZE, THUMBNAIL_SIZE, FEED_IMAGE_SIZE, MAX_IMAGE_PIXELS
+from datastore import run_blocking
+
+# Blobs are named after the SHA-256 of the original image, so their content never changes
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+CONTENT_ADDRESSED_NAME = re.compile(r"^[0-9a-f]{64}(-\w+)?\.(png|jpg)$")
+
+IMAGE_FORMATS = {'PNG': ("png", "image/png"), 'JPEG': ("jpg", "image/jpeg")}
+# Derived sizes, each fits in a square of the given number of pixels
+VARIANTS = {'feed': FEED_IMAGE_SIZE, 'thumbnail': THUMBNAIL_SIZE}
+IMAGE_TOO_LARGE = f"Images can have at most {MAX_IMAGE_PIXELS} pixels"
+
+
+"""
+Checks whether a blob name was given out by store_image, so it can be cached forever.
+
+Args:
+    name (str): The name of the blob.
+
+Returns:
+    bool: True if the name is derived from the content of the blob.
+"""
+def is_content_addressed(name):
+    return bool(CONTENT_ADDRESSED_NAME.match(name))
+
+def blob_names(digest, extension):
+    names = {'image_url': f"{digest}.{extension}"}
+    for variant in VARIANTS:
+        names[f"image_{variant}_url"] = f"{digest}-{variant}.{extension}"
+    return names
+
+def hash_file(file):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(UPLOAD_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+"""
+Imports Pillow and its format plugins, which the first upload would otherwise wait for. Pillow is imported by the
+functions that use it, so starting the app does not pay for it.
+"""
+def warm_up():
+    from PIL import Image
+    Image.init()
+
+"""
+Checks that an image can be decoded without running out of memory. Only the header has been read when it is called.
+
+Raises:
+    ValueError: If the image has more than MAX_IMAGE_PIXELS pixels.
+"""
+def check_size(image):
+    width, height = image.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ValueError(IMAGE_TOO_LARGE)
+
+"""
+Reads the format of an image from its header, without decoding it.
+
+Args:
+    file: A binary file object with the image.
+
+Returns:
+    str: The Pillow format of the image, "PNG" or "JPEG".
+
+Raises:
+    ValueError: If the file is not a JPG or PNG image, or the image is too large.
+"""
+def detect_format(file):
+    from PIL import Image, UnidentifiedImageError
+    try:
+        with Image.open(file) as image:
+            image_format = image.format
+            check_size(image)
+    except UnidentifiedImageError:
+        image_format = None
+    except Image.DecompressionBombError:
+        # Pillow refuses to even open images far above its own limit
+        raise ValueError(IMAGE_TOO_LARGE)
+    finally:
+        file.seek(0)
+
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError("Only JPG and PNG images are allowed")
+    return image_format
+
+"""
+Decodes an image once and encodes each of its resized variants.
+
+Args:
+    file: A binary file object with the original image.
+    image_format (str): The Pillow format of the image, "PNG" or "JPEG".
+
+Returns:
+    dict: The encoded bytes of each variant, keyed by variant name.
+
+Raises:
+    ValueError: If the image has more than MAX_IMAGE_PIXELS pixels.
+"""
+def make_variants(file, image_format):
+    from PIL import Image, ImageOps
+    with Image.open(file) as image:
+        check_size(image)
+        # Decode JPEGs at a reduced scale straight away, the variants are much smaller than the original
+        image.draft(image.mode, (FEED_IMAGE_SIZE, FEED_IMAGE_SIZE))
+        image = ImageOps.exif_transpose(image)
+
+        variants = {}
+        for variant, size in VARIANTS.items():
+            resized = image.copy()
+            resized.thumbnail((size, size))
+            output = io.BytesIO()
+            if image_format == 'JPEG':
+                resized.convert("RGB").save(output, "JPEG", quality=85, optimize=True, progressive=True)
+            else:
+                resized.save(output, "PNG", optimize=True)
+            variants[variant] = output.getvalue()
+
+    file.seek(0)
+    return variants
+
+"""
+Stores an uploaded image under the hash of its content, so its URL serves the image as soon as this returns. An
+image that was uploaded before is not uploaded again. The feed-size and thumbnail variants are left to
+store_variants, which is slow enough to run in the background.
+
+Args:
+    repository (Repository): The storage backend.
+    file: A binary file object with the uploaded image.
+
+Returns:
+    tuple: The blob names of the original and of each variant, keyed by the tweet field their URLs are stored in,
+        and whether the variants still have to be stored.
+
+Raises:
+    ValueError: If the file is not a JPG or PNG image, or the image is too large.
+"""
+async def store_original(repository, file):
+    image_format = await run_blocking(detect_format, file)
+    extension, content_type = IMAGE_FORMATS[image_format]
+    digest = await run_blocking(hash_file, file)
+    names = blob_names(digest, extension)
+
+    # The variants are uploaded together, the thumbnail stands for both
+    original_exists, variants_exist = await asyncio.gather(
+        repository.blob_exists(names['image_url']),
+        repository.blob_exists(names['image_thumbnail_url'])
+    )
+    if not original_exists:
+        await repository.upload_blob(names['image_url'], file, content_type, IMMUTABLE_CACHE_CONTROL)
+        file.seek(0)
+    return names, not variants_exist
+
+"""
+Stores the feed-size and thumbnail variants of an image stored by store_original, decoding it once.
+
+Args:
+    repository (Repository): The storage backend.
+    file: A binary file object with the original image.
+
+Raises:
+    ValueError: If the file is not a JPG or PNG image, or the image is too large.
+"""
+async def store_variants(repository, file):
+    image_format = await run_blocking(detect_format, file)
+    extension, content_type = IMAGE_FORMATS[image_format]
+    digest = await run_blocking(hash_file, file)
+    names = blob_names(digest, extension)
+
+    variants = await run_blocking(make_variants, file, image_format)
+    await asyncio.gather(*(
+        repository.upload_blob(names[f"image_{variant}_url"], io.BytesIO(content), content_type, IMMUTABLE_CACHE_CONTROL)
+        for variant, content in variants.items()
+    ))
@@ -0,0 +1,300 @@
+import heapq
+import os
+import pickle
+import uuid
+from datetime import datetime
+from constants import UPLOAD_CHUNK_SIZE
+from repository import Repository
+from timeline import is_celebrity
+
+
+def copy_document(document):
+    return {key: list(value) if isinstance(value, list) else value for key, value in document.items()}
+
+def newest(documents, limit, before=None):
+    if before:
+        documents = (document for document in documents if (document['date'], document['id']) < before)
+    return heapq.nlargest(limit, documents, key=lambda document: (document['date'], document['id']))
+
+"""
+Keeps every document and blob in process memory, for running the app and the performance suite without a GCP
+project. Documents are copied on the way in and out so callers cannot change stored state by accident.
+
+When a path is given, the state is loaded from that file on startup and written back to it on close.
+"""
+class MemoryRepository(Repository):
+    def __init__(self, path=None):
+        self.path = path
+        self.users = {}
+        self.uids_by_username = {}
+        # uid -> {other uid -> edge}, the two directions of every follow
+        self.followers = {}
+        self.following = {}
+        self.tweets = {}
+        self.timelines = {}
+        # tweet_id -> IDs of the users whose timeline holds a copy, stands in for the collection group query
+        self.timeline_copies = {}
+        self.postings = {}
+        # tweet_id -> the terms the tweet is indexed under
+        self.indexed_terms = {}
+        self.blobs = {}
+
+        if path and os.path.exists(path):
+            with open(path, "rb") as state_file:
+                self.__dict__.update(pickle.load(state_file))
+            self.uids_by_username = {user['username']: uid for uid, user in self.users.items() if user.get('username')}
+
+    def state(self):
+        return {name: getattr(self, name) for name in ("users", "followers", "following", "tweets", "timelines", "timeline_copies", "postings", "indexed_terms", "blobs")}
+
+    # Users
+
+    async def get_user(self, uid):
+        user = self.users.get(uid)
+        return copy_document(user) if user else None
+
+    async def get_users(self, uids):
+        return [copy_document(self.users[uid]) for uid in uids if uid in self.users]
+
+    async def find_user_by_username(self, username):
+        return await self.get_user(self.uids_by_username.get(username))
+
+    async def find_users_by_username(self, usernames):
+        uids = (self.uids_by_username.get(username) for username in set(usernames))
+        return [copy_document(self.users[uid]) for uid in uids if uid in self.users]
+
+    async def create_user(self, uid, data):
+        self.release_username(uid, data.get('username'))
+        self.users[uid] = {"id": uid, **copy_document(data)}
+        if data.get('username'):
+            self.uids_by_username[data['username']] = uid
+
+    async def claim_username(self, uid, username):
+        owner = self.uids_by_username.get(username)
+        if owner is not None and owner != uid:
+            return False
+
+        self.release_username(uid, username)
+        self.users.setdefault(uid, {"id": uid})['username'] = username
+        self.uids_by_username[username] = uid
+        return True
+
+    async def update_user(self, uid, fields):
+        if fields.get('username'):
+            self.release_username(uid, fields['username'])
+        self.users[uid].update(copy_document(fields))
+        if fields.get('username'):
+            self.uids_by_username[fields['username']] = uid
+
+    """
+    Drops the mapping of the username a user holds, when the user is about to hold another one.
+    """
+    def release_username(self, uid, username):
+        previous = self.users.get(uid, {}).get('username')
+        if previous and previous != username and self.uids_by_username.get(previous) == uid:
+            del self.uids_by_username[previous]
+
+    async def iter_usernames(self):
+        for username, uid in list(self.uids_by_username.items()):
+            yield uid, username
+
+    def watch_usernames(self, callback):
+        # Only this process writes to the in-memory engine, so there are no changes from elsewhere to report
+        return lambda: None
+
+    # Follow graph
+
+    async def follow(self, user, target):
+        following = self.following.setdefault(user['id'], {})
+        if target['id'] in following:
+            return False
+
+        date = datetime.now()
+        following[target['id']] = {'uid': target['id'], 'username': target['username'], 'date': date}
+        self.followers.setdefault(target['id'], {})[user['id']] = {'uid': user['id'], 'username': user['username'], 'date': date}
+        self.move_follow_counts(user['id'], target['id'], 1)
+        return True
+
+    async def unfollow(self, user, target):
+        if self.following.get(user['id'], {}).pop(target['id'], None) is None:
+            return False
+
+        self.followers.get(target['id'], {}).pop(user['id'], None)
+        self.move_follow_counts(user['id'], target['id'], -1)
+        return True
+
+    def move_follow_counts(self, uid, target_id, step):
+        stored_user = self.users[uid]
+        stored_target = self.users[target_id]
+        stored_user['following_count'] = stored_user.get('following_count', 0) + step
+        stored_target['follower_count'] = stored_target.get('follower_count', 0) + step
+        stored_target['celebrity'] = is_celebrity(stored_target['follower_count'], stored_target.get('celebrity', False))
+
+    async def is_following(self, uid, target_id):
+        return target_id in self.following.get(uid, {})
+
+    async def follower_ids(self, uid):
+        return list(self.followers.get(uid, {}))
+
+    async def following_ids(self, uid):
+        return list(self.following.get(uid, {}))
+
+    async def find_followed_celebrities(self, uid, following_count=None):
+        following = self.following.get(uid, {})
+        return [copy_document(self.users[target_id]) for target_id in following if self.users[target_id].get('celebrity')]
+
+    async def iter_users(self):
+        for user in list(self.users.values()):
+            yield copy_document(user)
+
+    async def put_follow_edges(self, edges):
+        for user, target, date in edges:
+            self.following.setdefault(user['id'], {})[target['id']] = {'uid': target['id'], 'username': target['username'], 'date': date}
+            self.followers.setdefault(target['id'], {})[user['id']] = {'uid': user['id'], 'username': user['username'], 'date': date}
+
+    async def count_follows(self, uid):
+        return len(self.followers.get(uid, {})), len(self.following.get(uid, {}))
+
+    async def remove_user_fields(self, uid, names):
+        for name in names:
+            self.users[uid].pop(name, None)
+
+    # Tweets
+
+    async def add_tweet(self, author_id, data):
+        tweet_id = uuid.uuid4().hex[:20]
+        self.tweets.setdefault(author_id, {})[tweet_id] = {"id": tweet_id, "author_id": author_id, **data}
+        return tweet_id
+
+    async def get_tweet(self, author_id, tweet_id):
+        tweet = self.tweets.get(author_id, {}).get(tweet_id)
+        return dict(tweet) if tweet else None
+
+    async def get_tweets(self, keys):
+        tweets = (self.tweets.get(author_id, {}).get(tweet_id) for author_id, tweet_id in keys)
+        return [dict(tweet) for tweet in tweets if tweet]
+
+    async def update_tweet(self, author_id, tweet_id, fields):
+        self.tweets[author_id][tweet_id].update(fields)
+
+    async def delete_tweet(self, author_id, tweet_id):
+        self.tweets.get(author_id, {}).pop(tweet_id, None)
+
+    async def latest_tweets(self, author_id, limit, before=None):
+        return [dict(tweet) for tweet in newest(self.tweets.get(author_id, {}).values(), limit, before)]
+
+    async def iter_tweets(self):
+        for author_tweets in list(self.tweets.values()):
+            for tweet in list(author_tweets.values()):
+                yield dict(tweet)
+
+    # Materialized timelines
+
+    def put_timeline_entry(self, owner_id, entry):
+        self.timelines.setdefault(owner_id, {})[entry['tweet_id']] = {"id": entry['tweet_id'], **entry}
+        self.timeline_copies.setdefault(entry['tweet_id'], set()).add(owner_id)
+
+    async def add_to_timelines(self, owner_ids, entry):
+        for owner_id in owner_ids:
+            self.put_timeline_entry(owner_id, entry)
+
+    async def put_timeline_entries(self, owner_id, entries):
+        for entry in entries:
+            self.put_timeline_entry(owner_id, entry)
+
+    async def update_timeline_entries(self, tweet_id, fields):
+        for owner_id in self.timeline_copies.get(tweet_id, ()):
+            self.timelines[owner_id][tweet_id].update(fields)
+
+    async def delete_timeline_entries(self, tweet_id):
+        for owner_id in self.timeline_copies.pop(tweet_id, ()):
+            self.timelines[owner_id].pop(tweet_id, None)
+
+    async def prune_timeline(self, owner_id, author_id):
+        timeline = self.timelines.get(owner_id, {})
+        for tweet_id in [tweet_id for tweet_id, entry in timeline.items() if entry['author_id'] == author_id]:
+            del timeline[tweet_id]
+            self.timeline_copies[tweet_id].discard(owner_id)
+
+    async def read_timeline(self, owner_id, limit, before=None):
+        return [dict(entry) for entry in newest(self.timelines.get(owner_id, {}).values(), limit, before)]
+
+    # Search index
+
+    async def update_postings(self, tweet_id, posting, terms):
+        for term in self.indexed_terms.pop(tweet_id, set()) - terms:
+            self.postings.get(term, {}).pop(tweet_id, None)
+        for term in terms:
+            self.postings.setdefault(term, {})[tweet_id] = {"id": tweet_id, **posting}
+        if terms:
+            self.indexed_terms[tweet_id] = set(terms)
+
+    async def term_counts(self, terms):
+        return {term: len(self.postings[term]) for term in terms if self.postings.get(term)}
+
+    async def postings_page(self, term, limit, cursor=None):
+        postings = self.postings.get(term, {})
+        start = cursor or 0
+        page = newest(postings.values(), start + limit)[start:]
+        return [dict(posting) for posting in page], (start + limit if start + limit < len(postings) else None)
+
+    async def clear_search_index(self):
+        self.postings = {}
+        self.indexed_terms = {}
+
+    async def put_postings(self, postings):
+        for term, tweet_id, posting in postings:
+            self.postings.setdefault(term, {})[tweet_id] = {"id": tweet_id, **posting}
+
+    async def put_indexed_terms(self, indexed_terms):
+        for tweet_id, terms in indexed_terms.items():
+            self.indexed_terms[tweet_id] = set(terms)
+
+    async def set_term_counts(self, counts):
+        # Counts are derived from the postings themselves
+        pass
+
+    # Bulk data
+
+    async def users_page(self, limit, after=None):
+        uids = sorted(uid for uid in self.users if after is None or uid > after)[:limit]
+        return [copy_document(self.users[uid]) for uid in uids]
+
+    async def tweets_page(self, author_id, limit, after=None):
+        tweets = self.tweets.get(author_id, {})
+        return [dict(tweets[tweet_id]) for tweet_id in sorted(tweet_id for tweet_id in tweets if after is None or tweet_id > after)[:limit]]
+
+    async def following_page(self, uid, limit, after=None):
+        following = self.following.get(uid, {})
+        return [dict(following[target_id]) for target_id in sorted(target_id for target_id in following if after is None or target_id > after)[:limit]]
+
+    async def put_users(self, users):
+        for user in users:
+            await self.create_user(user['id'], user)
+
+    async def put_tweets(self, tweets):
+        for tweet in tweets:
+            self.tweets.setdefault(tweet['author_id'], {})[tweet['id']] = dict(tweet)
+
+    # Blobs
+
+    async def upload_blob(self, name, file, content_type=None, cache_control=None):
+        content = bytearray()
+        for chunk in iter(lambda: file.read(UPLOAD_CHUNK_SIZE), b""):
+            content += chunk
+        self.blobs[name] = bytes(content)
+        return self.blob_url(name)
+
+    async def read_blob(self, name):
+        return self.blobs.get(name)
+
+    async def blob_exists(self, name):
+        return name in self.blobs
+
+    def blob_url(self, name):
+        return f"/blobs/{name}"
+
+    async def close(self):
+        if self.path:
+            with open(self.path, "wb") as state_file:
+                pickle.dump(self.state(), state_file)
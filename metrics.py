@@ -0,0 +1,273 @@
+import contextvars
+import os
+import time
+from bisect import bisect_left
+from collections import Counter
+from fastapi.templating import Jinja2Templates
+from instrumented_repository import request_operations, READ_OPERATIONS
+
+# Upper bounds of the latency histogram buckets in seconds, the defaults of the Prometheus client libraries
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+# Upper bounds of the buckets for the number of datastore calls a request makes
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+# The repository methods that read or write blobs rather than documents
+BLOB_OPERATIONS = frozenset(['upload_blob', 'read_blob', 'blob_exists'])
+
+# Seconds the current request spent in each phase, keyed by phase name
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names, values, extra=""):
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+"""
+A histogram with a fixed set of labels, rendered in the Prometheus text format.
+
+Observing is a bisect and a few list updates on the event loop thread, so it is cheap enough for every request.
+
+Args:
+    name (str): The metric name.
+    documentation (str): The HELP text.
+    label_names (tuple): The names of the labels.
+    buckets (tuple): The upper bounds of the buckets, in increasing order.
+"""
+class Histogram:
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [count per bucket, with the +Inf bucket last, then the sum]
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                bucket_labels = format_labels(self.label_names, label_values, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, label_values)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, label_values)} {cumulative}")
+        return "\n".join(lines)
+
+"""
+A value that goes up and down, one per set of label values, rendered in the Prometheus text format.
+
+Args:
+    name (str): The metric name.
+    documentation (str): The HELP text.
+    label_names (tuple): The names of the labels.
+"""
+class Gauge:
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        # label values -> value
+        self.values = {}
+
+    @property
+    def value(self):
+        return self.values.get(())
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {value}")
+        return "\n".join(lines)
+
+"""
+A count that only goes up, one per set of label values, rendered in the Prometheus text format.
+"""
+class Total(Gauge):
+    metric_type = "counter"
+
+    def inc(self, *label_values):
+        self.values[label_values] = self.values.get(label_values, 0) + 1
+
+"""
+Reads when this process started from /proc, so the time spent importing modules is counted too.
+
+Returns:
+    float: The unix time the process started, or the current time where /proc is not available.
+"""
+def process_start_time():
+    try:
+        with open("/proc/self/stat") as stat_file:
+            # The command name can contain spaces, the fields after it are space separated
+            start_ticks = int(stat_file.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        return time.time() - (uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+# Startup
+process_start = Gauge("process_start_time_seconds", "Start time of the process since the unix epoch in seconds.")
+process_start.set(process_start_time())
+first_response = Gauge("app_time_to_first_response_seconds", "Seconds from the start of the process to the first byte of the first response.")
+warm_up_duration = Gauge("app_warm_up_seconds", "Seconds the warm-up took after the app started.")
+
+# Background jobs
+jobs_pending = Gauge("app_jobs_pending", "Background jobs queued, running or waiting for a retry.")
+jobs_dead_letters = Gauge("app_jobs_dead_letters", "Background jobs that failed every attempt since the process started.")
+
+# Admission control
+admission_in_flight = Gauge("admission_in_flight_requests", "Requests running per admission budget.", ("budget",))
+admission_queue_depth = Gauge("admission_queue_depth", "Requests waiting for a slot per admission budget.", ("budget",))
+admission_rejections = Total("admission_rejections_total", "Requests turned away per admission budget and reason.", ("budget", "reason"))
+
+GAUGES = [process_start, first_response, warm_up_duration, jobs_pending, jobs_dead_letters, admission_in_flight, admission_queue_depth, admission_rejections]
+
+# Per call
+http_request_duration = Histogram("http_request_duration_seconds", "Latency of HTTP requests by route.", ("method", "route", "status"))
+datastore_call_duration = Histogram("datastore_call_duration_seconds", "Latency of storage backend calls.", ("kind", "operation"))
+token_verification_duration = Histogram("token_verification_duration_seconds", "Latency of Firebase ID token verifications.", ("result",))
+template_render_duration = Histogram("template_render_duration_seconds", "Time spent rendering templates.", ("template",))
+job_duration = Histogram("job_duration_seconds", "Latency of background job attempts.", ("job", "result"))
+admission_wait_duration = Histogram("admission_wait_seconds", "Time admitted requests waited for a slot.", ("budget",))
+
+# Per request
+request_phase_duration = Histogram("http_request_phase_seconds", "Time each request spent per phase, by route.", ("route", "phase"))
+request_datastore_calls = Histogram("http_request_datastore_calls", "Storage backend calls made by each request, by route.", ("route", "kind"), COUNT_BUCKETS)
+
+HISTOGRAMS = [http_request_duration, datastore_call_duration, token_verification_duration, template_render_duration, job_duration, admission_wait_duration, request_phase_duration, request_datastore_calls]
+
+# The phases of a request that are reported on their own, whether or not the request went through them
+REQUEST_PHASES = ("admission_wait", "datastore_read", "datastore_write", "blob", "token_verification", "template_render")
+
+
+def operation_kind(name):
+    if name in BLOB_OPERATIONS:
+        return "blob"
+    return "datastore_read" if name in READ_OPERATIONS else "datastore_write"
+
+def add_request_time(phase, seconds):
+    timings = request_timings.get()
+    if timings is not None:
+        timings[phase] += seconds
+
+"""
+Records one storage backend call, in the latency of its kind and in the time of the current request.
+
+Args:
+    name (str): The repository method.
+    args (tuple): The positional arguments of the call.
+    start (float): The time.perf_counter() at which the call began.
+    seconds (float): How long the call took.
+"""
+def observe_datastore_call(name, args, start, seconds):
+    if name == "close":
+        return
+    kind = operation_kind(name)
+    datastore_call_duration.observe(seconds, kind, name)
+    add_request_time(kind, seconds)
+
+"""
+Records how long a template took to render, in the histogram and in the phases of the current request.
+"""
+def observe_template_render(name, seconds):
+    template_render_duration.observe(seconds, name)
+    add_request_time("template_render", seconds)
+
+"""
+Returns the seconds the current request has spent in storage backend calls so far.
+"""
+def storage_time():
+    timings = request_timings.get()
+    if timings is None:
+        return 0
+    return timings["datastore_read"] + timings["datastore_write"] + timings["blob"]
+
+def observe_token_verification(result, seconds):
+    token_verification_duration.observe(seconds, result)
+    add_request_time("token_verification", seconds)
+
+"""
+Renders every metric in the Prometheus text exposition format.
+
+Returns:
+    str: The body of the /metrics response.
+"""
+def render_metrics():
+    return "\n".join(metric.render() for metric in GAUGES + HISTOGRAMS) + "\n"
+
+"""
+Jinja2Templates that records how long each template takes to render.
+"""
+class TimedTemplates(Jinja2Templates):
+    def TemplateResponse(self, name, *args, **kwargs):
+        start = time.perf_counter()
+        response = super().TemplateResponse(name, *args, **kwargs)
+        observe_template_render(name, time.perf_counter() - start)
+        return response
+
+"""
+Records the latency of every HTTP request by route, with the time it spent per phase and the storage backend calls
+it made. Runs inside RequestScopeMiddleware, which starts the operation counter of the request.
+
+Requests that match no route are recorded under the route "unmatched", so the number of series stays bounded.
+
+Args:
+    app: The ASGI app to wrap.
+    exclude (tuple): Paths that are not recorded, such as /metrics itself.
+"""
+class MetricsMiddleware:
+    def __init__(self, app, exclude=("/metrics",)):
+        self.app = app
+        self.exclude = frozenset(exclude)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude:
+            await self.app(scope, receive, send)
+            return
+
+        timings = Counter()
+        request_timings.set(timings)
+        status_code = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+                if first_response.value is None:
+                    first_response.set(time.time() - process_start.value)
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - start
+            # The router puts the matched route in the scope, mounts such as /static have no route of their own
+            route = getattr(scope.get("route"), "path", "unmatched")
+
+            http_request_duration.observe(seconds, scope["method"], route, status_code[0])
+            for phase in REQUEST_PHASES:
+                request_phase_duration.observe(timings[phase], route, phase)
+
+            calls = Counter()
+            for name, count in (request_operations.get() or {}).items():
+                calls[operation_kind(name)] += count
+            for kind in ("datastore_read", "datastore_write", "blob"):
+                request_datastore_calls.observe(calls[kind], route, kind)
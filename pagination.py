@@ -0,0 +1,166 @@
+import asyncio
+import base64
+import heapq
+import json
+from datetime import datetime
+
+
+"""
+Builds the opaque cursor that points just past a tweet in a newest-first feed.
+
+Args:
+    tweet (dict): The last tweet of a page, with 'date' and 'id'.
+
+Returns:
+    str: The URL-safe cursor.
+"""
+def encode_cursor(tweet):
+    position = json.dumps([tweet['date'].isoformat(), tweet['id']])
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip("=")
+
+"""
+Reads a cursor made by encode_cursor.
+
+Args:
+    cursor (str): The cursor, or None for the first page.
+
+Returns:
+    tuple or None: The (date, id) the page starts after, or None for the first page.
+
+Raises:
+    ValueError: If the cursor is malformed.
+"""
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        date, tweet_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(date), str(tweet_id)
+    except (TypeError, ValueError) as err:
+        raise ValueError("Invalid cursor") from err
+
+def position(tweet):
+    return tweet['date'], tweet['id']
+
+"""
+Heap entry that puts the newest tweet first, dates cannot be negated to turn heapq into a max-heap.
+"""
+class Newest:
+    __slots__ = ("key", "source")
+
+    def __init__(self, tweet, source):
+        self.key = position(tweet)
+        self.source = source
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+"""
+A newest-first stream of tweets that is fetched one chunk at a time, as the merge consumes it.
+
+Args:
+    fetch (callable): Called with (limit, before) and returns up to limit tweets older than the (date, id)
+        position before, newest first.
+"""
+class Source:
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.buffer = []
+        self.exhausted = False
+
+    async def load(self, limit, before):
+        self.buffer = list(reversed(await self.fetch(limit, before)))
+        self.exhausted = len(self.buffer) < limit
+
+"""
+Merges several newest-first sources into one newest-first stream of tweets, with a k-way merge.
+
+Every source is asked for an even share of the tweets up front. A source is only asked for more, starting after
+the last tweet taken from it, once the merge has used up everything it returned, so no source is read further
+than the tweets taken need and the cost does not depend on how deep the stream starts.
+
+Args:
+    fetchers (list): One fetch callable per source, see Source.
+    wanted (int): The most tweets to yield.
+    before (tuple, optional): The (date, id) the stream starts after. Defaults to None for the newest tweets.
+
+Yields:
+    dict: The tweets, newest first, each as soon as the merge has taken it.
+"""
+async def merge_tweets(fetchers, wanted, before=None):
+    sources = [Source(fetch) for fetch in fetchers]
+    share = wanted if len(sources) == 1 else -(-wanted // len(sources)) + 1
+    await asyncio.gather(*(source.load(share, before) for source in sources))
+
+    heap = [Newest(source.buffer[-1], source) for source in sources if source.buffer]
+    heapq.heapify(heap)
+
+    taken = 0
+    seen = set()
+    while heap and taken < wanted:
+        head = heapq.heappop(heap)
+        source = head.source
+        tweet = source.buffer.pop()
+
+        # A tweet can be in more than one source, for example in the timeline and among a celebrity's tweets
+        if tweet['id'] not in seen:
+            seen.add(tweet['id'])
+            taken += 1
+            yield tweet
+
+        if not source.buffer and not source.exhausted and taken < wanted:
+            await source.load(wanted - taken, position(tweet))
+        if source.buffer:
+            heapq.heappush(heap, Newest(source.buffer[-1], source))
+
+"""
+Reads one page of a feed that is the union of several newest-first sources, see merge_tweets.
+
+Args:
+    fetchers (list): One fetch callable per source, see Source.
+    limit (int): The number of tweets per page.
+    before (tuple, optional): The (date, id) the page starts after. Defaults to None for the first page.
+
+Returns:
+    tuple: The tweets of the page, newest first, and the cursor of the next page or None on the last page.
+"""
+async def merge_page(fetchers, limit, before=None):
+    # One tweet past the page tells whether there is a next page
+    page = [tweet async for tweet in merge_tweets(fetchers, limit + 1, before)]
+
+    if len(page) > limit:
+        return page[:limit], encode_cursor(page[limit - 1])
+    return page, None
+
+"""
+One page of a merged feed that is read while it is iterated, so a page being rendered can show each tweet as soon
+as it is merged. The cursor of the next page is known once the page has been iterated to the end.
+
+Args:
+    get_fetchers (callable): Coroutine function that returns the fetch callables of the sources, see Source. It
+        is only called when the iteration starts.
+    limit (int): The number of tweets per page.
+    before (tuple, optional): The (date, id) the page starts after. Defaults to None for the first page.
+"""
+class PageStream:
+    def __init__(self, get_fetchers, limit, before=None):
+        self.get_fetchers = get_fetchers
+        self.limit = limit
+        self.before = before
+        self.next_cursor = None
+
+    async def __aiter__(self):
+        # One tweet past the page tells whether there is a next page
+        tweets = merge_tweets(await self.get_fetchers(), self.limit + 1, self.before)
+        try:
+            last = None
+            count = 0
+            async for tweet in tweets:
+                if count == self.limit:
+                    self.next_cursor = encode_cursor(last)
+                    break
+                last = tweet
+                count += 1
+                yield tweet
+        finally:
+            await tweets.aclose()
@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import os
+import pickle
+import time
+from collections import OrderedDict
+from functools import partial
+
+# Maximum number of profiles kept in memory by each worker
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", "10000"))
+
+# How long a cached profile is served before it is read again, writes invalidate it sooner
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", "60"))
+
+# With a shared backend, how long a worker keeps its own copy of an entry; this bounds how long a worker can miss
+# an invalidation made by another worker
+PROFILE_CACHE_LOCAL_TTL = float(os.environ.get("PROFILE_CACHE_LOCAL_TTL", "2"))
+
+# Optional Redis URL of a cache shared by all workers, for example redis://localhost:6379/0
+PROFILE_CACHE_REDIS_URL = os.environ.get("PROFILE_CACHE_REDIS_URL")
+
+PROFILE_CACHE_KEY_PREFIX = "profile:"
+
+
+"""
+The viewer-independent part of a profile page: the user's document and the first page of their tweets.
+
+Args:
+    user_info (dict): The user's document.
+    tweets (list): The newest tweets of the user.
+    next_cursor (str): The cursor of the next page of tweets, or None.
+"""
+class CachedProfile:
+    __slots__ = ("user_info", "tweets", "next_cursor", "etag")
+
+    def __init__(self, user_info, tweets, next_cursor):
+        self.user_info = user_info
+        self.tweets = tweets
+        self.next_cursor = next_cursor
+        # Identifies this version of the profile, for validating the copies browsers keep
+        self.etag = hashlib.sha256(pickle.dumps((user_info, tweets, next_cursor))).hexdigest()[:32]
+
+"""
+A cache shared by every worker, kept in Redis. The redis package is only needed when this backend is used.
+
+Args:
+    url (str): The Redis URL.
+"""
+class RedisBackend:
+    def __init__(self, url):
+        import redis.asyncio
+        self.client = redis.asyncio.from_url(url)
+
+    async def get(self, key):
+        value = await self.client.get(PROFILE_CACHE_KEY_PREFIX + key)
+        return pickle.loads(value) if value is not None else None
+
+    async def set(self, key, value, ttl):
+        await self.client.set(PROFILE_CACHE_KEY_PREFIX + key, pickle.dumps(value), px=int(ttl * 1000))
+
+    async def delete(self, *keys):
+        await self.client.delete(*(PROFILE_CACHE_KEY_PREFIX + key for key in keys))
+
+    async def close(self):
+        await self.client.aclose()
+
+"""
+An LRU cache of profiles keyed by username, with a TTL and an optional shared backend behind it.
+
+Concurrent misses for the same profile share a single load, so a popular profile is read once when it expires
+rather than once per waiting request. Every write that changes what a profile shows must call invalidate.
+
+Args:
+    max_size (int): The most profiles kept in memory.
+    ttl (float): How long an entry is served, in seconds.
+    backend (RedisBackend, optional): The cache shared by all workers. Defaults to None.
+"""
+class ProfileCache:
+    def __init__(self, max_size=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL, backend=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self.local_ttl = min(ttl, PROFILE_CACHE_LOCAL_TTL) if backend else ttl
+        self.profiles = OrderedDict()
+        self.loading = {}
+
+    """
+    Returns the cached profile of a user, loading it on a miss.
+
+    Args:
+        username (str): The username of the profile.
+        load (callable): Coroutine function that reads the profile and returns a CachedProfile, or None if the
+            user does not exist. Missing users are not cached.
+
+    Returns:
+        CachedProfile or None: The profile, or None if the user does not exist.
+    """
+    async def get(self, username, load):
+        entry = self.profiles.get(username)
+        if entry is not None:
+            expires_at, profile = entry
+            if expires_at > time.monotonic():
+                self.profiles.move_to_end(username)
+                return profile
+            del self.profiles[username]
+
+        pending = self.loading.get(username)
+        if pending is None:
+            pending = self.loading[username] = asyncio.ensure_future(self.fill(username, load))
+            pending.add_done_callback(partial(self.loaded, username))
+        return await asyncio.shield(pending)
+
+    def loaded(self, username, task):
+        if self.loading.get(username) is task:
+            del self.loading[username]
+
+    async def fill(self, username, load):
+        profile = await self.backend.get(username) if self.backend else None
+        from_backend = profile is not None
+        if profile is None:
+            profile = await load()
+            if profile is None:
+                return None
+
+        # A write that invalidated the profile while it was being read leaves the result uncached
+        if self.loading.get(username) is not asyncio.current_task():
+            return profile
+
+        if self.backend and not from_backend:
+            await self.backend.set(username, profile, self.ttl)
+        self.put(username, profile)
+        return profile
+
+    def put(self, username, profile):
+        self.profiles[username] = (time.monotonic() + self.local_ttl, profile)
+        self.profiles.move_to_end(username)
+        while len(self.profiles) > self.max_size:
+            self.profiles.popitem(last=False)
+
+    """
+    Drops the cached profiles of users, after a write that changes what their profile shows.
+
+    Args:
+        *usernames (str): The usernames of the profiles.
+    """
+    async def invalidate(self, *usernames):
+        usernames = [username for username in usernames if username]
+        for username in usernames:
+            self.profiles.pop(username, None)
+            # A load that is still running finishes for its waiters, but the next request starts a fresh one
+            self.loading.pop(username, None)
+
+        if self.backend and usernames:
+            await self.backend.delete(*usernames)
+
+    async def close(self):
+        if self.backend:
+            await self.backend.close()
+
+"""
+Creates the profile cache, with the shared backend when PROFILE_CACHE_REDIS_URL is set.
+
+Returns:
+    ProfileCache: The profile cache.
+"""
+def create_profile_cache():
+    backend = RedisBackend(PROFILE_CACHE_REDIS_URL) if PROFILE_CACHE_REDIS_URL else None
+    return ProfileCache(backend=backend)
@@ -0,0 +1,345 @@
+"""
+Opt-in profiling of single requests.
+
+A request is traced when it carries the X-Profile-Token header with the value of PROFILE_TOKEN, or when it is
+picked by PROFILE_SAMPLE_RATE. While it runs, a sampling thread records the Python stack of the event loop whenever
+the loop is running one of the request's tasks, and every storage backend call of the request is recorded as a span
+with its arguments redacted. Each trace is written to PROFILE_DIR as JSON, with the stacks also in the folded format
+read by flamegraph.pl and speedscope.
+
+    python profiling.py list
+    python profiling.py show <trace id> [--top 20]
+    python profiling.py folded <trace id> | flamegraph.pl > trace.svg
+"""
+import argparse
+import asyncio
+import contextvars
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+import weakref
+from collections import Counter, defaultdict
+from datetime import datetime
+from datastore import run_blocking
+
+# Requests that send this value in the X-Profile-Token header are traced, tracing on demand is off when it is unset
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+# Fraction of all requests that are traced
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+# Where the traces are written
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# Seconds between two stack samples
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.005"))
+
+PROFILE_TOKEN_HEADER = b"x-profile-token"
+
+# The trace of the request being handled
+active_trace = contextvars.ContextVar("active_trace", default=None)
+
+# Task -> trace, for the tasks of traced requests, so the sampler knows whose stack it is looking at
+traced_tasks = weakref.WeakKeyDictionary()
+
+
+"""
+Describes an argument without its value, so traces can be shared without leaking user data.
+
+Args:
+    value: The argument.
+
+Returns:
+    str: The type of the argument, with the length of strings and containers.
+"""
+def redact(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return type(value).__name__
+    if isinstance(value, (str, bytes, list, tuple, set, frozenset, dict)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)})"
+
+"""
+Folds a stack into one line of the collapsed stack format, outermost frame first.
+
+Args:
+    frame (frame): The innermost frame.
+
+Returns:
+    str: The frame names joined with semicolons.
+"""
+def fold(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+"""
+The stacks and spans recorded for one request.
+
+Args:
+    method (str): The HTTP method.
+    path (str): The request path, without the query string.
+"""
+class Trace:
+    def __init__(self, method, path):
+        self.id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.status = None
+        self.route = None
+        # Appended to by the sampler thread, list.append is atomic
+        self.samples = []
+        self.spans = []
+
+    def add_span(self, name, args, start, seconds):
+        self.spans.append({
+            'name': name,
+            'start_ms': round((start - self.start) * 1000, 3),
+            'duration_ms': round(seconds * 1000, 3),
+            'args': [redact(arg) for arg in args],
+        })
+
+    def finish(self, status, route):
+        self.duration = time.perf_counter() - self.start
+        self.status = status
+        self.route = route
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'route': self.route,
+            'status': self.status,
+            'started_at': self.started_at.isoformat(),
+            'duration_ms': round(self.duration * 1000, 3),
+            'interval_ms': PROFILE_INTERVAL * 1000,
+            'spans': sorted(self.spans, key=lambda span: span['start_ms']),
+            'stacks': dict(Counter(self.samples).most_common()),
+        }
+
+    """
+    Writes the trace to a JSON file and its stacks to a folded file, both named after the trace ID. This blocks on
+    the disk.
+
+    Args:
+        directory (str): The directory to write to.
+    """
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        trace = self.to_dict()
+        with open(os.path.join(directory, f"{self.id}.json"), "w") as trace_file:
+            json.dump(trace, trace_file, indent=1)
+        with open(os.path.join(directory, f"{self.id}.folded"), "w") as folded_file:
+            folded_file.writelines(f"{stack} {count}\n" for stack, count in trace['stacks'].items())
+
+"""
+Samples the stack of the event loop thread while at least one traced request is running, and hands each sample to
+the trace whose task the loop is running at that moment.
+
+Args:
+    loop (asyncio.AbstractEventLoop): The event loop to sample.
+    interval (float): Seconds between two samples.
+"""
+class Sampler(threading.Thread):
+    def __init__(self, loop, interval=PROFILE_INTERVAL):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.interval = interval
+        self.traces = 0
+        self.active = threading.Event()
+
+    def run(self):
+        while True:
+            self.active.wait()
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.loop_thread_id)
+            task = asyncio.current_task(self.loop)
+            trace = traced_tasks.get(task) if task is not None else None
+            if trace is not None and frame is not None:
+                trace.samples.append(fold(frame))
+
+    def trace_started(self):
+        self.traces += 1
+        self.active.set()
+
+    def trace_finished(self):
+        self.traces -= 1
+        if not self.traces:
+            self.active.clear()
+
+sampler = None
+
+
+"""
+Prepares the running event loop for tracing: tasks created by a traced request are traced too, and the sampler
+thread is started. Does nothing when tracing is off.
+"""
+def install():
+    global sampler
+    if not PROFILE_TOKEN and not PROFILE_SAMPLE_RATE:
+        return
+
+    loop = asyncio.get_running_loop()
+    default_factory = loop.get_task_factory()
+
+    def task_factory(loop, coro, **kwargs):
+        task = default_factory(loop, coro, **kwargs) if default_factory else asyncio.Task(coro, loop=loop, **kwargs)
+        trace = active_trace.get()
+        if trace is not None:
+            traced_tasks[task] = trace
+        return task
+
+    loop.set_task_factory(task_factory)
+    sampler = Sampler(loop)
+    sampler.start()
+
+"""
+Records one storage backend call as a span of the current trace.
+
+Args:
+    name (str): The repository method.
+    args (tuple): The positional arguments of the call, recorded redacted.
+    start (float): The time.perf_counter() at which the call began.
+    seconds (float): How long the call took.
+"""
+def observe_call(name, args, start, seconds):
+    trace = active_trace.get()
+    if trace is not None:
+        trace.add_span(name, args, start, seconds)
+
+def wants_trace(scope):
+    if PROFILE_TOKEN:
+        token = dict(scope["headers"]).get(PROFILE_TOKEN_HEADER)
+        if token is not None and hmac.compare_digest(token, PROFILE_TOKEN.encode()):
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+"""
+Traces the requests that ask for it or are sampled, and returns the ID of the trace in the X-Trace-Id header.
+
+Args:
+    app: The ASGI app to wrap.
+    directory (str): Where the traces are written.
+"""
+class ProfilingMiddleware:
+    def __init__(self, app, directory=PROFILE_DIR):
+        self.app = app
+        self.directory = directory
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or sampler is None or not wants_trace(scope):
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(scope["method"], scope["path"])
+        status_code = [500]
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-trace-id", trace.id.encode())]
+            await send(message)
+
+        task = asyncio.current_task()
+        token = active_trace.set(trace)
+        traced_tasks[task] = trace
+        sampler.trace_started()
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            sampler.trace_finished()
+            traced_tasks.pop(task, None)
+            active_trace.reset(token)
+            trace.finish(status_code[0], getattr(scope.get("route"), "path", None))
+            await run_blocking(trace.write, self.directory)
+
+# Command line
+
+def load_traces(directory):
+    if not os.path.isdir(directory):
+        return []
+    traces = []
+    for name in os.listdir(directory):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name)) as trace_file:
+                traces.append(json.load(trace_file))
+    return sorted(traces, key=lambda trace: trace['started_at'])
+
+def load_trace(directory, trace_id):
+    path = os.path.join(directory, f"{trace_id}.json")
+    if not os.path.exists(path):
+        sys.exit(f"No trace {trace_id} in {directory}")
+    with open(path) as trace_file:
+        return json.load(trace_file)
+
+def list_traces(args):
+    for trace in load_traces(args.dir):
+        print(f"{trace['id']}  {trace['started_at']}  {trace['duration_ms']:>9.1f} ms  {trace['status']}  {trace['method']} {trace['path']}  "
+              f"{len(trace['spans'])} calls, {sum(trace['stacks'].values())} samples")
+
+"""
+Prints where the time of one trace went: its storage backend calls grouped by method, and the functions that were
+on the CPU the most, by their own samples and by the samples they were on the stack for.
+"""
+def show_trace(args):
+    trace = load_trace(args.dir, args.trace_id)
+    print(f"{trace['method']} {trace['path']} ({trace['route']}) -> {trace['status']} in {trace['duration_ms']:.1f} ms, started {trace['started_at']}")
+
+    calls = defaultdict(lambda: [0, 0.0])
+    for span in trace['spans']:
+        calls[span['name']][0] += 1
+        calls[span['name']][1] += span['duration_ms']
+    print(f"\nStorage backend calls ({len(trace['spans'])}):")
+    for name, (count, total) in sorted(calls.items(), key=lambda item: -item[1][1]):
+        print(f"  {total:>9.1f} ms  {count:>5}x  {name}")
+
+    samples = sum(trace['stacks'].values())
+    if not samples:
+        print("\nNo samples, the request spent all of its time waiting")
+        return
+    own = Counter()
+    total = Counter()
+    for stack, count in trace['stacks'].items():
+        frames = stack.split(";")
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    print(f"\nOn CPU: {samples} samples of {trace['interval_ms']:g} ms")
+    for title, counter in (("Own samples", own), ("Total samples", total)):
+        print(f"  {title}:")
+        for frame, count in counter.most_common(args.top):
+            print(f"    {count:>6}  {100 * count / samples:5.1f}%  {frame}")
+
+def print_folded(args):
+    for stack, count in load_trace(args.dir, args.trace_id)['stacks'].items():
+        print(f"{stack} {count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=PROFILE_DIR, help="The directory the traces are in")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="List the captured traces, oldest first").set_defaults(run=list_traces)
+    show = commands.add_parser("show", help="Summarize one trace")
+    show.add_argument("trace_id")
+    show.add_argument("--top", type=int, default=15)
+    show.set_defaults(run=show_trace)
+    folded = commands.add_parser("folded", help="Print the stacks of one trace in the folded format")
+    folded.add_argument("trace_id")
+    folded.set_defaults(run=print_folded)
+    args = parser.parse_args()
+
+    args.run(args)
@@ -0,0 +1,441 @@
+import os
+from abc import ABC, abstractmethod
+
+# Selects the storage backend, "firestore" for Firestore and Cloud Storage or "memory" for the in-memory engine
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firestore")
+# When set, the in-memory engine is loaded from and saved to this file
+MEMORY_BACKEND_PATH = os.environ.get("MEMORY_BACKEND_PATH")
+
+
+"""
+The persistence interface of the app, covering users, tweets, the follow graph, the materialized timelines,
+the search index and blobs.
+
+Documents are plain dicts. Users and tweets carry their document ID under 'id' and tweets also carry their
+author's ID under 'author_id'. A backend that leaves any of the abstract methods out cannot be created.
+"""
+class Repository(ABC):
+
+    # Users
+
+    """
+    Returns the user with the given ID, or None if there is none.
+    """
+    @abstractmethod
+    async def get_user(self, uid):
+        ...
+
+    """
+    Returns the users with the given IDs that exist, read in one batched get.
+    """
+    @abstractmethod
+    async def get_users(self, uids):
+        ...
+
+    """
+    Returns the user with the given username, or None if there is none, resolved through the username reservation.
+    """
+    @abstractmethod
+    async def find_user_by_username(self, username):
+        ...
+
+    """
+    Returns the users that have one of the given usernames, resolved through the username reservations.
+    """
+    @abstractmethod
+    async def find_users_by_username(self, usernames):
+        ...
+
+    """
+    Stores a new user, reserving their username if data has one. Meant for tools that write users in bulk, the app
+    claims usernames with claim_username.
+    """
+    @abstractmethod
+    async def create_user(self, uid, data):
+        ...
+
+    """
+    Reserves a username for a user and sets it on the user's document, creating the document if it does not exist,
+    in one transaction. The username the user held before is released.
+
+    Returns:
+        bool: False if the username is held by another user, in which case nothing is written.
+    """
+    @abstractmethod
+    async def claim_username(self, uid, username):
+        ...
+
+    @abstractmethod
+    async def update_user(self, uid, fields):
+        ...
+
+    """
+    Yields (uid, username) for every reserved username.
+    """
+    @abstractmethod
+    async def iter_usernames(self):
+        yield
+
+    """
+    Calls callback(uid, username) from any thread whenever a username is written by another process, with username
+    None when the user was removed.
+
+    Returns:
+        callable: Stops watching when called.
+    """
+    @abstractmethod
+    def watch_usernames(self, callback):
+        ...
+
+    # Follow graph
+
+    """
+    Makes one user follow another.
+
+    The edge is stored as its own record under both users and the follower_count of the target and the
+    following_count of the user are moved in the same atomic write. The target's celebrity flag follows its count,
+    see timeline.is_celebrity.
+
+    Args:
+        user (dict): The follower, with at least 'id' and 'username'.
+        target (dict): The user to follow, with at least 'id' and 'username'.
+
+    Returns:
+        bool: True if the user was not following the target before.
+    """
+    @abstractmethod
+    async def follow(self, user, target):
+        ...
+
+    """
+    Makes one user stop following another.
+
+    Returns:
+        bool: True if the user was following the target before.
+    """
+    @abstractmethod
+    async def unfollow(self, user, target):
+        ...
+
+    """
+    Returns whether one user follows another, with a single point lookup.
+    """
+    @abstractmethod
+    async def is_following(self, uid, target_id):
+        ...
+
+    """
+    Returns the IDs of the users following the given user.
+    """
+    @abstractmethod
+    async def follower_ids(self, uid):
+        ...
+
+    """
+    Returns the IDs of the users the given user follows.
+    """
+    @abstractmethod
+    async def following_ids(self, uid):
+        ...
+
+    """
+    Returns the users followed by the given user whose tweets are not fanned out on write. The number of users the
+    user follows, when known, lets the backend pick the cheaper way to find them.
+    """
+    @abstractmethod
+    async def find_followed_celebrities(self, uid, following_count=None):
+        ...
+
+    """
+    Yields every user document, for migrations.
+    """
+    @abstractmethod
+    async def iter_users(self):
+        yield
+
+    """
+    Writes follow edges without touching the counts, for migrations.
+
+    Args:
+        edges (list): (user, target, date) tuples, the users as dicts with 'id' and 'username'.
+    """
+    @abstractmethod
+    async def put_follow_edges(self, edges):
+        ...
+
+    """
+    Counts the stored follow edges of a user.
+
+    Returns:
+        tuple: The number of followers and the number of followed users.
+    """
+    @abstractmethod
+    async def count_follows(self, uid):
+        ...
+
+    @abstractmethod
+    async def remove_user_fields(self, uid, names):
+        ...
+
+    # Tweets
+
+    """
+    Stores a new tweet.
+
+    Returns:
+        str: The ID of the new tweet.
+    """
+    @abstractmethod
+    async def add_tweet(self, author_id, data):
+        ...
+
+    @abstractmethod
+    async def get_tweet(self, author_id, tweet_id):
+        ...
+
+    """
+    Returns the tweets for a list of (author_id, tweet_id) keys, skipping tweets that no longer exist.
+    """
+    @abstractmethod
+    async def get_tweets(self, keys):
+        ...
+
+    @abstractmethod
+    async def update_tweet(self, author_id, tweet_id, fields):
+        ...
+
+    @abstractmethod
+    async def delete_tweet(self, author_id, tweet_id):
+        ...
+
+    """
+    Returns the latest tweets of a user, newest first by (date, id).
+
+    Args:
+        author_id (str): The ID of the user.
+        limit (int): The number of tweets to return.
+        before (tuple, optional): Only return tweets older than this (date, id) position, for the next page.
+    """
+    @abstractmethod
+    async def latest_tweets(self, author_id, limit, before=None):
+        ...
+
+    """
+    Yields every tweet of every user.
+    """
+    @abstractmethod
+    async def iter_tweets(self):
+        yield
+
+    # Materialized timelines
+
+    """
+    Adds the same timeline entry to the timeline of each of the given users.
+    """
+    @abstractmethod
+    async def add_to_timelines(self, owner_ids, entry):
+        ...
+
+    """
+    Adds a list of timeline entries to the timeline of one user.
+    """
+    @abstractmethod
+    async def put_timeline_entries(self, owner_id, entries):
+        ...
+
+    """
+    Updates every timeline copy of a tweet.
+    """
+    @abstractmethod
+    async def update_timeline_entries(self, tweet_id, fields):
+        ...
+
+    """
+    Removes every timeline copy of a tweet.
+    """
+    @abstractmethod
+    async def delete_timeline_entries(self, tweet_id):
+        ...
+
+    """
+    Removes the tweets of one author from the timeline of one user.
+    """
+    @abstractmethod
+    async def prune_timeline(self, owner_id, author_id):
+        ...
+
+    """
+    Returns the newest entries of a user's timeline by (date, id), with the tweet ID under 'id', starting after the
+    (date, id) position before when it is given.
+    """
+    @abstractmethod
+    async def read_timeline(self, owner_id, limit, before=None):
+        ...
+
+    # Search index
+
+    """
+    Writes the posting of a tweet under each of its current terms and removes it from the terms it no longer contains,
+    keeping the per-term tweet counts in step. The index keeps the terms each tweet is indexed under, so the terms to
+    remove are known without the text the tweet had before. Applying the same update again changes nothing, so it
+    can be retried.
+
+    Args:
+        tweet_id (str): The ID of the tweet.
+        posting (dict): The posting, or None when the tweet was deleted.
+        terms (set): The terms of the tweet, empty when the tweet was deleted.
+    """
+    @abstractmethod
+    async def update_postings(self, tweet_id, posting, terms):
+        ...
+
+    """
+    Returns a dict of term to the number of tweets that contain it, omitting unknown terms.
+    """
+    @abstractmethod
+    async def term_counts(self, terms):
+        ...
+
+    """
+    Returns one page of a term's postings, newest first.
+
+    Args:
+        term (str): The term.
+        limit (int): The page size.
+        cursor (optional): The cursor returned with the previous page.
+
+    Returns:
+        tuple: The postings and the cursor of the next page, or None on the last page.
+    """
+    @abstractmethod
+    async def postings_page(self, term, limit, cursor=None):
+        ...
+
+    """
+    Removes every posting, term count and record of indexed terms from the search index.
+    """
+    @abstractmethod
+    async def clear_search_index(self):
+        ...
+
+    """
+    Writes a list of (term, tweet_id, posting) without touching the term counts, used when rebuilding the index.
+    """
+    @abstractmethod
+    async def put_postings(self, postings):
+        ...
+
+    """
+    Records the terms tweets are indexed under, a dict of tweet ID to terms, used when rebuilding the index.
+    """
+    @abstractmethod
+    async def put_indexed_terms(self, indexed_terms):
+        ...
+
+    """
+    Overwrites the tweet counts of the given terms, a dict of term to count.
+    """
+    @abstractmethod
+    async def set_term_counts(self, counts):
+        ...
+
+    # Bulk data
+
+    """
+    Returns one page of users in document ID order, starting after the user ID after.
+    """
+    @abstractmethod
+    async def users_page(self, limit, after=None):
+        ...
+
+    """
+    Returns one page of a user's tweets in document ID order, starting after the tweet ID after.
+    """
+    @abstractmethod
+    async def tweets_page(self, author_id, limit, after=None):
+        ...
+
+    """
+    Returns one page of the edges of the users a user follows, as dicts with the followed user's 'uid' and
+    'username' and the 'date' of the follow, in uid order starting after the uid after.
+    """
+    @abstractmethod
+    async def following_page(self, uid, limit, after=None):
+        ...
+
+    """
+    Writes users as they are, each with its 'id', reserving their usernames. Existing users are overwritten.
+    """
+    @abstractmethod
+    async def put_users(self, users):
+        ...
+
+    """
+    Writes tweets as they are, each with its 'id' and 'author_id'. Existing tweets are overwritten.
+    """
+    @abstractmethod
+    async def put_tweets(self, tweets):
+        ...
+
+    # Blobs
+
+    """
+    Stores a blob.
+
+    Args:
+        name (str): The name of the blob.
+        file: A binary file object to read the content from. Backends should stream it rather than read it whole.
+        content_type (str, optional): The MIME type of the content.
+        cache_control (str, optional): The Cache-Control header the blob is served with.
+
+    Returns:
+        str: The URL of the blob.
+    """
+    @abstractmethod
+    async def upload_blob(self, name, file, content_type=None, cache_control=None):
+        ...
+
+    """
+    Returns the content of a blob, or None if there is none.
+    """
+    @abstractmethod
+    async def read_blob(self, name):
+        ...
+
+    """
+    Returns whether a blob with the given name exists.
+    """
+    @abstractmethod
+    async def blob_exists(self, name):
+        ...
+
+    """
+    Returns the URL a blob is served from once it is stored, without checking that it exists.
+    """
+    @abstractmethod
+    def blob_url(self, name):
+        ...
+
+    """
+    Opens the connections of the backend ahead of the first request. Backends without connections do nothing.
+    """
+    async def warm_up(self):
+        pass
+
+    async def close(self):
+        pass
+
+"""
+Creates the repository selected by STORAGE_BACKEND.
+
+Returns:
+    Repository: The repository.
+"""
+def create_repository():
+    if STORAGE_BACKEND == "memory":
+        from memory_repository import MemoryRepository
+        return MemoryRepository(MEMORY_BACKEND_PATH)
+    if STORAGE_BACKEND == "firestore":
+        from firestore_repository import FirestoreRepository
+        return FirestoreRepository()
+    raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import re
+from constants import SEARCH_RESULT_LIMIT, SEARCH_PAGE_SIZE, MAX_TERM_LENGTH, MAX_BATCH_SIZE
+from repository import create_repository
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# Firestore reserves document IDs of the form __name__
+RESERVED_TERM_PATTERN = re.compile(r"^__.*__$")
+
+
+"""
+Splits tweet text into the set of lowercase terms it is indexed under, each cut to MAX_TERM_LENGTH characters.
+
+Args:
+    text (str): The tweet text or search query.
+
+Returns:
+    set: The distinct terms.
+"""
+def tokenize(text):
+    terms = {term[:MAX_TERM_LENGTH] for term in TOKEN_PATTERN.findall((text or "").lower())}
+    return {term for term in terms if not RESERVED_TERM_PATTERN.match(term)}
+
+def posting(tweet_id, author_id, tweet_data, terms):
+    return {
+        'tweet_id': tweet_id,
+        'author_id': author_id,
+        'date': tweet_data.get('date'),
+        'terms': sorted(terms)
+    }
+
+"""
+Adds or updates the postings of a tweet in the inverted index.
+
+Each term keeps the number of tweets that contain it and one posting per tweet. Every posting carries all the
+terms of its tweet so multi-word queries can be answered from a single postings list. The postings of the terms an
+edited tweet no longer contains are removed.
+
+Args:
+    repository (Repository): The storage backend.
+    author_id (str): The ID of the tweet's author.
+    tweet_id (str): The ID of the tweet.
+    tweet_data (dict): The tweet as stored.
+"""
+async def index_tweet(repository, author_id, tweet_id, tweet_data):
+    terms = tokenize(tweet_data.get('name'))
+    await repository.update_postings(tweet_id, posting(tweet_id, author_id, tweet_data, terms), terms)
+
+"""
+Removes the postings of a deleted tweet from the inverted index.
+
+Args:
+    repository (Repository): The storage backend.
+    tweet_id (str): The ID of the tweet.
+"""
+async def remove_tweet(repository, tweet_id):
+    await repository.update_postings(tweet_id, None, set())
+
+"""
+Finds the tweets that contain every word of a query, newest first.
+
+The postings of the rarest query term are paged through in date order and filtered on the remaining terms, so the
+cost depends on the number of matching tweets rather than on the number of users.
+
+Args:
+    repository (Repository): The storage backend.
+    words (str): The search query.
+    limit (int, optional): The maximum number of tweets to return. Defaults to SEARCH_RESULT_LIMIT.
+
+Returns:
+    List: The matching tweets sorted by date in descending order.
+"""
+async def search(repository, words, limit=SEARCH_RESULT_LIMIT):
+    terms = tokenize(words)
+    if not terms:
+        return []
+
+    counts = await repository.term_counts(terms)
+    if len(counts) < len(terms) or min(counts.values()) <= 0:
+        return []
+
+    rarest = min(counts, key=counts.get)
+    other_terms = terms - {rarest}
+
+    keys = []
+    page, cursor = await repository.postings_page(rarest, SEARCH_PAGE_SIZE)
+    while True:
+        for entry in page:
+            if other_terms.issubset(entry['terms']):
+                keys.append((entry['author_id'], entry['tweet_id']))
+        if len(keys) >= limit or cursor is None:
+            break
+        page, cursor = await repository.postings_page(rarest, SEARCH_PAGE_SIZE, cursor)
+
+    tweets = await repository.get_tweets(keys[:limit])
+    return sorted(tweets, key=lambda x: x['date'], reverse=True)
+
+"""
+Rebuilds the whole inverted index from the tweets of every user.
+
+Args:
+    repository (Repository): The storage backend.
+
+Returns:
+    int: The number of tweets indexed.
+"""
+async def rebuild(repository):
+    await repository.clear_search_index()
+
+    counts = {}
+    postings = []
+    indexed_terms = {}
+    indexed = 0
+
+    async for tweet in repository.iter_tweets():
+        terms = tokenize(tweet.get('name'))
+        entry = posting(tweet['id'], tweet['author_id'], tweet, terms)
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+            postings.append((term, tweet['id'], entry))
+        if terms:
+            indexed_terms[tweet['id']] = terms
+        indexed += 1
+        if len(postings) >= MAX_BATCH_SIZE:
+            await asyncio.gather(repository.put_postings(postings), repository.put_indexed_terms(indexed_terms))
+            postings = []
+            indexed_terms = {}
+    await asyncio.gather(repository.put_postings(postings), repository.put_indexed_terms(indexed_terms))
+
+    await repository.set_term_counts(counts)
+    return indexed
+
+async def main(command):
+    repository = create_repository()
+    try:
+        if command == "rebuild":
+            print(f"Indexed {await rebuild(repository)} tweets")
+    finally:
+        await repository.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the tweet search index.")
+    parser.add_argument("command", choices=["rebuild"])
+    args = parser.parse_args()
+
+    asyncio.run(main(args.command))
@@ -0,0 +1,73 @@
+'use strict'
+
+// Adds the tweets pushed by /timeline/stream to the top of the timeline, without reloading the page
+
+function formatDate(isoDate) {
+    const date = new Date(isoDate)
+    const pad = (number) => String(number).padStart(2, '0')
+    return `${date.getFullYear()}-${pad(date.getMonth() + 1)}-${pad(date.getDate())} ${pad(date.getHours())}:${pad(date.getMinutes())}:${pad(date.getSeconds())}`
+}
+
+function renderTweet(tweet, username) {
+    const container = document.createElement('div')
+    container.className = 'tweet-container'
+
+    const heading = document.createElement('h5')
+    const author = document.createElement('a')
+    author.href = `/profile/${encodeURIComponent(tweet.username)}`
+    author.className = 'name'
+    author.textContent = tweet.username
+    heading.appendChild(author)
+    container.appendChild(heading)
+
+    if (tweet.image_url) {
+        const link = document.createElement('a')
+        link.href = tweet.image_url
+        const image = document.createElement('img')
+        image.src = tweet.image_thumbnail_url || tweet.image_url
+        if (tweet.image_feed_url) {
+            image.srcset = `${tweet.image_thumbnail_url} 240w, ${tweet.image_feed_url} 720w`
+            image.sizes = '(max-width: 600px) 100vw, 600px'
+        }
+        image.alt = 'Tweet image'
+        image.className = 'tweet-image'
+        link.appendChild(image)
+        container.appendChild(link)
+    }
+
+    const text = document.createElement('p')
+    text.textContent = tweet.name
+    container.appendChild(text)
+
+    const date = document.createElement('p')
+    date.textContent = formatDate(tweet.date)
+    container.appendChild(date)
+
+    if (tweet.username === username) {
+        for (const [action, label] of [['edit', 'Edit'], ['delete', 'Delete']]) {
+            const link = document.createElement('a')
+            link.href = `/${action}/${encodeURIComponent(tweet.id)}`
+            link.className = action
+            link.textContent = label
+            container.appendChild(link)
+        }
+    }
+    return container
+}
+
+window.addEventListener('load', function() {
+    const liveTweets = document.getElementById('live-tweets')
+    if (!liveTweets || !window.EventSource) {
+        return
+    }
+
+    const stream = new EventSource('/timeline/stream')
+    stream.addEventListener('tweet', function(event) {
+        liveTweets.prepend(renderTweet(JSON.parse(event.data), liveTweets.dataset.username))
+    })
+    // The stream fell too far behind, the timeline is reloaded instead of showing a partial one
+    stream.addEventListener('reload', function() {
+        stream.close()
+        window.location.reload()
+    })
+})
@@ -0,0 +1,124 @@
+"""
+Streamed rendering of HTML pages.
+
+A streamed page is rendered with Jinja's async mode while it is being sent. Everything up to the first value that
+has to be fetched, such as the page shell and the compose form, goes out at once, and the rest follows as the data
+it shows arrives, for example a timeline that is iterated one tweet at a time. Rendering runs in a task of its own,
+and everything it has produced by the time it waits for data goes out as one chunk, so the page is sent in as few
+chunks as the waits allow.
+
+The render time of a streamed page is recorded once the page is complete, without the time it spent in the storage
+backend calls it waited on. Calls made side by side are all taken off, so pages that make them are undercounted.
+
+Whatever can end in an error page or a redirect, such as signing in, must happen before the response is created:
+once the page has started its status can no longer change, and an error while rendering cuts the page short.
+"""
+import asyncio
+import os
+import time
+from fastapi.responses import StreamingResponse
+from metrics import observe_template_render, storage_time
+
+# Set to "off" to render pages in full before sending them, for example behind a proxy that buffers them anyway
+STREAM_PAGES = os.environ.get("STREAM_PAGES", "on")
+# Rendered pieces a page can run ahead of a slow client, most pieces are a few bytes of markup
+STREAM_QUEUE_SIZE = 256
+# Templates kept compiled for async rendering, the default of Jinja
+TEMPLATE_CACHE_SIZE = 400
+
+
+"""
+Renders a template while its output is consumed.
+
+Args:
+    template (jinja2.Template): A template of an environment in async mode.
+    context (dict): The template context.
+
+Yields:
+    bytes: The output rendered by the time the renderer had to wait for data, or by the time it got ahead of the
+        consumer by STREAM_QUEUE_SIZE pieces.
+"""
+async def render_chunks(template, context):
+    pieces = asyncio.Queue(STREAM_QUEUE_SIZE)
+
+    async def render():
+        start = time.perf_counter()
+        waited = storage_time()
+        try:
+            async for piece in template.generate_async(context):
+                await pieces.put(piece)
+        except Exception as err:
+            await pieces.put(err)
+            return
+        observe_render_time(template, start, waited)
+        await pieces.put(None)
+
+    renderer = asyncio.create_task(render())
+    try:
+        while True:
+            chunk = [await pieces.get()]
+            while isinstance(chunk[-1], str) and not pieces.empty():
+                chunk.append(pieces.get_nowait())
+            end = chunk.pop() if not isinstance(chunk[-1], str) else ""
+            if chunk:
+                yield "".join(chunk).encode()
+            if isinstance(end, Exception):
+                raise end
+            if end is None:
+                return
+    finally:
+        # The client went away, or rendering failed
+        renderer.cancel()
+
+"""
+Renders a template in full before any of it is sent.
+"""
+async def render_whole(template, context):
+    start = time.perf_counter()
+    waited = storage_time()
+    page = await template.render_async(context)
+    observe_render_time(template, start, waited)
+    yield page.encode()
+
+def observe_render_time(template, start, waited):
+    observe_template_render(template.name, max(0, time.perf_counter() - start - (storage_time() - waited)))
+
+"""
+Renders the templates of a Jinja2Templates as streamed responses.
+
+The templates are compiled again in an async environment that shares the loader, globals and filters of the
+original, so the same template files serve both kinds of response.
+
+Args:
+    templates (Jinja2Templates): The templates.
+"""
+class StreamingTemplates:
+    def __init__(self, templates):
+        self.env = templates.env.overlay(enable_async=True, cache_size=TEMPLATE_CACHE_SIZE)
+        # Whether responses are streamed, or rendered in full first
+        self.stream = STREAM_PAGES != "off"
+
+    """
+    Compiles every template ahead of the first render. This blocks on the disk.
+    """
+    def compile(self):
+        for name in self.env.list_templates():
+            self.env.get_template(name)
+
+    """
+    Creates the streamed response of a template. Values in the context can be async iterables, which the template
+    loops over as they produce items, and coroutine functions, which it calls and awaits.
+
+    Args:
+        name (str): The template name.
+        context (dict): The template context, including the request.
+        status_code (int, optional): The status code. Defaults to 200.
+        headers (dict, optional): Extra response headers.
+
+    Returns:
+        StreamingResponse: The HTML response.
+    """
+    def TemplateResponse(self, name, context, status_code=200, headers=None):
+        template = self.env.get_template(name)
+        body = render_chunks(template, context) if self.stream else render_whole(template, context)
+        return StreamingResponse(body, status_code=status_code, headers=headers, media_type="text/html")
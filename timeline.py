@@ -0,0 +1,198 @@
+import asyncio
+from functools import partial
+from constants import TIMELINE_LENGTH, FANOUT_FOLLOWER_LIMIT, FANOUT_DEMOTION_RATIO
+from pagination import PageStream, merge_page
+
+
+"""
+Checks whether a user has too many followers to fan their tweets out on write.
+
+A user becomes a celebrity above FANOUT_FOLLOWER_LIMIT followers and stays one until their followers drop to
+FANOUT_DEMOTION_RATIO of it.
+
+Args:
+    follower_count (int): The number of users following the user.
+    celebrity (bool, optional): Whether the user is a celebrity now. Defaults to False.
+
+Returns:
+    bool: True if the user's tweets should be pulled on read instead.
+"""
+def is_celebrity(follower_count, celebrity=False):
+    if celebrity:
+        return follower_count > FANOUT_FOLLOWER_LIMIT * FANOUT_DEMOTION_RATIO
+    return follower_count > FANOUT_FOLLOWER_LIMIT
+
+def is_pulled(user):
+    return is_celebrity(user.get('follower_count', 0), user.get('celebrity', False))
+
+"""
+Builds the copy of a tweet that is stored in a user's materialized timeline.
+
+Args:
+    tweet_id (str): The ID of the tweet.
+    author_id (str): The ID of the user who wrote the tweet.
+    tweet_data (dict): The tweet as stored in the author's Tweet collection.
+
+Returns:
+    dict: The timeline entry.
+"""
+def timeline_entry(tweet_id, author_id, tweet_data):
+    return {
+        'tweet_id': tweet_id,
+        'author_id': author_id,
+        'name': tweet_data.get('name'),
+        'username': tweet_data.get('username'),
+        'date': tweet_data.get('date'),
+        'image_url': tweet_data.get('image_url', ''),
+        'image_feed_url': tweet_data.get('image_feed_url', ''),
+        'image_thumbnail_url': tweet_data.get('image_thumbnail_url', '')
+    }
+
+"""
+Pushes a new tweet into the author's timeline and the timeline of each of their followers.
+
+Celebrities, see is_celebrity, only get the tweet in their own timeline, their followers pull it when they read
+their timeline.
+
+Args:
+    repository (Repository): The storage backend.
+    author (dict): The author's user document.
+    tweet_id (str): The ID of the new tweet.
+    tweet_data (dict): The new tweet.
+"""
+async def fan_out_tweet(repository, author, tweet_id, tweet_data):
+    timeline_owners = [author['id']]
+    if author.get('follower_count', 0) and not is_pulled(author):
+        timeline_owners.extend(await repository.follower_ids(author['id']))
+
+    await repository.add_to_timelines(timeline_owners, timeline_entry(tweet_id, author['id'], tweet_data))
+
+"""
+Updates every timeline copy of an edited tweet.
+
+Args:
+    repository (Repository): The storage backend.
+    tweet_id (str): The ID of the edited tweet.
+    tweet_data (dict): The fields that changed.
+"""
+async def update_tweet_copies(repository, tweet_id, tweet_data):
+    await repository.update_timeline_entries(tweet_id, tweet_data)
+
+"""
+Removes every timeline copy of a deleted tweet.
+
+Args:
+    repository (Repository): The storage backend.
+    tweet_id (str): The ID of the deleted tweet.
+"""
+async def delete_tweet_copies(repository, tweet_id):
+    await repository.delete_timeline_entries(tweet_id)
+
+"""
+Copies the latest tweets of a newly followed user into the follower's timeline.
+
+Args:
+    repository (Repository): The storage backend.
+    user (dict): The follower's user document.
+    target_user (dict): The followed user's document.
+"""
+async def backfill_timeline(repository, user, target_user):
+    if is_pulled(target_user):
+        return
+
+    tweets = await repository.latest_tweets(target_user['id'], TIMELINE_LENGTH)
+    await repository.put_timeline_entries(user['id'], [timeline_entry(tweet['id'], target_user['id'], tweet) for tweet in tweets])
+
+"""
+Copies the latest tweets of a user who is no longer a celebrity into the timeline of each of their followers. Their
+tweets were pulled on read until now, so the ones posted as a celebrity were never fanned out.
+
+Args:
+    repository (Repository): The storage backend.
+    author (dict): The user's document.
+"""
+async def backfill_followers(repository, author):
+    follower_ids, tweets = await asyncio.gather(repository.follower_ids(author['id']), repository.latest_tweets(author['id'], TIMELINE_LENGTH))
+    for tweet in tweets:
+        await repository.add_to_timelines(follower_ids, timeline_entry(tweet['id'], author['id'], tweet))
+
+"""
+Removes the tweets of an unfollowed user from the follower's timeline.
+
+Args:
+    repository (Repository): The storage backend.
+    user (dict): The follower's user document.
+    author_id (str): The ID of the unfollowed user.
+"""
+async def prune_timeline(repository, user, author_id):
+    await repository.prune_timeline(user['id'], author_id)
+
+"""
+Materializes the timeline of a user whose timeline was never built, from their own tweets and the tweets of everyone they follow.
+
+Args:
+    repository (Repository): The storage backend.
+    user (dict): The user's document.
+"""
+async def rebuild_timeline(repository, user):
+    sources = [user['id']] + await repository.following_ids(user['id'])
+    results = await asyncio.gather(*(repository.latest_tweets(source, TIMELINE_LENGTH) for source in sources))
+
+    entries = [timeline_entry(tweet['id'], source, tweet) for source, tweets in zip(sources, results) for tweet in tweets]
+    await repository.put_timeline_entries(user['id'], entries)
+    await repository.update_user(user['id'], {'timeline_materialized': True})
+
+"""
+Lists the sources a user's timeline is merged from: the materialized timeline, built first if it never was, and
+the tweets of any followed accounts that are too large to fan out on write.
+
+Args:
+    repository (Repository): The storage backend.
+    user (dict): The user's document.
+
+Returns:
+    list: The fetch callables of the sources, see pagination.Source.
+"""
+async def timeline_sources(repository, user):
+    if not user.get('timeline_materialized'):
+        await rebuild_timeline(repository, user)
+
+    celebrities = await repository.find_followed_celebrities(user['id'], user.get('following_count'))
+
+    # Pull the tweets of followed accounts that are not fanned out on write
+    fetchers = [partial(repository.read_timeline, user['id'])]
+    fetchers.extend(partial(repository.latest_tweets, celebrity['id']) for celebrity in celebrities)
+    return fetchers
+
+"""
+Reads one page of a user's timeline newest first.
+
+The page is a k-way merge of the materialized timeline and the tweets of any followed accounts that are too
+large to fan out on write, each read from the cursor onwards and only as far as the page needs.
+
+Args:
+    repository (Repository): The storage backend.
+    user (dict): The user's document.
+    limit (int, optional): The number of tweets per page. Defaults to TIMELINE_LENGTH.
+    before (tuple, optional): The (date, id) position the page starts after. Defaults to None for the first page.
+
+Returns:
+    tuple: The timeline tweets sorted by date in descending order, and the cursor of the next page or None.
+"""
+async def read_timeline(repository, user, limit=TIMELINE_LENGTH, before=None):
+    return await merge_page(await timeline_sources(repository, user), limit, before)
+
+"""
+Reads one page of a user's timeline like read_timeline, but only while it is iterated, one tweet at a time.
+
+Args:
+    repository (Repository): The storage backend.
+    user (dict): The user's document.
+    limit (int, optional): The number of tweets per page. Defaults to TIMELINE_LENGTH.
+    before (tuple, optional): The (date, id) position the page starts after. Defaults to None for the first page.
+
+Returns:
+    PageStream: The tweets of the page newest first, with the cursor of the next page once they are all read.
+"""
+def stream_timeline(repository, user, limit=TIMELINE_LENGTH, before=None):
+    return PageStream(partial(timeline_sources, repository, user), limit, before)
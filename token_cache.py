@@ -0,0 +1,250 @@
+import asyncio
+import hashlib
+import heapq
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+import google.auth.jwt
+from google.auth import exceptions
+from datastore import run_blocking
+
+FIREBASE_CERTS_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+
+# Maximum number of verified tokens kept in memory
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "10000"))
+
+# Used when the cert response has no max-age, and how long before expiry the certs are refreshed
+DEFAULT_CERT_MAX_AGE = 3600
+CERT_REFRESH_MARGIN = 60
+CERT_RETRY_DELAY = 30
+# Seconds between two fetches of the certs for tokens signed with a key that is not in them, so tokens with made-up
+# key IDs cannot make every request fetch the certs
+CERT_FORCED_REFRESH_INTERVAL = int(os.environ.get("CERT_FORCED_REFRESH_INTERVAL", "60"))
+
+
+"""
+An LRU cache of decoded Firebase ID tokens keyed by the SHA-256 of the token.
+
+Entries are dropped once the token's exp has passed.
+"""
+class TokenCache:
+    def __init__(self, max_size=TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self.tokens = OrderedDict()
+        self.expiry_heap = []
+
+    @staticmethod
+    def key(id_token):
+        return hashlib.sha256(id_token.encode("utf-8")).hexdigest()
+
+    """
+    Checks whether decoded claims are still valid.
+
+    Args:
+        claims (dict): The decoded token.
+        now (float): The current unix time.
+
+    Returns:
+        bool: False if the token has expired.
+    """
+    def is_valid(self, claims, now):
+        return claims.get("exp", 0) > now
+
+    """
+    Looks up the decoded claims of a token.
+
+    Args:
+        id_token (str): The Firebase ID token.
+
+    Returns:
+        dict or None: The decoded token if it is cached and still valid, None otherwise.
+    """
+    def get(self, id_token):
+        key = self.key(id_token)
+        claims = self.tokens.get(key)
+        if claims is None:
+            return None
+
+        if not self.is_valid(claims, time.time()):
+            del self.tokens[key]
+            return None
+
+        self.tokens.move_to_end(key)
+        return claims
+
+    """
+    Caches the decoded claims of a verified token.
+
+    Args:
+        id_token (str): The Firebase ID token.
+        claims (dict): The decoded token.
+    """
+    def put(self, id_token, claims):
+        now = time.time()
+        self.evict_expired(now)
+        if not self.is_valid(claims, now):
+            return
+
+        key = self.key(id_token)
+        self.tokens[key] = claims
+        self.tokens.move_to_end(key)
+        heapq.heappush(self.expiry_heap, (claims["exp"], key))
+
+        while len(self.tokens) > self.max_size:
+            self.tokens.popitem(last=False)
+
+    """
+    Drops every cached token whose exp has passed.
+
+    Args:
+        now (float): The current unix time.
+    """
+    def evict_expired(self, now):
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            _, key = heapq.heappop(self.expiry_heap)
+            claims = self.tokens.get(key)
+            if claims is not None and claims["exp"] <= now:
+                del self.tokens[key]
+
+        # Keys evicted by the LRU leave stale heap entries behind, so compact it when it outgrows the cache
+        if len(self.expiry_heap) > 2 * self.max_size:
+            self.expiry_heap = [(claims["exp"], key) for key, claims in self.tokens.items()]
+            heapq.heapify(self.expiry_heap)
+
+"""
+Caches the public certs used to sign Firebase ID tokens for as long as their Cache-Control max-age allows,
+and refreshes them in the background before they expire.
+"""
+class CertCache:
+    def __init__(self, request_adapter, certs_url=FIREBASE_CERTS_URL):
+        self.request_adapter = request_adapter
+        self.certs_url = certs_url
+        self.certs = None
+        self.expires_at = 0
+        self.refresh_task = None
+        # The last fetch for a key that was not in the certs, and when it started
+        self.forced_refresh = None
+        self.forced_at = 0
+
+    """
+    Fetches the certs and records when they expire. This blocks on the network.
+    """
+    def fetch(self):
+        response = self.request_adapter(self.certs_url, method="GET")
+        if response.status != 200:
+            raise exceptions.TransportError("Could not fetch certificates at {}".format(self.certs_url))
+
+        max_age = DEFAULT_CERT_MAX_AGE
+        match = re.search(r"max-age=(\d+)", response.headers.get("cache-control", ""))
+        if match:
+            max_age = int(match.group(1))
+
+        self.certs = json.loads(response.data.decode("utf-8"))
+        self.expires_at = time.time() + max_age
+
+    """
+    Returns the current certs, fetching them if they are missing or expired.
+
+    Returns:
+        dict: A mapping of key IDs to x509 certificates.
+    """
+    async def get(self):
+        if self.certs is None or self.expires_at <= time.time():
+            await run_blocking(self.fetch)
+        self.start_refreshing()
+        return self.certs
+
+    """
+    Fetches the certs before they expire, for a token signed with a key that was rotated in after they were cached.
+    At most one such fetch starts per CERT_FORCED_REFRESH_INTERVAL seconds, callers that arrive while it runs wait
+    for it.
+
+    Returns:
+        dict or None: The fetched certs, or None if the certs were fetched this way too recently.
+    """
+    async def refresh(self):
+        now = time.monotonic()
+        if self.forced_refresh is None or now - self.forced_at >= CERT_FORCED_REFRESH_INTERVAL:
+            self.forced_at = now
+            self.forced_refresh = asyncio.ensure_future(run_blocking(self.fetch))
+        elif self.forced_refresh.done():
+            return None
+        await asyncio.shield(self.forced_refresh)
+        return self.certs
+
+    """
+    Starts the background refresh task if it is not running yet.
+    """
+    def start_refreshing(self):
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self.refresh_forever())
+
+    async def refresh_forever(self):
+        while True:
+            await asyncio.sleep(max(self.expires_at - CERT_REFRESH_MARGIN - time.time(), 0))
+            try:
+                await run_blocking(self.fetch)
+            except exceptions.TransportError as err:
+                print(str(err))
+                await asyncio.sleep(CERT_RETRY_DELAY)
+
+"""
+Verifies Firebase ID tokens against cached certs and remembers the result, so that authenticating a
+returning token is a dictionary lookup.
+"""
+class FirebaseTokenVerifier:
+    def __init__(self, request_adapter, max_size=TOKEN_CACHE_SIZE):
+        self.tokens = TokenCache(max_size)
+        self.certs = CertCache(request_adapter)
+
+    """
+    Verifies a Firebase ID token.
+
+    Args:
+        id_token (str): The Firebase ID token to be verified.
+
+    Returns:
+        dict: The decoded token.
+
+    Raises:
+        ValueError: If the token is invalid or expired, or signed with a key that is not in the certs.
+    """
+    async def verify(self, id_token):
+        claims = self.tokens.get(id_token)
+        if claims is not None:
+            return claims
+
+        certs = await self.certs.get()
+        try:
+            claims = google.auth.jwt.decode(id_token, certs=certs)
+        except exceptions.MalformedError as err:
+            # The token may be signed with a key that was rotated in after the certs were cached
+            if "Certificate for key id" not in str(err):
+                raise
+            certs = await self.certs.refresh()
+            if certs is None:
+                raise ValueError("Token is signed with an unknown key")
+            claims = google.auth.jwt.decode(id_token, certs=certs)
+
+        self.tokens.put(id_token, claims)
+        return claims
+
+    """
+    Looks up a token that was verified before, without verifying it.
+
+    Args:
+        id_token (str): The Firebase ID token.
+
+    Returns:
+        dict or None: The decoded token if it is cached and still valid, None otherwise.
+    """
+    def cached(self, id_token):
+        return self.tokens.get(id_token)
+
+    """
+    Fetches the certs ahead of the first sign-in and starts refreshing them in the background.
+    """
+    async def warm_up(self):
+        await self.certs.get()
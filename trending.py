@@ -0,0 +1,212 @@
+"""
+Trending hashtags and mentions over a sliding window, counted as tweets are posted.
+
+Each kind of topic is counted in a ring of time buckets that together cover TRENDING_WINDOW seconds. Every bucket is
+a count-min sketch, and a running total of the live buckets answers how often a topic was used in the whole window.
+When a bucket falls out of the window its sketch is subtracted from the total, so counts decay as the window moves.
+Next to the sketches, the topics with the highest counts are kept as a bounded set of candidates, of which the top
+is read. Memory depends on the settings only, never on how many tweets or distinct topics there are.
+
+Counts are estimates that can only be too high, by at most a few per TRENDING_SKETCH_WIDTH topic uses in the window.
+Counting happens in each worker from the tweets its broker delivers, so every worker sees every tweet when the live
+broker is shared through Redis. A worker that starts counts from that moment on.
+"""
+import hashlib
+import os
+import re
+import time
+from array import array
+from collections import deque
+
+# Seconds of tweets that trending topics are counted over
+TRENDING_WINDOW = float(os.environ.get("TRENDING_WINDOW", "3600"))
+# Buckets the window is divided in, the window moves forward one bucket at a time
+TRENDING_BUCKETS = int(os.environ.get("TRENDING_BUCKETS", "12"))
+# Topics shown per kind
+TRENDING_TOP = int(os.environ.get("TRENDING_TOP", "10"))
+# Topics tracked per kind, more than shown so topics just below the top can climb into it
+TRENDING_CANDIDATES = int(os.environ.get("TRENDING_CANDIDATES", "100"))
+# Counters per row and rows of each count-min sketch
+TRENDING_SKETCH_WIDTH = int(os.environ.get("TRENDING_SKETCH_WIDTH", "2048"))
+TRENDING_SKETCH_DEPTH = 4
+
+TOPIC_PATTERN = re.compile(r"(?<!\w)([#@])(\w+)")
+
+
+"""
+Finds the hashtags and mentions of a tweet.
+
+Args:
+    text (str): The tweet text.
+
+Returns:
+    tuple: The set of lowercase hashtags with their #, and the set of mentioned usernames with their @, as written
+        since usernames are case sensitive.
+"""
+def extract_topics(text):
+    hashtags, mentions = set(), set()
+    for sign, word in TOPIC_PATTERN.findall(text or ""):
+        if sign == "#":
+            hashtags.add(sign + word.lower())
+        else:
+            mentions.add(sign + word)
+    return hashtags, mentions
+
+"""
+Counts items in a fixed amount of memory. The count of an item is the smallest of its counters, one per row, so it
+is never below the true count and only above it when other items share all of its counters.
+
+Args:
+    width (int): The counters per row.
+    depth (int): The rows.
+"""
+class CountMinSketch:
+    def __init__(self, width=TRENDING_SKETCH_WIDTH, depth=TRENDING_SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('q', bytes(8 * width)) for _ in range(depth)]
+
+    """
+    Picks the counter of an item in each row, from one hash that is the same in every process.
+    """
+    def positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=8 * self.depth).digest()
+        return [int.from_bytes(digest[8 * row:8 * row + 8], "little") % self.width for row in range(self.depth)]
+
+    def add(self, positions, count=1):
+        estimate = None
+        for row, position in zip(self.rows, positions):
+            row[position] += count
+            estimate = row[position] if estimate is None else min(estimate, row[position])
+        return estimate
+
+    def estimate(self, positions):
+        return min(row[position] for row, position in zip(self.rows, positions))
+
+    def subtract(self, other):
+        for row, other_row in zip(self.rows, other.rows):
+            for position, count in enumerate(other_row):
+                if count:
+                    row[position] -= count
+
+    def clear(self):
+        for row in self.rows:
+            row[:] = array('q', bytes(8 * self.width))
+
+"""
+Counts items over a sliding window of time and keeps the ones with the highest counts.
+
+Args:
+    window (float): The seconds the counts cover.
+    buckets (int): The buckets the window is divided in.
+    candidates (int): The items tracked for the top.
+    clock (callable): Returns the current time in seconds.
+"""
+class SlidingTopK:
+    def __init__(self, window=TRENDING_WINDOW, buckets=TRENDING_BUCKETS, candidates=TRENDING_CANDIDATES, clock=time.monotonic):
+        self.bucket_seconds = window / buckets
+        self.bucket_count = buckets
+        self.max_candidates = candidates
+        self.clock = clock
+        # (bucket number, sketch) of the live buckets, oldest first
+        self.buckets = deque()
+        self.total = CountMinSketch()
+        # item -> (estimated count over the window, positions in the sketches)
+        self.candidates = {}
+        # The candidates sorted by count, until the counts change
+        self.ranking = None
+
+    """
+    Moves the window up to the current time: expired buckets are subtracted from the total and reused for the new
+    bucket, and the candidates are counted again without them.
+    """
+    def advance(self):
+        current = int(self.clock() // self.bucket_seconds)
+        expired = []
+        while self.buckets and self.buckets[0][0] <= current - self.bucket_count:
+            _, sketch = self.buckets.popleft()
+            self.total.subtract(sketch)
+            expired.append(sketch)
+
+        if not self.buckets or self.buckets[-1][0] != current:
+            sketch = expired.pop() if expired else CountMinSketch(self.total.width, self.total.depth)
+            sketch.clear()
+            self.buckets.append((current, sketch))
+
+        if expired:
+            self.recount()
+
+    def recount(self):
+        for item, (_, positions) in list(self.candidates.items()):
+            count = self.total.estimate(positions)
+            if count > 0:
+                self.candidates[item] = (count, positions)
+            else:
+                del self.candidates[item]
+        self.ranking = None
+
+    def add(self, item, count=1):
+        self.advance()
+        positions = self.total.positions(item)
+        self.buckets[-1][1].add(positions, count)
+        estimate = self.total.add(positions, count)
+
+        if item not in self.candidates and len(self.candidates) >= self.max_candidates:
+            smallest = min(self.candidates, key=lambda candidate: self.candidates[candidate][0])
+            if self.candidates[smallest][0] >= estimate:
+                return
+            del self.candidates[smallest]
+        self.candidates[item] = (estimate, positions)
+        self.ranking = None
+
+    """
+    Returns the items with the highest counts over the window.
+
+    Args:
+        limit (int): The number of items.
+
+    Returns:
+        list: The (item, count) pairs, highest count first.
+    """
+    def top(self, limit):
+        self.advance()
+        if self.ranking is None:
+            self.ranking = sorted(((item, count) for item, (count, _) in self.candidates.items()), key=lambda entry: (-entry[1], entry[0]))
+        return self.ranking[:limit]
+
+"""
+The trending hashtags and mentions, counted separately so one kind cannot crowd out the other.
+"""
+class Trending:
+    def __init__(self):
+        self.hashtags = SlidingTopK()
+        self.mentions = SlidingTopK()
+
+    """
+    Counts the topics of a new tweet, once per tweet. Called by the broker for every tweet it delivers.
+
+    Args:
+        author_id (str): The ID of the author.
+        tweet (dict): The tweet as it is shown in a timeline.
+    """
+    def add_tweet(self, author_id, tweet):
+        hashtags, mentions = extract_topics(tweet.get('name'))
+        for hashtag in hashtags:
+            self.hashtags.add(hashtag)
+        for mention in mentions:
+            self.mentions.add(mention)
+
+    """
+    Returns the trending topics of each kind.
+
+    Args:
+        limit (int, optional): The topics per kind. Defaults to TRENDING_TOP.
+
+    Returns:
+        dict: The hashtags and the mentions, each a list of {'topic', 'count'} highest count first.
+    """
+    def top(self, limit=TRENDING_TOP):
+        return {
+            'hashtags': [{'topic': topic, 'count': count} for topic, count in self.hashtags.top(limit)],
+            'mentions': [{'topic': topic, 'count': count} for topic, count in self.mentions.top(limit)],
+        }
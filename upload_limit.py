@@ -0,0 +1,48 @@
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from starlette.status import HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
+
+"""
+Rejects multipart request bodies larger than a limit while they are being received.
+
+Requests that announce a larger Content-Length are rejected before any of the body is read. Other requests are
+counted as they stream in and fail as soon as the limit is passed, so an oversized image is never spooled in full.
+
+Args:
+    app: The ASGI app to wrap.
+    max_body_size (int): The largest accepted body in bytes.
+"""
+class UploadSizeLimitMiddleware:
+    def __init__(self, app, max_body_size):
+        self.app = app
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.is_multipart(scope):
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_body_size:
+            response = JSONResponse({"detail": "Upload too large"}, status_code=HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_size:
+                    # Raised from inside form parsing, so the app answers with a 413 like any other HTTPException
+                    raise HTTPException(status_code=HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Upload too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    def is_multipart(self, scope):
+        content_type = dict(scope["headers"]).get(b"content-type", b"")
+        return content_type.startswith(b"multipart/form-data")
@@ -0,0 +1,133 @@
+import sys
+from bisect import bisect_left, insort
+
+
+"""
+A process-local index of every username, kept in a sorted list for prefix search and a dict for exact
+username to user ID resolution.
+
+The index is loaded once at startup and kept fresh by the writes of this process and by a storage backend listener
+for the writes of other processes. All mutations happen on the event loop thread.
+"""
+class UsernameIndex:
+    def __init__(self):
+        self.usernames = []
+        self.uids = {}
+        self.usernames_by_uid = {}
+        self.loaded = False
+        self.unsubscribe = None
+
+    """
+    Adds a username, replacing the previous username of the same user if it changed.
+
+    Args:
+        username (str): The username.
+        uid (str): The ID of the user's document.
+    """
+    def add(self, username, uid):
+        previous = self.usernames_by_uid.get(uid)
+        if previous == username:
+            return
+        if previous is not None:
+            self.remove(uid)
+        if username in self.uids:
+            self.remove(self.uids[username])
+
+        self.uids[username] = uid
+        self.usernames_by_uid[uid] = username
+        insort(self.usernames, username)
+
+    """
+    Removes the username of a user.
+
+    Args:
+        uid (str): The ID of the user's document.
+    """
+    def remove(self, uid):
+        username = self.usernames_by_uid.pop(uid, None)
+        if username is None:
+            return
+
+        del self.uids[username]
+        position = bisect_left(self.usernames, username)
+        if position < len(self.usernames) and self.usernames[position] == username:
+            del self.usernames[position]
+
+    """
+    Finds the usernames that start with a prefix, in alphabetical order.
+
+    Args:
+        prefix (str): The prefix to search for.
+        limit (int): The maximum number of usernames to return.
+
+    Returns:
+        list: The matching usernames.
+    """
+    def search_prefix(self, prefix, limit):
+        matches = []
+        position = bisect_left(self.usernames, prefix)
+        while position < len(self.usernames) and len(matches) < limit and self.usernames[position].startswith(prefix):
+            matches.append(self.usernames[position])
+            position += 1
+        return matches
+
+    """
+    Resolves a username to the ID of the user's document.
+
+    Args:
+        username (str): The username.
+
+    Returns:
+        str or None: The user ID, or None if the username is not in the index.
+    """
+    def resolve(self, username):
+        return self.uids.get(username)
+
+    """
+    Estimates the memory held by the index.
+
+    Returns:
+        int: The size in bytes of the containers and the strings they hold.
+    """
+    def memory_footprint(self):
+        size = sys.getsizeof(self.usernames) + sys.getsizeof(self.uids) + sys.getsizeof(self.usernames_by_uid)
+        for username, uid in self.uids.items():
+            size += sys.getsizeof(username) + sys.getsizeof(uid)
+        return size
+
+    """
+    Loads every username from the storage backend.
+
+    Args:
+        repository (Repository): The storage backend.
+    """
+    async def load(self, repository):
+        async for uid, username in repository.iter_usernames():
+            self.add(username, uid)
+        self.loaded = True
+
+    """
+    Applies one username change reported by the storage backend.
+    """
+    def apply_change(self, uid, username):
+        if username:
+            self.add(username, uid)
+        else:
+            self.remove(uid)
+
+    """
+    Starts listening for username changes made by other processes.
+
+    The backend may report changes from another thread, so they are handed over to the event loop.
+
+    Args:
+        repository (Repository): The storage backend.
+        loop (asyncio.AbstractEventLoop): The event loop that owns the index.
+    """
+    def listen(self, repository, loop):
+        self.unsubscribe = repository.watch_usernames(lambda uid, username: loop.call_soon_threadsafe(self.apply_change, uid, username))
+
+    def stop(self):
+        if self.unsubscribe is not None:
+            self.unsubscribe()
+            self.unsubscribe = None
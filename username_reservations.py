@@ -0,0 +1,58 @@
+import argparse
+import asyncio
+from constants import MAX_BATCH_SIZE
+from repository import create_repository
+
+
+"""
+Reserves the usernames of the users that were created before usernames had reservations.
+
+Each username is claimed for the user that has it, so the migration can be run again after an interruption. When
+two users ended up with the same username, the first one reached keeps it and the others are reported, they need
+to pick a new username.
+
+Args:
+    repository (Repository): The storage backend.
+
+Returns:
+    tuple: The number of usernames reserved, and the (uid, username) of the users whose username is held by another user.
+"""
+async def migrate(repository):
+    reserved = 0
+    conflicts = []
+
+    async def claim(user):
+        nonlocal reserved
+        if await repository.claim_username(user['id'], user['username']):
+            reserved += 1
+        else:
+            conflicts.append((user['id'], user['username']))
+
+    users = []
+    async for user in repository.iter_users():
+        if user.get('username'):
+            users.append(user)
+        if len(users) == MAX_BATCH_SIZE:
+            await asyncio.gather(*(claim(user) for user in users))
+            users = []
+    await asyncio.gather(*(claim(user) for user in users))
+    return reserved, conflicts
+
+async def main(command):
+    repository = create_repository()
+    try:
+        if command == "migrate":
+            reserved, conflicts = await migrate(repository)
+            print(f"Reserved {reserved} usernames")
+            for uid, username in conflicts:
+                print(f"Username {username} of user {uid} is held by another user")
+    finally:
+        await repository.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the username reservations.")
+    parser.add_argument("command", choices=["migrate"])
+    args = parser.parse_args()
+
+    asyncio.run(main(args.command))